@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark CCI SST decoding on synthetic CCI-shaped files.
+
+Compares the old reader (one open per variable, float64 CF decoding, serial)
+with process_sst_cci's single-open float32 reader run through a thread pool.
+Files are int16/int8 packed, gzip-chunked and carry the CF attributes of the
+real mirror files.
+
+Run from wrf-auto-runs/ (process_sst_cci imports params, so a parameters.toml
+must be present):
+
+    python benchmarks/bench_cci_decode.py --days 16 --workers 1 2 4
+"""
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import h5netcdf
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import process_sst_cci  # noqa: E402
+
+
+def write_synthetic(path, nlat, nlon, seed):
+    rng = np.random.default_rng(seed)
+    lat = np.linspace(-60, -60 + nlat * 0.05, nlat, endpoint=False, dtype='f4')
+    lon = np.linspace(150, 150 + nlon * 0.05, nlon, endpoint=False, dtype='f4')
+    shape = (1, nlat, nlon)
+    chunks = (1, min(nlat, 360), min(nlon, 720))
+
+    sst = rng.integers(-500, 3000, size=shape, dtype='i2')
+    sst[:, : nlat // 10, :] = -32768  # land / fill rows
+    ice = rng.integers(0, 100, size=shape, dtype='i1')
+
+    with h5netcdf.File(str(path), 'w') as f:
+        f.dimensions = {'time': 1, 'lat': nlat, 'lon': nlon}
+        f.create_variable('lat', ('lat',), data=lat)
+        f.create_variable('lon', ('lon',), data=lon)
+        v = f.create_variable('analysed_sst', ('time', 'lat', 'lon'), data=sst,
+                              chunks=chunks, compression='gzip')
+        v.attrs['scale_factor'] = 0.01
+        v.attrs['add_offset'] = 273.15
+        v.attrs['_FillValue'] = np.int16(-32768)
+        v = f.create_variable('sea_ice_fraction', ('time', 'lat', 'lon'), data=ice,
+                              chunks=chunks, compression='gzip')
+        v.attrs['scale_factor'] = 0.01
+        v.attrs['_FillValue'] = np.int8(-128)
+
+
+def old_read(nc_path, var_name, idx):
+    """Reader as it was before single-open decoding: one open per variable, float64."""
+    lat_lo, lat_hi, ((lon_lo, lon_hi),) = idx
+    with h5netcdf.File(str(nc_path), 'r') as f:
+        var = f.variables[var_name]
+        raw = np.asarray(var[0, lat_lo:lat_hi, lon_lo:lon_hi])
+        scale = float(var.attrs['scale_factor']) if 'scale_factor' in var.attrs else 1.0
+        offset = float(var.attrs['add_offset']) if 'add_offset' in var.attrs else 0.0
+        fill = var.attrs.get('_FillValue')
+
+    data = raw.astype(np.float64) * scale + offset
+    if fill is not None:
+        data[raw == fill] = np.nan
+    return data
+
+
+def bench_old(paths, idx):
+    t0 = time.perf_counter()
+    for path in paths:
+        old_read(path, 'analysed_sst', idx)
+        old_read(path, 'sea_ice_fraction', idx)
+    return time.perf_counter() - t0
+
+
+def bench_new(paths, idx, workers):
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in pool.map(lambda p: process_sst_cci._read_day_slabs(p, idx), paths):
+            pass
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=16)
+    parser.add_argument('--nlat', type=int, default=600, help='grid rows (0.05 deg)')
+    parser.add_argument('--nlon', type=int, default=800, help='grid columns (0.05 deg)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='cci_bench_') as tmp:
+        paths = [pathlib.Path(tmp, f'day{i:03d}.nc') for i in range(args.days)]
+        for i, path in enumerate(paths):
+            write_synthetic(path, args.nlat, args.nlon, seed=i)
+
+        lat0 = -60 + args.nlat * 0.05 * 0.25
+        lon0 = 150 + args.nlon * 0.05 * 0.25
+        idx, _, _ = process_sst_cci._bbox_indices(
+            paths[0], lon0, lat0, lon0 + args.nlon * 0.05 * 0.5, lat0 + args.nlat * 0.05 * 0.5)
+
+        print(f'{args.days} days, {args.nlat}x{args.nlon} grid, subset '
+              f'{idx[1] - idx[0]}x{idx[2][0][1] - idx[2][0][0]} (best of {args.repeat})')
+        base = min(bench_old(paths, idx) for _ in range(args.repeat))
+        print(f'  old (per-variable open, float64): {base:7.3f} s')
+        for workers in args.workers:
+            t = min(bench_new(paths, idx, workers) for _ in range(args.repeat))
+            print(f'  single open, float32, {workers} worker(s): {t:7.3f} s  ({base / t:4.2f}x)')
+
+
+if __name__ == '__main__':
+    main()
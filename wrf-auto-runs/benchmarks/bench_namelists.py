@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark batch namelist generation with namelists.build_namelists.
+
+Builds the WPS and WRF namelists of --configs campaign configurations (one
+period per day from --start, cycling through every runnable domain subset of
+the [domains] tree, with and without ndown settings) in a single process,
+using the parameters.toml next to the scripts. It reports configurations per
+second for the in-memory build alone, build plus rendering to namelist text,
+and build plus writing both files to a temporary directory.
+
+Run from wrf-auto-runs/ (namelists imports params, so a parameters.toml must
+be present):
+
+    python benchmarks/bench_namelists.py --configs 5000
+"""
+import argparse
+import io
+import pathlib
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import utils  # noqa: E402
+from namelists import NamelistConfig, build_namelists  # noqa: E402
+
+
+def domain_subsets(parent_ids):
+    """Every domain with all its nests: the subsets a run (or ndown run) can take."""
+    subsets = []
+    for top in range(1, len(parent_ids) + 1):
+        subset = [top]
+        for domain, parent in enumerate(parent_ids[top:], top + 1):
+            if parent in subset:
+                subset.append(domain)
+        subsets.append(subset)
+    return subsets
+
+
+def configurations(config, n, start, days):
+    subsets = domain_subsets(utils.to_list(config.file['domains']['parent_id']))
+    for i in range(n):
+        period_start = start + timedelta(days=i)
+        domains = subsets[i % len(subsets)]
+        ndown = 3600 if domains[0] > 1 and i % 2 else None
+        yield period_start, period_start + timedelta(days=days), domains, ndown
+
+
+def bench(config, cases, step=None):
+    t0 = time.perf_counter()
+    for start_date, end_date, domains, ndown in cases:
+        nml = build_namelists(config, start_date, end_date, domains, ndown)
+        if step is not None:
+            step(nml)
+    return time.perf_counter() - t0
+
+
+def render(nml):
+    for namelist in nml.to_f90nml():
+        namelist.write(io.StringIO())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--configs', type=int, default=5000)
+    parser.add_argument('--start', default='2000-01-01', help='first period start (YYYY-MM-DD)')
+    parser.add_argument('--days', type=int, default=2, help='period length in days')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    config = NamelistConfig.from_params()
+    cases = list(configurations(config, args.configs, datetime.fromisoformat(args.start), args.days))
+
+    with tempfile.TemporaryDirectory(prefix='nml_bench_') as tmp:
+        wps_path = pathlib.Path(tmp, 'namelist.wps')
+        wrf_path = pathlib.Path(tmp, 'namelist.input')
+
+        print(f'{args.configs} configurations, {len(domain_subsets(utils.to_list(config.file["domains"]["parent_id"])))} '
+              f'domain subsets (best of {args.repeat})')
+        for label, step in (('build', None), ('build + render', render),
+                            ('build + write', lambda nml: nml.write(wps_path, wrf_path))):
+            t = min(bench(config, cases, step) for _ in range(args.repeat))
+            print(f'  {label:<15} {t:7.3f} s  ({args.configs / t:8.0f} configs/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-addressed file cache shared between runs and Slurm array tasks.
+
+Configured by the optional [cache] section of parameters.toml. Each namespace
+(era5, int, geo_em, ...) lives under {[cache].path}/{namespace}/ and holds one
+directory per entry containing the cached files plus a meta.json describing
+them. The cache directory may sit on shared NFS:
+
+- Entries are staged in {namespace}/.tmp and renamed into place, so readers
+  never see a partially written entry.
+- A POSIX lock file per key (fcntl.lockf, which also works over NFS) makes sure
+  only one task fills a given key while the others wait for it.
+- Files are hard-linked into the run's data_path (copied when the cache is on
+  another filesystem), so evicting an entry never breaks a running task.
+- max_size_gb caps each namespace; the least recently used entries are evicted
+  first.
+
+POSIX locks belong to the process, not the file descriptor: don't hold the same
+key's lock from two threads of one process.
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+import params
+
+
+META_FILE = 'meta.json'
+LOCK_DIR = '.locks'
+TMP_DIR = '.tmp'
+
+
+#######################################################
+### Helpers
+
+
+def hash_key(*parts):
+    """sha256 hex digest of the canonical JSON encoding of parts."""
+    s = json.dumps(parts, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+def hash_file(path, block_size=1 << 20):
+    """sha256 hex digest of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """Hard-link src to dst, falling back to a copy across filesystems."""
+    dst = Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def bbox_contains(outer, inner):
+    """True if the (min_lon, min_lat, max_lon, max_lat) box outer covers inner."""
+    return (outer[0] <= inner[0] and outer[1] <= inner[1]
+            and outer[2] >= inner[2] and outer[3] >= inner[3])
+
+
+#######################################################
+### Cache
+
+
+class FileCache:
+    """A directory of atomically published, LRU-evicted cache entries."""
+
+    def __init__(self, root, max_bytes=None):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.root.joinpath(LOCK_DIR).mkdir(exist_ok=True)
+        self.root.joinpath(TMP_DIR).mkdir(exist_ok=True)
+
+    def path(self, key):
+        return self.root.joinpath(key)
+
+    def _lock_path(self, key):
+        return self.root.joinpath(LOCK_DIR, key.replace('/', '__') + '.lock')
+
+    @staticmethod
+    def _touch(entry):
+        os.utime(entry.joinpath(META_FILE))
+
+    @staticmethod
+    def read_meta(entry):
+        with open(entry.joinpath(META_FILE)) as f:
+            return json.load(f)
+
+    def get(self, key):
+        """Return the entry directory for key, or None on a miss."""
+        entry = self.path(key)
+        if entry.joinpath(META_FILE).exists():
+            self._touch(entry)
+            return entry
+        return None
+
+    def find(self, prefix, match):
+        """Return the first entry under prefix whose meta satisfies match(meta), or None."""
+        group = self.path(prefix)
+        if not group.is_dir():
+            return None
+        for meta_path in sorted(group.glob(f'*/{META_FILE}')):
+            entry = meta_path.parent
+            try:
+                meta = self.read_meta(entry)
+            except (OSError, ValueError):
+                continue
+            if match(meta):
+                self._touch(entry)
+                return entry
+        return None
+
+    @contextlib.contextmanager
+    def lock(self, key, blocking=True):
+        """Exclusive lock on key. Yields True once held (False if non-blocking and busy)."""
+        with open(self._lock_path(key), 'a') as f:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.lockf(f, flags)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+
+    def publish(self, key, files, meta=None):
+        """
+        Atomically publish files as the entry for key and return the entry directory.
+
+        files maps the name inside the entry (may contain '/') to a source path,
+        or is a list of paths stored under their own names. If another task
+        published the key first, its entry is kept and returned.
+        """
+        if not isinstance(files, dict):
+            files = {Path(p).name: p for p in files}
+
+        tmp = self.root.joinpath(TMP_DIR, uuid.uuid4().hex)
+        try:
+            for name, src in files.items():
+                link_or_copy(src, tmp.joinpath(name))
+            meta = dict(meta or {})
+            meta['key'] = key
+            meta['files'] = sorted(files)
+            meta['created'] = time.time()
+            with open(tmp.joinpath(META_FILE), 'w') as f:
+                json.dump(meta, f)
+
+            entry = self.path(key)
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                if not entry.joinpath(META_FILE).exists():
+                    raise
+        finally:
+            if tmp.exists():
+                shutil.rmtree(tmp)
+
+        return entry
+
+    def materialize(self, entry, dest_dir, names=None):
+        """Link an entry's files (or just names) into dest_dir. Returns the destination paths."""
+        if names is None:
+            names = self.read_meta(entry)['files']
+        return [link_or_copy(entry.joinpath(name), Path(dest_dir).joinpath(name)) for name in names]
+
+    def entries(self):
+        """Yield (entry, size_bytes, last_used) for every published entry."""
+        for meta_path in self.root.rglob(META_FILE):
+            entry = meta_path.parent
+            if entry.relative_to(self.root).parts[0] in (LOCK_DIR, TMP_DIR):
+                continue
+            size = sum(p.stat().st_size for p in entry.rglob('*') if p.is_file())
+            yield entry, size, meta_path.stat().st_mtime
+
+    def evict(self):
+        """Remove least-recently-used entries until the namespace fits in max_bytes."""
+        if not self.max_bytes:
+            return 0
+
+        with self.lock('.evict', blocking=False) as held:
+            if not held:
+                return 0
+
+            entries = sorted(self.entries(), key=lambda e: e[2])
+            total = sum(e[1] for e in entries)
+            n_removed = 0
+            for entry, size, _ in entries:
+                if total <= self.max_bytes:
+                    break
+                key = str(entry.relative_to(self.root))
+                with self.lock(key, blocking=False) as free:
+                    if not free:
+                        continue
+                    shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+                n_removed += 1
+
+        return n_removed
+
+
+def get_cache(namespace):
+    """
+    Return the FileCache for namespace, or None when caching is not configured.
+
+    [cache].max_size_gb sets the default cap per namespace; a [cache.<namespace>]
+    table can override it or disable the namespace with enabled = false.
+    """
+    if params.cache_path is None:
+        return None
+
+    cache_cfg = params.file.get('cache', {})
+    ns_cfg = cache_cfg.get(namespace, {})
+    if not ns_cfg.get('enabled', True):
+        return None
+
+    max_size_gb = ns_cfg.get('max_size_gb', cache_cfg.get('max_size_gb'))
+    max_bytes = int(max_size_gb * 1024**3) if max_size_gb else None
+
+    return FileCache(params.cache_path.joinpath(namespace), max_bytes)
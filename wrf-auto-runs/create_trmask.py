@@ -15,6 +15,7 @@ import h5netcdf
 import pathlib
 
 import params
+from domain_tree import DomainTree
 
 
 def create_trmask(domains, start_date):
@@ -77,6 +78,8 @@ def create_trmask(domains, start_date):
     max_lat = bbox_values['max_lat']
     min_lon = bbox_values['min_lon']
     max_lon = bbox_values['max_lon']
+    if has_bbox:
+        _warn_outside_domains(domains, min_lat, max_lat, min_lon, max_lon)
 
     # Format the Times string as WRF expects: "YYYY-MM-DD_HH:MM:SS"
     if hasattr(start_date, 'format'):
@@ -142,6 +145,21 @@ def create_trmask(domains, start_date):
         )
 
 
+def _warn_outside_domains(domains, min_lat, max_lat, min_lon, max_lon):
+    """Warn about domains the [wvt] bbox misses entirely, whose masks would be all zero."""
+    tree = DomainTree(params.file['domains'])
+    if tree.map_proj == 'lat-lon':
+        return
+
+    bounds = tree.bounds()
+    for domain in domains:
+        d_min_lon, d_min_lat, d_max_lon, d_max_lat = bounds[domain - 1]
+        lat_overlap = min_lat <= d_max_lat and max_lat >= d_min_lat
+        lon_overlap = any(min_lon + k <= d_max_lon and max_lon + k >= d_min_lon for k in (0, 360, 720))
+        if not (lat_overlap and lon_overlap):
+            print(f'   WARNING: the [wvt] bbox does not overlap domain d{domain:02d}; its tracer mask will be empty')
+
+
 def _write_trmask(path, lat, lon, mask, times_str, mminlu, num_land_cat,
                   do_2d=True, do_3d=False, n_vert=None):
     """Write a trmask NetCDF3 classic file in the format WRF expects."""
@@ -254,3 +254,34 @@ TIME_CONTROL_PIPELINE_KEYS = {
     'start_date', 'end_date', 'duration_hours', 'interval_hours',
     'history_file', 'summary_file', 'z_level_file',
 }
+
+# ============================================================
+# ERA5 Source Files
+# ============================================================
+
+# File codes era5_dl's 'wrf' preset downloads, per source product. Source keys
+# are {product}/{YYYYMM}/{product}.{code}.ll025{sc|uv}.{YYYYMMDDHH}_{YYYYMMDDHH}.nc;
+# invariant files sit under e5.oper.invariant/197901/.
+ERA5_FILE_CODES = {
+    'e5.oper.an.pl': ('128_129_z', '128_133_q', '128_130_t', '128_131_u', '128_132_v'),
+    'e5.oper.an.sfc': (
+        '128_034_sstk', '128_235_skt', '128_039_swvl1', '128_040_swvl2',
+        '128_041_swvl3', '128_042_swvl4', '128_139_stl1', '128_170_stl2',
+        '128_183_stl3', '128_236_stl4', '128_031_ci', '128_167_2t',
+        '128_168_2d', '128_165_10u', '128_166_10v', '128_033_rsn',
+        '128_141_sd', '128_151_msl', '128_134_sp',
+    ),
+    'e5.oper.invariant': ('128_129_z', '128_172_lsm'),
+}
+
+# ERA5 file codes replaced by CCI when sst.source = 'cci'
+ERA5_CCI_SKIP_CODES = ('128_034_sstk', '128_031_ci')
+
+ERA5_INVARIANT_MONTH = '197901'
+
+# ERA5 pressure levels (hPa), surface to top
+ERA5_PRESSURE_LEVELS = (
+    1000, 975, 950, 925, 900, 875, 850, 825, 800, 775, 750, 700, 650, 600, 550,
+    500, 450, 400, 350, 300, 250, 225, 200, 175, 150, 125, 100, 70, 50, 30,
+    20, 10, 7, 5, 3, 2, 1,
+)
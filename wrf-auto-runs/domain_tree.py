@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Geometry of a WRF domain tree, computed once for every nest.
+
+DomainTree takes a geogrid dict (the [domains] section or namelist.wps
+&geogrid) and works out, for all domains at once, the grid spacing, the
+projected lower-left corner and centre, the corner and boundary lon/lat and
+the parent chain. Nest generations are resolved together with numpy
+(parents always come before their nests in the namelist), and every
+boundary ring goes through one pyproj transform.
+
+It backs the geogrid subsetting of set_params (domains and ndown runs),
+the WPS_GEOG staging plan (stage_geog.py), the campaign input bbox of
+prefetch.py (main.py still takes its bbox from the geo_em ring) and the
+[wvt] bbox check of create_trmask.
+"""
+import copy
+
+import numpy as np
+
+import utils
+
+###########################################
+### Domain tree
+
+
+class DomainTree:
+    """
+    Domain geometry of a geogrid dict. Array attributes are indexed by
+    domain - 1: parent (0-based index of the parent), dx, dy (m), e_we,
+    e_sn, x0, y0 (projected lower-left corner, m) and depth (0 for d01).
+    """
+
+    def __init__(self, geogrid):
+        self.geogrid = geogrid
+        self.map_proj = geogrid['map_proj'].lower()
+
+        self.parent = np.asarray(utils.to_list(geogrid['parent_id']), dtype=int) - 1
+        self.ratio = np.asarray(utils.to_list(geogrid['parent_grid_ratio']), dtype=float)
+        self.i_parent_start = np.asarray(utils.to_list(geogrid['i_parent_start']), dtype=float)
+        self.j_parent_start = np.asarray(utils.to_list(geogrid['j_parent_start']), dtype=float)
+        self.e_we = np.asarray(utils.to_list(geogrid['e_we']), dtype=float)
+        self.e_sn = np.asarray(utils.to_list(geogrid['e_sn']), dtype=float)
+        self.n = len(self.parent)
+        self.parent[0] = 0
+
+        if self.map_proj != 'lat-lon':
+            self.geo_to_proj, self.proj_to_geo = utils.wrf_transformers(*self.projection())
+            x_ref, y_ref = self.geo_to_proj.transform(geogrid['ref_lon'], geogrid['ref_lat'])
+        else:
+            self.geo_to_proj = self.proj_to_geo = None
+            x_ref, y_ref = geogrid['ref_lon'], geogrid['ref_lat']
+
+        self.dx = np.zeros(self.n)
+        self.dy = np.zeros(self.n)
+        self.x0 = np.zeros(self.n)
+        self.y0 = np.zeros(self.n)
+        self.depth = np.zeros(self.n, dtype=int)
+
+        self.dx[0] = geogrid['dx']
+        self.dy[0] = geogrid['dy']
+        self.x0[0] = x_ref - (self.e_we[0] - 1) * 0.5 * self.dx[0]
+        self.y0[0] = y_ref - (self.e_sn[0] - 1) * 0.5 * self.dy[0]
+
+        # One generation of nests per pass: those whose parent is already placed
+        placed = np.zeros(self.n, dtype=bool)
+        placed[0] = True
+        while not placed.all():
+            ready = ~placed & placed[self.parent]
+            if not ready.any():
+                raise ValueError('parent_id must refer to an earlier domain.')
+            p = self.parent[ready]
+            self.x0[ready] = self.x0[p] + (self.i_parent_start[ready] - 1) * self.dx[p]
+            self.y0[ready] = self.y0[p] + (self.j_parent_start[ready] - 1) * self.dy[p]
+            self.dx[ready] = self.dx[p] / self.ratio[ready]
+            self.dy[ready] = self.dy[p] / self.ratio[ready]
+            self.depth[ready] = self.depth[p] + 1
+            placed |= ready
+
+    @classmethod
+    def from_namelist(cls, wps_nml):
+        return cls(wps_nml['geogrid'])
+
+    def projection(self):
+        """(map_proj, truelat1, truelat2, ref_lat, stand_lon) as utils.wrf_transformers takes them."""
+        geogrid = self.geogrid
+        truelat1 = geogrid.get('truelat1', geogrid['ref_lat'])
+        return (self.map_proj, truelat1, geogrid.get('truelat2', truelat1), geogrid['ref_lat'],
+                geogrid.get('stand_lon', geogrid['ref_lon']))
+
+    @property
+    def x_center(self):
+        return self.x0 + (self.e_we - 1) * 0.5 * self.dx
+
+    @property
+    def y_center(self):
+        return self.y0 + (self.e_sn - 1) * 0.5 * self.dy
+
+    def chain(self, domain):
+        """Domain numbers from d01 down to domain."""
+        chain = [domain - 1]
+        while chain[0] != 0:
+            chain.insert(0, int(self.parent[chain[0]]))
+        return [index + 1 for index in chain]
+
+    def _to_geo(self, x, y):
+        if self.proj_to_geo is None:
+            raise NotImplementedError(f'WRF proj not implemented yet: {self.map_proj}')
+        return self.proj_to_geo.transform(x, y)
+
+    def corners(self):
+        """(lon, lat) arrays of shape (n, 4): the SW, SE, NE and NW corners of every domain."""
+        x1 = self.x0 + (self.e_we - 1) * self.dx
+        y1 = self.y0 + (self.e_sn - 1) * self.dy
+        x = np.stack([self.x0, x1, x1, self.x0], axis=1)
+        y = np.stack([self.y0, self.y0, y1, y1], axis=1)
+        lon, lat = self._to_geo(x.ravel(), y.ravel())
+        return np.reshape(lon, (self.n, 4)), np.reshape(lat, (self.n, 4))
+
+    def boundary(self, n_points=25):
+        """(lon, lat) arrays of shape (n, 4 * n_points) along every domain's edges."""
+        t = np.linspace(0, 1, n_points)
+        w = ((self.e_we - 1) * self.dx)[:, None]
+        h = ((self.e_sn - 1) * self.dy)[:, None]
+        zeros = np.zeros((self.n, n_points))
+        ones = np.ones((self.n, n_points))
+        x = self.x0[:, None] + w * np.concatenate([t * ones, t * ones, zeros, ones], axis=1)
+        y = self.y0[:, None] + h * np.concatenate([zeros, ones, t * ones, t * ones], axis=1)
+        lon, lat = self._to_geo(x.ravel(), y.ravel())
+        return np.reshape(lon, x.shape), np.reshape(lat, y.shape)
+
+    def bounds(self, n_points=25):
+        """
+        (min_lon, min_lat, max_lon, max_lat) of every domain's boundary ring,
+        longitudes 0-360 with max_lon past 360 across the prime meridian.
+        """
+        lon, lat = self.boundary(n_points)
+        bounds = []
+        for ring_lon, ring_lat in zip(lon, lat):
+            start, end = utils.lon_arc(ring_lon)
+            bounds.append((start, float(ring_lat.min()), end, float(ring_lat.max())))
+        return bounds
+
+    def bbox(self, domain=1, pad=0.5, n_points=25):
+        """
+        Input download bbox of domain without geogrid (prefetch.py), rounded as
+        run_geogrid.domain_bbox rounds the geo_em ring. The ring here runs along
+        the staggered edges, so the box never falls inside the geo_em one.
+        """
+        lon, lat = self.boundary(n_points)
+        return utils.ring_bbox(lon[domain - 1], lat[domain - 1], pad)
+
+    def reanchored(self, domain):
+        """
+        Projection of a single-domain grid matching domain: reference point at
+        the domain centre, stand_lon rotated with it and true latitudes at the
+        new ref_lat, as ndown runs write them back.
+        """
+        geogrid = self.geogrid
+        ref_lat, ref_lon = geogrid['ref_lat'], geogrid['ref_lon']
+        stand_lon = geogrid.get('stand_lon', ref_lon)
+        if domain > 1:
+            lon_angle = stand_lon - ref_lon
+            ref_lon, ref_lat = self._to_geo(self.x_center[domain - 1], self.y_center[domain - 1])
+            stand_lon = ref_lon + lon_angle
+
+        return {
+            'dx': int(self.dx[domain - 1]),
+            'dy': int(self.dy[domain - 1]),
+            'ref_lat': round(ref_lat, 6),
+            'ref_lon': round(ref_lon, 6),
+            'truelat1': round(ref_lat, 6),
+            'truelat2': round(ref_lat, 6),
+            'stand_lon': round(stand_lon, 6),
+        }
+
+    def subset(self, domains, reanchor=False, geogrid=None):
+        """
+        The geogrid for running only domains (ascending, domains[0] the new
+        top domain), updated in place when geogrid is given. The nest fields
+        are renumbered and the top domain's dx/dy set; with reanchor the
+        projection is moved onto the new top domain too.
+        """
+        if geogrid is None:
+            geogrid = copy.deepcopy(self.geogrid)
+
+        new_top_domain = domains[0]
+        if new_top_domain > self.n:
+            raise ValueError('new_top_domain must be greater than max_domains')
+
+        if reanchor:
+            geogrid.update(self.reanchored(new_top_domain))
+        else:
+            geogrid['dx'] = int(self.dx[new_top_domain - 1])
+            geogrid['dy'] = int(self.dy[new_top_domain - 1])
+
+        parent_ids = utils.to_list(geogrid['parent_id'])
+        domain_index = [domain - 1 for domain in domains]
+        new_top_parent_id = new_top_domain - 1
+        geogrid['parent_id'] = [parent_ids[pid] - new_top_parent_id if parent_ids[pid] - new_top_parent_id > 1 else 1 for pid in domain_index]
+
+        for field in ('parent_grid_ratio', 'i_parent_start', 'j_parent_start'):
+            values = [utils.to_list(geogrid[field])[index] for index in domain_index]
+            values[0] = 1
+            geogrid[field] = values
+
+        for p, v in geogrid.items():
+            if isinstance(v, list):
+                if len(v) == self.n:
+                    geogrid[p] = [v[index] for index in domain_index]
+
+        return geogrid
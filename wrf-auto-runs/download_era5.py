@@ -7,12 +7,35 @@ Translates wrf-auto-runs' [remote.era5] config into era5_dl's [source] TOML,
 points [remote] at the local /data/era5 directory, and invokes era5_dl with
 the right preset, date range, bbox, and (when sst_source == 'cci') the
 --skip-vars SSTK,CI flag.
+
+era5_dl works at day granularity and on every pressure level, so the
+downloaded files are thinned to the exact valid times the run needs and
+the pressure levels up to just above p_top_requested before they are
+cached or converted.
+
+With [input.era5_local] path set, nothing is downloaded: the bbox, valid
+times and pressure levels the run needs are read straight from the files of
+an on-prem ERA5 mirror (same layout as the source bucket) and written as
+small subset files, so only the clipped data lands on scratch.
 """
+import concurrent.futures
+import contextlib
 import copy
-import shlex
+import datetime
+import os
+import pathlib
+import shutil
 import subprocess
 
+import h5netcdf
+import numpy as np
+import pendulum
+
+import cache
+import defaults
+import governor
 import params
+import utils
 
 
 def _format_toml_value(v):
@@ -35,18 +58,7 @@ def _write_era5_dl_toml(path, sections):
     path.write_text('\n'.join(lines))
 
 
-def dl_era5(start_date, end_date, min_lon, min_lat, max_lon, max_lat):
-    era5_out = params.data_path.joinpath('era5')
-    era5_out.mkdir(exist_ok=True)
-
-    source_cfg = copy.deepcopy(params.file['remote']['era5'])
-
-    cfg_path = params.data_path.joinpath('era5_dl.toml')
-    _write_era5_dl_toml(cfg_path, {
-        'source': source_cfg,
-        'remote': {'type': 'local', 'path': str(era5_out)},
-    })
-
+def _era5_dl_cmd(cfg_path, start_date, end_date, min_lon, min_lat, max_lon, max_lat):
     start_str = start_date.strftime('%Y-%m-%d')
     end_str = end_date.strftime('%Y-%m-%d')
 
@@ -59,15 +71,412 @@ def dl_era5(start_date, end_date, min_lon, min_lat, max_lon, max_lat):
         '--max-lon', f'{max_lon}',
         '--min-lat', f'{min_lat}',
         '--max-lat', f'{max_lat}',
-        '--no-check-target',
-        '-n', '4',
     ]
     if params.sst_source == 'cci':
         cmd_parts += ['--skip-vars', 'sstk,ci']
 
+    return cmd_parts
+
+
+def _run_era5_dl(cmd_parts):
     p = subprocess.run(cmd_parts, capture_output=True, text=True, check=False)
 
     if p.returncode != 0:
         raise RuntimeError(f'era5_dl failed ({p.returncode}):\nstdout:\n{p.stdout}\nstderr:\n{p.stderr}')
 
+    return p.stdout
+
+
+def _write_cfg(cfg_path, out_path):
+    source_cfg = copy.deepcopy(params.file['remote']['era5'])
+
+    _write_era5_dl_toml(cfg_path, {
+        'source': source_cfg,
+        'remote': {'type': 'local', 'path': str(out_path)},
+    })
+
+
+def _source_keys(cfg_path, start_date, end_date, bbox):
+    """List the source file keys (product/YYYYMM/file.nc) era5_dl would download."""
+    cmd_parts = _era5_dl_cmd(cfg_path, start_date, end_date, *bbox) + ['--list-only']
+    stdout = _run_era5_dl(cmd_parts)
+
+    return sorted({line.strip() for line in stdout.split('\n') if line.strip().endswith('.nc')})
+
+
+def _key_dates(key):
+    """(start, end) dates encoded in an ERA5 file name (...YYYYMMDDHH_YYYYMMDDHH.nc)."""
+    dates_str = key.split('.')[-2].split('_')
+    start = pendulum.from_format(dates_str[0], 'YYYYMMDDHH').date()
+    end = pendulum.from_format(dates_str[1], 'YYYYMMDDHH').date()
+    return start, end
+
+
+def _time_strs(times):
+    return sorted({t.strftime('%Y%m%d%H') for t in times})
+
+
+def _key_hours(key, times):
+    """The valid times (YYYYMMDDHH) of times inside the source file key, or None for invariant files."""
+    if 'invariant' in key:
+        return None
+    start, end = _key_dates(key)
+    return _time_strs(t for t in times if start <= t.date() <= end)
+
+
+def _file_times(nc):
+    """YYYYMMDDHH strings of the CF time coordinate of an open file."""
+    time_var = nc['time']
+    unit, _, ref = time_var.attrs['units'].partition(' since ')
+    ref = datetime.datetime.fromisoformat(ref.strip())
+    seconds = {'days': 86400, 'hours': 3600, 'minutes': 60, 'seconds': 1}[unit.strip()]
+    return [(ref + datetime.timedelta(seconds=float(v) * seconds)).strftime('%Y%m%d%H') for v in np.asarray(time_var[:])]
+
+
+def level_min():
+    """
+    Lowest pressure level (hPa) the run needs: the first ERA5 level above
+    [domains] p_top_requested plus [input.era5] level_margin levels, or None
+    when [input.era5] prune_levels is false.
+    """
+    input_cfg = params.file.get('input', {}).get('era5', {})
+    if not input_cfg.get('prune_levels', True):
+        return None
+
+    p_top = params.file.get('domains', {}).get('p_top_requested', defaults.WRF_DOMAINS_DEFAULTS['p_top_requested'])
+    levels = defaults.ERA5_PRESSURE_LEVELS
+    above = [i for i, lev in enumerate(levels) if lev * 100 < p_top]
+    if not above:
+        return None
+
+    return levels[min(above[0] + input_cfg.get('level_margin', 1), len(levels) - 1)]
+
+
+def _axis_slice(idx):
+    """idx as a slice when evenly spaced (one hyperslab read), else None."""
+    if len(idx) == 1:
+        return slice(idx[0], idx[0] + 1)
+    step = idx[1] - idx[0]
+    if step > 0 and all(b - a == step for a, b in zip(idx, idx[1:])):
+        return slice(idx[0], idx[-1] + 1, step)
+    return None
+
+
+def _read_subset(var, keep):
+    """The kept indices of var, reading only their bounding slabs."""
+    sel = []
+    takes = []
+    for axis, dim in enumerate(var.dimensions):
+        idx = keep.get(dim)
+        if idx is None:
+            sel.append(slice(None))
+            continue
+        axis_slice = _axis_slice(idx)
+        if axis_slice is None:
+            sel.append(slice(idx[0], idx[-1] + 1))
+            takes.append((axis, [i - idx[0] for i in idx]))
+        else:
+            sel.append(axis_slice)
+
+    data = var[tuple(sel)]
+    for axis, idx in takes:
+        data = np.take(data, idx, axis=axis)
+    return data
+
+
+def _bbox_indices(src, bbox):
+    """
+    {dim: indices} of the latitude/longitude rows covering bbox, with one
+    cell of margin. A box across the prime meridian (max_lon past 360), or
+    one the file's longitudes cannot give as a single run, keeps every
+    longitude, as era5_dl does.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    lat = np.asarray(src['latitude'][:])
+    rows = np.flatnonzero((lat >= min_lat) & (lat <= max_lat))
+    if rows.size == 0:
+        raise ValueError(f'The ERA5 file does not overlap latitudes {min_lat} to {max_lat}.')
+    keep = {'latitude': list(range(max(rows[0] - 1, 0), min(rows[-1] + 2, lat.size)))}
+
+    if max_lon <= 360 and 'longitude' in src.variables:
+        lon = np.asarray(src['longitude'][:]) % 360
+        cols = np.flatnonzero((lon >= min_lon) & (lon <= max_lon))
+        if cols.size and cols[-1] - cols[0] + 1 == cols.size:
+            keep['longitude'] = list(range(max(cols[0] - 1, 0), min(cols[-1] + 2, lon.size)))
+
+    return keep
+
+
+def subset_file(src_path, dst_path, hours=None, min_level=None, bbox=None):
+    """
+    Write the valid times in hours (YYYYMMDDHH strings), the pressure levels
+    of at least min_level hPa and the grid cells covering bbox (0-360) of
+    src_path to dst_path, with the same compression. None keeps every
+    time/level/cell. Only the kept slabs are read. Returns False, writing
+    nothing, when nothing would be cut.
+    """
+    with h5netcdf.File(src_path, 'r') as src:
+        keep = {}
+        if hours is not None and 'time' in src.variables:
+            keep['time'] = [i for i, t in enumerate(_file_times(src)) if t in set(hours)]
+        if min_level is not None and 'level' in src.variables:
+            keep['level'] = [i for i, lev in enumerate(np.asarray(src['level'][:])) if lev >= min_level]
+        if bbox is not None and 'latitude' in src.variables:
+            keep.update(_bbox_indices(src, bbox))
+        keep = {d: idx for d, idx in keep.items() if idx and len(idx) < src.dimensions[d].size}
+        if not keep:
+            return False
+
+        with h5netcdf.File(dst_path, 'w') as dst:
+            dst.dimensions = {d: len(keep[d]) if d in keep else dim.size for d, dim in src.dimensions.items()}
+            dst.attrs.update(src.attrs)
+            for name, var in src.variables.items():
+                data = _read_subset(var, keep)
+                kwargs = {}
+                if '_FillValue' in var.attrs:
+                    kwargs['fillvalue'] = var.attrs['_FillValue']
+                if var.compression is not None:
+                    chunks = tuple(min(c, n) for c, n in zip(var.chunks, data.shape)) if var.chunks else None
+                    kwargs.update(compression=var.compression, compression_opts=var.compression_opts,
+                                  shuffle=var.shuffle, chunks=chunks)
+                out = dst.create_variable(name, var.dimensions, dtype=var.dtype, data=data, **kwargs)
+                out.attrs.update({k: v for k, v in var.attrs.items() if k != '_FillValue'})
+
+    return True
+
+
+def thin_file(nc_path, hours=None, min_level=None):
+    """
+    Keep only the valid times in hours (YYYYMMDDHH strings) and the pressure
+    levels of at least min_level hPa in nc_path, rewriting it in place with
+    the same compression. None keeps every time/level. Returns whether the
+    file was rewritten.
+    """
+    tmp = nc_path.with_name(nc_path.name + '.thin')
+    if not subset_file(nc_path, tmp, hours, min_level):
+        return False
+
+    os.replace(tmp, nc_path)
+
+    return True
+
+
+def _cache_prefix(key):
+    group = cache.hash_key('era5', key)
+    return f'{group[:2]}/{group}'
+
+
+def _covers(meta, bbox, hours, min_level):
+    """
+    Whether a cache entry covers bbox, the valid times hours and the levels
+    down to min_level (None: every time/level).
+    """
+    if not cache.bbox_contains(meta['bbox'], bbox):
+        return False
+    if meta.get('hours') is not None and (hours is None or not set(hours) <= set(meta['hours'])):
+        return False
+    if meta.get('level_min') is not None and (min_level is None or min_level < meta['level_min']):
+        return False
+    return True
+
+
+def _link_cached(era5_cache, keys, bbox, era5_out, times):
+    """
+    Link every cached key whose entry covers our bbox, valid times and
+    levels into era5_out. Returns the missing keys.
+    """
+    min_level = level_min()
+    missing = []
+    for key in keys:
+        hours = _key_hours(key, times)
+        entry = era5_cache.find(_cache_prefix(key), lambda meta: _covers(meta, bbox, hours, min_level))
+        if entry is None:
+            missing.append(key)
+        else:
+            era5_cache.materialize(entry, era5_out)
+
+    return missing
+
+
+def _dl_era5_cached(era5_cache, start_date, end_date, bbox, era5_out, times, n_workers=4):
+    """
+    Fill era5_out from the shared ERA5 cache, downloading only the source files
+    no cache entry covers. Each source file is one cache entry keyed by its
+    source key, the clip bbox and the valid times kept; any entry with a
+    superset bbox holding every valid time we need is a hit.
+    """
+    cfg_path = params.data_path.joinpath('era5_dl.toml')
+    _write_cfg(cfg_path, era5_out)
+
+    keys = _source_keys(cfg_path, start_date, end_date, bbox)
+    if not keys:
+        raise ValueError(f'era5_dl found no source files between {start_date} and {end_date}.')
+
+    missing = _link_cached(era5_cache, keys, bbox, era5_out, times)
+    print(f'-- ERA5 cache: {len(keys) - len(missing)} of {len(keys)} files cached')
+
+    if missing:
+        with contextlib.ExitStack() as stack:
+            # Sorted so concurrent tasks always take overlapping locks in the same order
+            for key in missing:
+                stack.enter_context(era5_cache.lock(_cache_prefix(key)))
+
+            # Another task may have published some keys while we waited
+            missing = _link_cached(era5_cache, missing, bbox, era5_out, times)
+
+            if missing:
+                staging = params.data_path.joinpath('era5_staging')
+                staging.mkdir(exist_ok=True)
+                staging_cfg = params.data_path.joinpath('era5_dl_staging.toml')
+                _write_cfg(staging_cfg, staging)
+
+                # Narrow the download to the date span of the missing files
+                dated = [_key_dates(key) for key in missing if 'invariant' not in key]
+                dl_start = dl_end = start_date.date()
+                if dated:
+                    dl_start = max(start_date.date(), min(d[0] for d in dated))
+                    dl_end = min(end_date.date(), max(d[1] for d in dated))
+
+                with governor.slots('era5').acquire(n_workers) as n:
+                    _run_era5_dl(_era5_dl_cmd(staging_cfg, dl_start, dl_end, *bbox) + ['--no-check-target', '-n', str(n)])
+
+                for key in missing:
+                    file_path = staging.joinpath(key)
+                    if not file_path.exists():
+                        raise RuntimeError(f'era5_dl did not produce {key}')
+                    hours = _key_hours(key, times)
+                    min_level = level_min() if '.pl.' in key else None
+                    if not thin_file(file_path, hours, min_level):
+                        hours = min_level = None
+                    group = _cache_prefix(key)
+                    entry = era5_cache.publish(
+                        f'{group}/{cache.hash_key(bbox, hours, min_level)[:16]}',
+                        {key: file_path},
+                        {'source_key': key, 'bbox': list(bbox), 'hours': hours, 'level_min': min_level},
+                    )
+                    era5_cache.materialize(entry, era5_out)
+
+                shutil.rmtree(staging)
+
+    era5_cache.evict()
+
+
+def era5_archive():
+    """Path of the [input.era5_local] ERA5 archive, or None when ERA5 is downloaded with era5_dl."""
+    path = params.file.get('input', {}).get('era5_local', {}).get('path')
+    return pathlib.Path(path) if path else None
+
+
+def _archive_files(archive, start_date, end_date):
+    """
+    {source key: archive path} of the archive files covering start_date to
+    end_date. Raises ValueError naming the file codes with days missing.
+    """
+    days = [d.date() for d in pendulum.interval(pendulum.instance(start_date).start_of('day'),
+                                                 pendulum.instance(end_date).start_of('day')).range('days')]
+    months = sorted({d.strftime('%Y%m') for d in days})
+
+    files = {}
+    problems = []
+    for product, codes in defaults.ERA5_FILE_CODES.items():
+        if params.sst_source == 'cci':
+            codes = [c for c in codes if c not in defaults.ERA5_CCI_SKIP_CODES]
+        product_months = [defaults.ERA5_INVARIANT_MONTH] if 'invariant' in product else months
+
+        for code in codes:
+            covered = set()
+            for month in product_months:
+                for src in sorted(archive.joinpath(product, month).glob(f'{product}.{code}.*.nc')):
+                    key = f'{product}/{month}/{src.name}'
+                    if 'invariant' not in product:
+                        start, end = _key_dates(key)
+                        if end < days[0] or start > days[-1]:
+                            continue
+                        covered.update(d for d in days if start <= d <= end)
+                    else:
+                        covered.update(days)
+                    files[key] = src
+
+            missing = [d for d in days if d not in covered]
+            if missing:
+                problems.append(f'{product} {code}: {len(missing)} day(s) from {missing[0]}')
+
+    if problems:
+        raise ValueError(f'The ERA5 archive at {archive} is missing files:\n  ' + '\n  '.join(problems))
+
+    return files
+
+
+def subset_era5_archive(start_date, end_date, min_lon, min_lat, max_lon, max_lat, hour_interval=None):
+    """
+    Write the bbox, the valid times stepping hour_interval from start_date
+    and the pressure levels down to level_min() of the [input.era5_local]
+    archive files covering start_date to end_date into data_path/era5, in
+    the era5_dl source layout. Only those slabs are read from the archive;
+    a file with nothing to cut is symlinked. [input.era5_local] workers
+    files are read at once (default 4).
+    """
+    archive = era5_archive()
+    workers = params.file['input']['era5_local'].get('workers', 4)
+    era5_out = params.data_path.joinpath('era5')
+    era5_out.mkdir(exist_ok=True)
+
+    files = _archive_files(archive, start_date, end_date)
+    times = list(utils.wps_timestamps(start_date, end_date, hour_interval or 1))
+    bbox = (min_lon, min_lat, max_lon, max_lat)
+    min_level = level_min()
+
+    def subset(key):
+        src = files[key]
+        dst = era5_out.joinpath(key)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if dst.is_symlink() or dst.exists():
+            dst.unlink()
+        part = dst.with_name(dst.name + '.part')
+        if subset_file(src, part, _key_hours(key, times), min_level if '.pl.' in key else None, bbox):
+            os.replace(part, dst)
+        else:
+            dst.symlink_to(src)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(subset, sorted(files)))
+
+    return True
+
+
+def dl_era5(start_date, end_date, min_lon, min_lat, max_lon, max_lat, hour_interval=None, n_workers=4):
+    """
+    Download the ERA5 files covering start_date to end_date into data_path/era5.
+    With hour_interval, the files are thinned to the valid times stepping
+    hour_interval from start_date. n_workers is era5_dl's parallel download count,
+    reduced to the 'era5' transfer slots held under [storage] max_transfers.
+    """
+    era5_out = params.data_path.joinpath('era5')
+    era5_out.mkdir(exist_ok=True)
+
+    # era5_dl clips one 0-360 box, so a domain across the prime meridian takes the full ring
+    if max_lon > 360:
+        min_lon, max_lon = 0, 360
+
+    bbox = (min_lon, min_lat, max_lon, max_lat)
+    if hour_interval is None:
+        hour_interval = 1
+    times = list(utils.wps_timestamps(start_date, end_date, hour_interval))
+
+    era5_cache = cache.get_cache('era5')
+    if era5_cache is not None:
+        _dl_era5_cached(era5_cache, start_date, end_date, bbox, era5_out, times, n_workers)
+        return True
+
+    cfg_path = params.data_path.joinpath('era5_dl.toml')
+    _write_cfg(cfg_path, era5_out)
+
+    with governor.slots('era5').acquire(n_workers) as n:
+        _run_era5_dl(_era5_dl_cmd(cfg_path, start_date, end_date, *bbox) + ['--no-check-target', '-n', str(n)])
+
+    hours = _time_strs(times)
+    for nc_path in era5_out.rglob('*.nc'):
+        if 'invariant' not in nc_path.name:
+            thin_file(nc_path, hours, level_min() if '.pl.' in nc_path.name else None)
+
     return True
@@ -5,13 +5,10 @@ Created on Sun Mar 22 2026
 
 @author: mike
 """
-import pathlib
-import shlex
-import subprocess
 import pendulum
 import copy
 
-import params, utils
+import params, storage
 
 ############################################
 ### Parameters
@@ -22,51 +19,44 @@ import params, utils
 ### Functions
 
 
-def dl_wrf(start_date, end_date):
+def wrf_input_files(start_date, end_date):
     """
-    Download wrfout files from remote storage for use as WRF boundary conditions.
+    The [remote.wrf] storage, domain and {day: wrfout file name} for every day
+    from start_date to end_date. Raises ValueError if any file is missing on
+    the remote.
     """
     remote = copy.deepcopy(params.file['remote']['wrf'])
 
-    wrf_path = pathlib.Path(remote.pop('path'))
     domain = remote.pop('domain')
 
-    name = 'wrf'
-
-    config_path = utils.create_rclone_config(name, params.data_path, remote)
+    store = storage.get_storage('wrf', remote)
 
     start_date1 = pendulum.instance(start_date).start_of('day')
     end_date1 = pendulum.instance(end_date).start_of('day')
 
-    include_from = ''
-
     days = pendulum.interval(start_date1, end_date1).range('days')
 
-    day_count = 0
-    for day in days:
-        datetime_str = day.strftime(params.wps_date_format)
-        include_from += f'wrfout_{domain}_{datetime_str}.nc\n'
-        day_count += 1
+    file_names = {day.date(): f'wrfout_{domain}_{day.strftime(params.wps_date_format)}.nc' for day in days}
 
     ## Check that all required files exist on remote
-    src_str = f'{name}:{wrf_path}/'
+    available = set(store.list())
+    missing = [f for f in file_names.values() if f not in available]
+
+    if missing:
+        missing_str = '\n'.join(missing)
+        raise ValueError(f"Expected {len(file_names)} wrfout files on remote but {len(missing)} are missing:\n{missing_str}")
 
-    cmd_str = f'rclone lsf {src_str} --config={config_path} --max-depth 1 --files-only --include-from -'
-    cmd_list = shlex.split(cmd_str)
-    p = subprocess.run(cmd_list, input=include_from, capture_output=True, text=True, check=False)
+    return store, domain, file_names
 
-    file_list = p.stdout.split('\n')[:-1]
 
-    if len(file_list) != day_count:
-        file_list_str = '\n'.join(file_list)
-        raise ValueError(f"Expected {day_count} wrfout files on remote but found {len(file_list)}:\n{file_list_str}")
+def dl_wrf(start_date, end_date):
+    """
+    Download wrfout files from remote storage for use as WRF boundary conditions.
+    """
+    store, _, file_names = wrf_input_files(start_date, end_date)
 
     ## Download
-    cmd_str = f'rclone copy {src_str} {params.data_path}/wrfout --transfers=4 --config={config_path} --include-from -'
-    cmd_list = shlex.split(cmd_str)
-    p = subprocess.run(cmd_list, input=include_from, capture_output=True, text=True, check=False)
-
-    if p.stderr != '':
-        raise ValueError(p.stderr)
-    else:
-        return True
+    failed = store.download(list(file_names.values()), params.data_path.joinpath('wrfout'))
+    storage.check_failures(failed, 'download wrfout')
+
+    return True
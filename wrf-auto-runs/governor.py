@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cluster-wide cap on concurrent transfers per remote.
+
+Every task sharing the slot directory ([storage] slots_path, else
+{cache path}/.io_slots) competes for the same lock files: remote name has
+slots slot_000.lock .. slot_{N-1}.lock, where N comes from [storage]
+max_transfers (an int for every remote, or a {name: int} table). A transfer
+holds a POSIX lock on one or more slot files, the same lockf locking the
+cache uses, so the locks work over NFS and are released if the task dies.
+Without max_transfers or a shared directory there is no cap.
+"""
+import contextlib
+import fcntl
+import os
+import pathlib
+import random
+import threading
+import time
+
+import params
+
+############################################
+### Parameters
+
+POLL_SECONDS = 2.0
+
+_slots = {}
+
+###########################################
+### Slots
+
+
+class TransferSlots:
+    """limit lock-file slots for the remote name under path."""
+
+    def __init__(self, path, name, limit, poll=POLL_SECONDS):
+        self.dir = pathlib.Path(path).joinpath(name)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.name = name
+        self.limit = limit
+        self.poll = poll
+        # lockf locks belong to the process, so threads of one task must not share a slot
+        self._held = set()
+        self._guard = threading.Lock()
+
+    def _try_lock(self, slot):
+        f = open(self.dir.joinpath(f'slot_{slot:03d}.lock'), 'a')
+        try:
+            fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return None
+        return f
+
+    def _grab(self, n):
+        """Lock up to n free slots without blocking. Returns {slot: file}."""
+        got = {}
+        with self._guard:
+            for slot in random.sample(range(self.limit), self.limit):
+                if len(got) >= n:
+                    break
+                if slot in self._held:
+                    continue
+                f = self._try_lock(slot)
+                if f is not None:
+                    got[slot] = f
+                    self._held.add(slot)
+        return got
+
+    def _release(self, got):
+        with self._guard:
+            for slot, f in got.items():
+                fcntl.lockf(f, fcntl.LOCK_UN)
+                f.close()
+                self._held.discard(slot)
+
+    @contextlib.contextmanager
+    def acquire(self, n=1):
+        """
+        Hold between 1 and n slots, waiting until at least one is free.
+        Yields the number held, which the caller uses as its parallelism.
+        """
+        n = max(1, min(n, self.limit))
+        got = self._grab(n)
+        waited = False
+        while not got:
+            if not waited:
+                print(f'-- Waiting for a free {self.name} transfer slot ({self.limit} in use across tasks)')
+                waited = True
+            time.sleep(self.poll * random.uniform(0.5, 1.5))
+            got = self._grab(n)
+        try:
+            yield len(got)
+        finally:
+            self._release(got)
+
+
+class _Unlimited:
+    @contextlib.contextmanager
+    def acquire(self, n=1):
+        yield max(1, n)
+
+
+###########################################
+### Functions
+
+
+def _limit(name):
+    limit = params.file.get('storage', {}).get('max_transfers')
+    if isinstance(limit, dict):
+        limit = limit.get(name)
+    return int(limit) if limit else None
+
+
+def _slots_path():
+    path = params.file.get('storage', {}).get('slots_path')
+    if path:
+        return pathlib.Path(path)
+    if params.cache_path is not None:
+        return params.cache_path.joinpath('.io_slots')
+    return None
+
+
+def slots(name):
+    """The (memoized) transfer slots of remote name; a no-op when no cap applies."""
+    limit = _limit(name)
+    path = _slots_path()
+    memo_key = (name, limit, str(path), os.getpid())
+    if memo_key not in _slots:
+        if limit is None or path is None:
+            _slots[memo_key] = _Unlimited()
+        else:
+            _slots[memo_key] = TransferSlots(path, name, limit)
+    return _slots[memo_key]
@@ -12,12 +12,11 @@ import pendulum
 import sentry_sdk
 
 # from download_nml_domain import dl_nml_domain
-from set_params import check_nml_params, set_nml_params, set_ndown_params, update_metgrid_levels
-from download_era5 import dl_era5
-from run_era5_to_int import run_era5_to_int
+from set_params import check_nml_params, set_geogrid_nml_params, set_nml_params, set_ndown_params, update_metgrid_levels
+from download_era5 import dl_era5, era5_archive, subset_era5_archive
+from run_era5_to_int import run_era5_to_int, missing_era5_int
 from process_sst_cci import process_sst_cci
-from download_wrf import dl_wrf
-from run_wrf_to_int import run_wrf_to_int
+from run_wrf_to_int import stream_wrf_to_int
 from run_metgrid import run_metgrid
 from run_real import run_real
 from monitor_wrf import monitor_wrf
@@ -27,6 +26,7 @@ from run_geogrid import run_geogrid
 from run_ndown import run_ndown
 from download_ndown_input import dl_ndown_input
 from create_trmask import create_trmask
+from preflight import run_preflight
 
 import params
 import utils
@@ -87,10 +87,10 @@ if domains_init is None:
 
 print(f'-- domains: {domains}')
 
-if domains_init[0] == 1 and all([domain - i == 1 for i, domain in enumerate(domains_init)]):
-    _ = set_nml_params(domains_init)
-else:
-    _ = set_nml_params()
+start_date, end_date, _, _ = set_geogrid_nml_params(domains_init)
+
+print('-- Pre-flight check of input availability...')
+run_preflight(start_date, end_date, domains_init[0] if ndown_check else None)
 
 print('-- Run geogrid.exe...')
 min_lon, min_lat, max_lon, max_lat = run_geogrid(src_n_domains, domains_init)
@@ -114,23 +114,29 @@ if ndown_check:
     dl_ndown_input(domains_init[0], start_date, end_date)
 
 if params.is_wrf_input:
-    print('-- Downloading WRF data...')
-    dl_wrf(start_date, end_date)
+    print('-- Downloading WRF data and processing to WPS Int day by day...')
+    stream_wrf_to_int(start_date, end_date, hour_interval, (min_lon, min_lat, max_lon, max_lat))
+else:
+    bbox = (min_lon, min_lat, max_lon, max_lat)
+    missing_int = missing_era5_int(start_date, end_date, hour_interval, bbox)
 
-    print('-- Checking input data coverage...')
-    utils.check_input_extent('wrf', min_lon, min_lat, max_lon, max_lat)
+    if missing_int and era5_archive() is not None:
+        print('-- Reading ERA5 data from the local archive...')
+        subset_era5_archive(missing_int[0], missing_int[-1], min_lon, min_lat, max_lon, max_lat, hour_interval)
 
-    print('-- Processing WRF to WPS Int...')
-    run_wrf_to_int(start_date, end_date, hour_interval)
-else:
-    print('-- Downloading ERA5 data...')
-    dl_era5(start_date, end_date, min_lon, min_lat, max_lon, max_lat)
+        print('-- Checking input data coverage...')
+        utils.check_input_extent('era5', min_lon, min_lat, max_lon, max_lat)
+    elif missing_int:
+        print('-- Downloading ERA5 data...')
+        dl_era5(missing_int[0], missing_int[-1], min_lon, min_lat, max_lon, max_lat, hour_interval)
 
-    print('-- Checking input data coverage...')
-    utils.check_input_extent('era5', min_lon, min_lat, max_lon, max_lat)
+        print('-- Checking input data coverage...')
+        utils.check_input_extent('era5', min_lon, min_lat, max_lon, max_lat)
+    else:
+        print('-- All ERA5 intermediate files are cached, skipping the download...')
 
     print('-- Processing ERA5 to WPS Int...')
-    run_era5_to_int(start_date, end_date, hour_interval)
+    run_era5_to_int(start_date, end_date, hour_interval, bbox)
 
     if params.sst_source == 'cci':
         print('-- Processing CCI SST to WPS Int...')
@@ -114,7 +114,7 @@ if params.is_wrf_input:
     utils.check_input_extent('wrf', min_lon, min_lat, max_lon, max_lat)
 
     print('-- Processing WRF to WPS Int...')
-    run_wrf_to_int(start_date, end_date, hour_interval, False)
+    run_wrf_to_int(start_date, end_date, hour_interval, del_old=False)
 else:
     print('-- Downloading ERA5 data...')
     dl_era5(start_date, end_date)
@@ -123,7 +123,7 @@ else:
     utils.check_input_extent('era5', min_lon, min_lat, max_lon, max_lat)
 
     print('-- Processing ERA5 to WPS Int...')
-    run_era5_to_int(start_date, end_date, hour_interval, False)
+    run_era5_to_int(start_date, end_date, hour_interval, del_old=False)
 
 print('-- Running metgrid.exe...')
 run_metgrid(False)
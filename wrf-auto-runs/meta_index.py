@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Header index of the ERA5, wrfout and met_em files in a directory.
+
+scan_dir reads the header of every matching file once, in parallel, into a
+JSON sidecar (.meta_index.json) next to them. An entry is reused while the
+file's size and mtime are unchanged, and entries of removed files are
+dropped. Each entry holds:
+
+- extent: [min_lon, min_lat, max_lon, max_lat], longitudes 0-360
+- times: valid times (params.wps_date_format)
+- levels: the vertical dimension sizes (bottom_top, level, soil levels)
+- variables: the data variable names
+- p_top: P_TOP in Pa (wrfout only)
+
+The input checks (utils.check_input_extent, the wrf_to_int pressure levels
+and set_params.update_metgrid_levels) query the index, so every file is
+checked rather than only the first.
+"""
+import concurrent.futures
+import datetime
+import json
+import os
+import pathlib
+
+import h5netcdf
+import numpy as np
+
+import params
+
+############################################
+### Parameters
+
+INDEX_NAME = '.meta_index.json'
+
+LEVEL_DIMS = ('bottom_top', 'level', 'pressure_level', 'num_metgrid_levels', 'soil_layers_stag')
+
+###########################################
+### Readers
+
+
+def _cf_times(time_var):
+    unit, _, ref = time_var.attrs['units'].partition(' since ')
+    ref = datetime.datetime.fromisoformat(ref.strip())
+    seconds = {'days': 86400, 'hours': 3600, 'minutes': 60, 'seconds': 1}[unit.strip()]
+    return [(ref + datetime.timedelta(seconds=float(v) * seconds)).strftime(params.wps_date_format)
+            for v in np.asarray(time_var[:])]
+
+
+def _wrf_times(times_var):
+    return [b''.join(row).decode() for row in np.asarray(times_var[:])]
+
+
+def _extent(lat, lon):
+    lon = np.where(lon < 0, lon + 360, lon)
+    return [float(lon.min()), float(lat.min()), float(lon.max()), float(lat.max())]
+
+
+def read_meta(path):
+    """Header metadata of one ERA5, wrfout or met_em NetCDF file."""
+    with h5netcdf.File(str(path), 'r') as nc:
+        names = set(nc.variables)
+        meta = {
+            'variables': sorted(names - set(nc.dimensions)),
+            'levels': {dim: nc.dimensions[dim].size for dim in LEVEL_DIMS if dim in nc.dimensions},
+            'extent': None,
+            'times': [],
+        }
+
+        if 'latitude' in names and 'longitude' in names:
+            meta['extent'] = _extent(np.asarray(nc['latitude'][:]), np.asarray(nc['longitude'][:]))
+            time_name = 'valid_time' if 'valid_time' in names else 'time'
+            if time_name in names:
+                meta['times'] = _cf_times(nc[time_name])
+        else:
+            for lat_name, lon_name in (('XLAT', 'XLONG'), ('XLAT_M', 'XLONG_M')):
+                if lat_name in names:
+                    meta['extent'] = _extent(np.asarray(nc[lat_name][0]), np.asarray(nc[lon_name][0]))
+                    break
+            if 'Times' in names:
+                meta['times'] = _wrf_times(nc['Times'])
+
+        if 'P_TOP' in names:
+            meta['p_top'] = float(np.asarray(nc['P_TOP'][0]))
+        if 'NUM_METGRID_SOIL_LEVELS' in nc.attrs:
+            meta['levels']['num_metgrid_levels'] = int(nc.attrs['BOTTOM-TOP_GRID_DIMENSION'])
+            meta['levels']['num_metgrid_soil_levels'] = int(nc.attrs['NUM_METGRID_SOIL_LEVELS'])
+
+    return meta
+
+
+###########################################
+### Index
+
+
+def _stamp(stat):
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def scan_dir(directory, pattern, workers=8):
+    """
+    {path relative to directory: metadata} of every file matching pattern
+    (a pathlib glob, '**/' to recurse), reading only the headers of files
+    that are new or changed since the sidecar index was written.
+    """
+    directory = pathlib.Path(directory)
+    index_path = directory.joinpath(INDEX_NAME)
+    try:
+        index = json.loads(index_path.read_text())
+    except (OSError, ValueError):
+        index = {}
+
+    files = {str(path.relative_to(directory)): path for path in sorted(directory.glob(pattern)) if path.is_file()}
+    stamps = {name: _stamp(path.stat()) for name, path in files.items()}
+    stale = [name for name in files if index.get(name, {}).get('stamp') != stamps[name]]
+
+    if stale:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for name, meta in zip(stale, pool.map(lambda name: read_meta(files[name]), stale)):
+                meta['stamp'] = stamps[name]
+                index[name] = meta
+
+    # Entries of other patterns are kept; only those of removed files are dropped
+    gone = [name for name in index if name not in files and not directory.joinpath(name).exists()]
+    for name in gone:
+        del index[name]
+
+    if stale or gone:
+        tmp = index_path.with_name(f'{INDEX_NAME}.{os.getpid()}.part')
+        tmp.write_text(json.dumps(index))
+        os.replace(tmp, index_path)
+
+    return {name: index[name] for name in files}
+
+
+def extent_gaps(extent, bbox, buffer=0.5, lon_ranges=None):
+    """Descriptions of where extent falls short of bbox (see utils.check_input_extent)."""
+    input_lon_min, input_lat_min, input_lon_max, input_lat_max = extent
+    min_lon, min_lat, max_lon, max_lat = bbox
+    gaps = []
+    if input_lat_min > min_lat + buffer:
+        gaps.append(f'lat south of {input_lat_min:.1f} (domain needs {min_lat:.1f})')
+    if input_lat_max < max_lat - buffer:
+        gaps.append(f'lat north of {input_lat_max:.1f} (domain needs {max_lat:.1f})')
+    for lo, hi in lon_ranges or [(min_lon, max_lon)]:
+        if input_lon_min > lo + buffer:
+            gaps.append(f'lon west of {input_lon_min:.1f} (domain needs {lo:.1f})')
+        if input_lon_max < hi - buffer:
+            gaps.append(f'lon east of {input_lon_max:.1f} (domain needs {hi:.1f})')
+
+    return gaps
+
+
+def uniform(metas, field, what):
+    """The single value of field shared by every entry of metas, else a ValueError naming the odd files."""
+    values = {}
+    for name, meta in metas.items():
+        values.setdefault(json.dumps(meta.get(field), sort_keys=True), []).append(name)
+    if len(values) > 1:
+        details = '\n  '.join(f'{value}: {", ".join(names[:3])}{" ..." if len(names) > 3 else ""}'
+                              for value, names in values.items())
+        raise ValueError(f'The {what} files disagree on {field}:\n  {details}')
+
+    return next(iter(metas.values())).get(field)
+
+
+def missing_times(metas, timestamps):
+    """The timestamps (datetimes) that none of metas holds, as params.wps_date_format strings."""
+    held = {t for meta in metas.values() for t in meta['times']}
+    return sorted(ts.strftime(params.wps_date_format) for ts in timestamps
+                  if ts.strftime(params.wps_date_format) not in held)
@@ -6,11 +6,9 @@ Created on Mon Oct  6 15:41:48 2025
 @author: mike
 """
 import os
-import pathlib
 import resource
 import shlex
 import subprocess
-import copy
 import sentry_sdk
 from time import sleep
 
@@ -35,18 +33,7 @@ def monitor_wrf(outputs, end_date, run_uuid, rename_dict):
     """
 
     """
-    if params.is_remote_output:
-        remote = copy.deepcopy(params.file['remote']['output'])
-
-        name = 'output'
-
-        if 'path' in remote:
-            out_path = pathlib.Path(remote.pop('path'))
-        else:
-            out_path = None
-    else:
-        out_path = None
-        name = None
+    store = utils.output_storage()
 
     # output_globs = [out_files_glob[op] for op in outputs]
 
@@ -65,12 +52,12 @@ def monitor_wrf(outputs, end_date, run_uuid, rename_dict):
 
         files = utils.select_files_to_ul(files, 1)
 
-        if files and out_path is not None:
+        if files and store is not None:
             if params.output_variables:
                 print('- wrfout variables will be filtered based on the output_variables.')
                 utils.filter_variables(files, params.output_variables)
             files = utils.rename_files(files, rename_dict)
-            utils.ul_output_files(files, run_path, name, out_path, params.config_path)
+            utils.ul_output_files(files, store)
 
         sleep(60)
         check = p.poll()
@@ -88,12 +75,12 @@ def monitor_wrf(outputs, end_date, run_uuid, rename_dict):
 
         files = utils.select_files_to_ul(files, 0)
 
-        if files and out_path is not None:
+        if files and store is not None:
             if params.output_variables:
                 print('- wrfout variables will be filtered based on the output_variables.')
                 utils.filter_variables(files, params.output_variables)
             files = utils.rename_files(files, rename_dict)
-            utils.ul_output_files(files, run_path, name, out_path, params.config_path)
+            utils.ul_output_files(files, store)
 
         return True
     else:
@@ -104,12 +91,9 @@ def monitor_wrf(outputs, end_date, run_uuid, rename_dict):
             results_str = pe.stdout
         # scope = sentry_sdk.get_current_scope()
         # scope.add_attachment(path=wrf_log_path)
-        if out_path is not None:
+        if store is not None:
             print(f'-- Uploading WRF log files for run uuid: {run_uuid}')
-            dest_str = f'{name}:{out_path}/logs/{run_uuid}/'
-            cmd_str = f'rclone copy {params.run_path} {dest_str} --no-check-dest --config={params.config_path} --include "rsl.*" --transfers=8'
-            cmd_list = shlex.split(cmd_str)
-            p = subprocess.run(cmd_list, capture_output=True, text=True, check=True)
+            utils.ul_rsl_logs(params.run_path, run_uuid)
 
         raise ValueError(f'wrf.exe failed. Look at the logs for details: {results_str}')
 
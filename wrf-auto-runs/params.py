@@ -85,6 +85,14 @@ if sst_source not in ('era5', 'cci'):
 if sst_source == 'cci' and 'sst' not in file.get('remote', {}):
     raise ValueError("[sst].source = 'cci' requires a [remote.sst] section pointing at the CCI SST mirror.")
 
+if 'cache_path' in os.environ:
+    file.setdefault('cache', {})['path'] = os.environ['cache_path']
+
+if 'path' in file.get('cache', {}):
+    cache_path = pathlib.Path(file['cache']['path'])
+else:
+    cache_path = None
+
 if not data_path.exists():
     data_path.mkdir(exist_ok=True)
 
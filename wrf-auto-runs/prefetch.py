@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fill the shared input caches for a whole campaign before submitting the
+Slurm array, so the array tasks start with every input available locally.
+
+    python prefetch.py periods.csv [-n WORKERS]
+
+Reads the start_date,end_date rows of the periods CSV (the file the array
+scripts read) and parameters.toml, works out each period's input window the
+way main.py does (the bbox from the domain tree, without running geogrid),
+and fetches the union in one pass:
+
+- ERA5 source files into the 'era5' cache (nothing with [input.era5_local]),
+- CCI SST mirror days into the 'sst' cache (when sst.source = 'cci'),
+- for [remote.wrf] input, the converted WRF:* files into the 'int' cache.
+
+Sources are fetched concurrently. Requires a [cache] path.
+"""
+import argparse
+import concurrent.futures
+import csv
+import shutil
+from datetime import timedelta
+
+import pendulum
+
+import params
+import utils
+from check_ndown import check_ndown_params
+from domain_tree import DomainTree
+from download_era5 import dl_era5, era5_archive
+from namelists import NamelistConfig, build_namelists
+from process_sst_cci import prefetch_cci_days
+from run_geogrid import run_geogrid
+from run_wrf_to_int import stream_wrf_to_int
+from set_params import check_nml_params, set_geogrid_nml_params
+
+###########################################
+### Functions
+
+
+def read_periods(csv_path):
+    """(start_date, end_date) strings of every row of a periods CSV."""
+    with open(csv_path, newline='') as f:
+        return [(row['start_date'].strip(), row['end_date'].strip()) for row in csv.DictReader(f)]
+
+
+def _set_period(start_date, end_date):
+    params.file['time_control']['start_date'] = start_date
+    params.file['time_control']['end_date'] = end_date
+
+
+def _run_domains():
+    """(initial domain list, source domain count) as main.py resolves them from [domains] run."""
+    domains = params.file.get('domains', {}).get('run')
+    if isinstance(domains, int):
+        domains = [domains]
+
+    _, domains_init = check_ndown_params(domains)
+    src_n_domains, domains = check_nml_params(domains)
+    if domains_init is None:
+        domains_init = list(domains)
+
+    return domains_init, src_n_domains
+
+
+def input_bbox(src_n_domains, domains_init):
+    """
+    Input bbox of the top run domain (domains_init[0]), from the [domains]
+    geometry (DomainTree) so geogrid.exe need not run. It is rounded like
+    the bbox main.py takes from the geo_em ring and is never smaller, so the
+    ERA5 cache entries it fills cover the runs. A lat-lon grid runs geogrid
+    as main.py does.
+    """
+    pad = params.file.get('input', {}).get('bbox_pad', 0.5)
+    tree = DomainTree(params.file['domains'])
+    if tree.map_proj != 'lat-lon':
+        return tree.bbox(domains_init[0], pad)
+
+    set_geogrid_nml_params(domains_init)
+    return run_geogrid(src_n_domains, domains_init)
+
+
+def input_windows(periods, domains_init):
+    """(start, end, hour_interval) of the input each period needs, as set_nml_params computes them."""
+    config = NamelistConfig.from_params()
+    windows = []
+    for start_date, end_date in periods:
+        nml = build_namelists(config, start_date, end_date, domains_init)
+        windows.append((nml.start_date, nml.end_date, nml.interval_hours))
+
+    return windows
+
+
+def merge_windows(windows):
+    """
+    Merge overlapping or touching windows into (start, end, hour_interval)
+    spans. A span keeps the interval only if every window in it starts on
+    its time grid, else it falls back to hourly.
+    """
+    spans = []
+    for start, end, hour_interval in sorted(windows):
+        if spans and start <= spans[-1][1] + timedelta(hours=hour_interval):
+            span_start, span_end, span_interval = spans[-1]
+            if (start - span_start) % timedelta(hours=span_interval):
+                span_interval = 1
+            spans[-1] = (span_start, max(span_end, end), span_interval)
+        else:
+            spans.append((start, end, hour_interval))
+
+    return spans
+
+
+def prefetch_era5(spans, bbox, workers):
+    era5_out = params.data_path.joinpath('era5')
+    for start, end, hour_interval in spans:
+        print(f'-- ERA5 {start} to {end}')
+        dl_era5(start, end, *bbox, hour_interval, n_workers=workers)
+        shutil.rmtree(era5_out, ignore_errors=True)
+
+
+def prefetch_cci(windows):
+    dates = {ts.date() for window in windows for ts in utils.wps_timestamps(*window)}
+    n_days = prefetch_cci_days(dates)
+    print(f'-- CCI SST: {n_days} days in the cache')
+
+
+def prefetch_wrf(windows, bbox):
+    for start, end, hour_interval in windows:
+        print(f'-- WRF:* intermediates {start} to {end}')
+        stream_wrf_to_int(start, end, hour_interval, bbox)
+        for path in params.data_path.glob('WRF:*'):
+            path.unlink()
+
+
+def prefetch(csv_path, workers=16):
+    if params.cache_path is None:
+        raise ValueError('Prefetching fills the shared caches, so it needs a [cache] path.')
+
+    periods = read_periods(csv_path)
+    if not periods:
+        raise ValueError(f'{csv_path} has no periods.')
+
+    domains_init, src_n_domains = _run_domains()
+
+    # Only the domain geometry matters for the bbox, so any period will do
+    _set_period(*periods[0])
+    bbox = input_bbox(src_n_domains, domains_init)
+
+    windows = input_windows(periods, domains_init)
+    spans = merge_windows(windows)
+    print(f'-- {len(periods)} periods in {len(spans)} contiguous span(s), bbox {bbox}')
+
+    tasks = []
+    if params.is_wrf_input:
+        tasks.append((prefetch_wrf, (windows, bbox)))
+    elif era5_archive() is None:
+        tasks.append((prefetch_era5, (spans, bbox, workers)))
+    if not params.is_wrf_input and params.sst_source == 'cci':
+        tasks.append((prefetch_cci, (windows,)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(tasks), 1)) as pool:
+        for future in [pool.submit(func, *args) for func, args in tasks]:
+            future.result()
+
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill the shared input caches for every period of a campaign.')
+    parser.add_argument('csv_path', help='periods CSV with start_date,end_date columns')
+    parser.add_argument('-n', '--workers', type=int, default=16, help='parallel ERA5 downloads')
+    args = parser.parse_args()
+
+    start_time = pendulum.now('UTC')
+    prefetch(args.csv_path, args.workers)
+    print(f'-- Prefetch finished in {round((pendulum.now("UTC") - start_time).total_minutes(), 1)} mins')
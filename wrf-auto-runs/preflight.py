@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pre-flight availability check, run before geogrid.
+
+Confirms that every input the run will download exists on its remote: the
+ERA5 source files covering each day, the CCI SST mirror days, the wrfout
+files used as boundary conditions ([remote.wrf]) and the ndown parent
+wrfout files. All listings run in parallel and are shared through a JSON
+index (in [cache] path when set, else the data path) with a TTL, so array
+tasks started together list each remote prefix once between them.
+"""
+import concurrent.futures
+import fcntl
+import json
+import os
+import time
+import uuid
+
+import pendulum
+
+import cache
+import defaults
+import params
+import storage
+from download_era5 import era5_archive
+from process_sst_cci import resolve_cci_days
+
+############################################
+### Parameters
+
+INDEX_FILE = 'remote_index.json'
+
+###########################################
+### Listing index
+
+
+class RemoteIndex:
+    """Remote listings cached in a shared JSON file for ttl seconds."""
+
+    def __init__(self, path, ttl, max_workers=16):
+        self.path = path
+        self.ttl = ttl
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.errors = []
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write(self, new_entries):
+        """Merge new_entries into the index under an exclusive lock, dropping expired ones."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_name(self.path.name + '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            now = time.time()
+            index = {k: v for k, v in self._read().items() if now - v['time'] < self.ttl}
+            index.update(new_entries)
+            tmp = self.path.with_name(f'.{self.path.name}.{uuid.uuid4().hex}')
+            with open(tmp, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp, self.path)
+
+    def list(self, name, remote_cfg, prefixes):
+        """Return {prefix: set of file names} for the prefixes of remote name."""
+        remote_hash = cache.hash_key(remote_cfg)[:16]
+        index_keys = {prefix: f'{name}|{remote_hash}|{prefix}' for prefix in prefixes}
+
+        index = self._read() if self.ttl > 0 else {}
+        now = time.time()
+        listings = {}
+        stale = []
+        for prefix, key in index_keys.items():
+            entry = index.get(key)
+            if entry is not None and now - entry['time'] < self.ttl:
+                listings[prefix] = set(entry['names'])
+            else:
+                stale.append(prefix)
+
+        if stale:
+            store = storage.get_storage(name, remote_cfg)
+            futures = {self.pool.submit(lambda p: sorted(store.list(p)), prefix): prefix for prefix in stale}
+            new_entries = {}
+            for future in concurrent.futures.as_completed(futures):
+                prefix = futures[future]
+                try:
+                    names = future.result()
+                except Exception as err:
+                    self.errors.append(f'Could not list {name}:{prefix}: {err}')
+                    listings[prefix] = set()
+                    continue
+                listings[prefix] = set(names)
+                new_entries[index_keys[prefix]] = {'time': now, 'names': names}
+
+            if new_entries and self.ttl > 0:
+                self._write(new_entries)
+
+        return listings
+
+
+class _IndexedStore:
+    """Store-like view whose list() goes through a RemoteIndex."""
+
+    def __init__(self, index, name, remote_cfg):
+        self.index = index
+        self.name = name
+        self.remote_cfg = remote_cfg
+
+    def list(self, prefix=''):
+        return self.index.list(self.name, self.remote_cfg, [prefix])[prefix]
+
+
+###########################################
+### Checks
+
+
+def _days(start_date, end_date):
+    return list(pendulum.interval(pendulum.instance(start_date).start_of('day'),
+                                  pendulum.instance(end_date).start_of('day')).range('days'))
+
+
+def _key_span(name):
+    """(start, end) dates of an ERA5 source file name."""
+    dates_str = name.split('.')[-2].split('_')
+    return (pendulum.from_format(dates_str[0], 'YYYYMMDDHH').date(),
+            pendulum.from_format(dates_str[1], 'YYYYMMDDHH').date())
+
+
+def check_era5(index, start_date, end_date):
+    """Every ERA5 file code must have source files covering every run day."""
+    archive = era5_archive()
+    if archive is not None:
+        remote_cfg = {'type': 'local', 'path': str(archive)}
+    else:
+        remote_cfg = params.file['remote']['era5']
+    days = [d.date() for d in _days(start_date, end_date)]
+    months = sorted({d.strftime('%Y%m') for d in days})
+
+    prefixes = []
+    for product in defaults.ERA5_FILE_CODES:
+        if 'invariant' in product:
+            prefixes.append(f'{product}/{defaults.ERA5_INVARIANT_MONTH}')
+        else:
+            prefixes.extend(f'{product}/{month}' for month in months)
+    listings = index.list('era5', remote_cfg, prefixes)
+
+    problems = []
+    for product, codes in defaults.ERA5_FILE_CODES.items():
+        if params.sst_source == 'cci':
+            codes = [c for c in codes if c not in defaults.ERA5_CCI_SKIP_CODES]
+        names = set().union(*(names for prefix, names in listings.items() if prefix.startswith(f'{product}/')))
+
+        for code in codes:
+            code_names = [n for n in names if f'.{code}.' in n]
+            if 'invariant' in product:
+                if not code_names:
+                    problems.append(f'ERA5 {product} {code} is missing')
+                continue
+
+            spans = [_key_span(n) for n in code_names]
+            missing = [d for d in days if not any(s <= d <= e for s, e in spans)]
+            if missing:
+                problems.append(f'ERA5 {product} {code} is missing {len(missing)} day(s): {missing[0]} .. {missing[-1]}')
+
+    return problems
+
+
+def check_cci(index, start_date, end_date):
+    """Every run day must have a CCI SST file on the mirror (or in the sst cache)."""
+    days = [d.date() for d in _days(start_date, end_date)]
+    store = _IndexedStore(index, 'sst', params.file['remote']['sst'])
+    try:
+        resolve_cci_days(days, store, cache.get_cache('sst'))
+    except ValueError as err:
+        return [str(err)]
+    return []
+
+
+def _check_wrfout(index, name, remote_cfg, domain_str, start_date, end_date, label):
+    file_names = [f'wrfout_{domain_str}_{day.strftime(params.wps_date_format)}.nc' for day in _days(start_date, end_date)]
+    available = index.list(name, remote_cfg, [''])['']
+    missing = [f for f in file_names if f not in available]
+    if missing:
+        return [f'{label} is missing {len(missing)} of {len(file_names)} wrfout files: ' + ', '.join(missing[:5])
+                + (' ...' if len(missing) > 5 else '')]
+    return []
+
+
+def check_wrf_input(index, start_date, end_date):
+    """Every run day must have a [remote.wrf] wrfout file for its configured domain."""
+    remote_cfg = dict(params.file['remote']['wrf'])
+    domain = remote_cfg.pop('domain')
+    return _check_wrfout(index, 'wrf', remote_cfg, domain, start_date, end_date, '[remote.wrf]')
+
+
+def check_ndown_input(index, start_date, end_date, parent_domain):
+    """Every run day must have a parent wrfout file on the [ndown.input] remote."""
+    return _check_wrfout(index, 'ndown', params.file['ndown']['input'], f'd{parent_domain:02d}',
+                         start_date, end_date, '[ndown.input]')
+
+
+def run_preflight(start_date, end_date, ndown_domain=None):
+    """
+    Check that every input of the run is available, running the checks in
+    parallel. Raises ValueError listing every problem found. ndown_domain is
+    the parent domain whose wrfout files ndown reads, or None without ndown.
+    """
+    preflight_cfg = params.file.get('preflight', {})
+    if not preflight_cfg.get('enabled', True):
+        return True
+
+    index_dir = params.cache_path if params.cache_path is not None else params.data_path
+    index = RemoteIndex(index_dir.joinpath(INDEX_FILE), preflight_cfg.get('ttl_minutes', 60) * 60)
+
+    checks = []
+    if params.is_wrf_input:
+        checks.append((check_wrf_input, ()))
+    else:
+        checks.append((check_era5, ()))
+        if params.sst_source == 'cci':
+            checks.append((check_cci, ()))
+    if ndown_domain is not None:
+        checks.append((check_ndown_input, (ndown_domain,)))
+
+    t1 = time.time()
+    problems = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(checks)) as pool:
+            futures = [pool.submit(func, index, start_date, end_date, *args) for func, args in checks]
+            for future in futures:
+                problems.extend(future.result())
+    finally:
+        index.pool.shutdown()
+
+    problems = index.errors + problems
+    if problems:
+        raise ValueError('Pre-flight check failed, inputs are not available:\n' + '\n'.join(f'  {p}' for p in problems))
+
+    print(f'-- Pre-flight check passed in {round(time.time() - t1, 1)} secs ({len(checks)} input source(s))')
+
+    return True
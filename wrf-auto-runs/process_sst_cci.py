@@ -8,27 +8,34 @@ intermediate file for each WPS timestep in the requested range.
 Mirror layout expected at {remote.sst.path}:
     {path}/{YYYY}/{YYYYMMDD}120000-ESACCI-L4_GHRSST-SSTdepth-OSTIA-GLOB_{CDR3.0|ICDR3.0}-v02.0-fv01.0.nc
 
-Reading: h5netcdf directly (no xarray). CF decoding (scale_factor, add_offset,
-_FillValue) is done manually — it's about half a dozen lines.
+Reading: h5netcdf directly (no xarray), one open per file for both variables.
+CF decoding (scale_factor, add_offset, _FillValue) is done manually in float32.
 """
-import copy
-import shlex
+import contextlib
 import shutil
-import subprocess
-from datetime import timedelta
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import f90nml
 import h5netcdf
 import numpy as np
 from wrf_to_int.WPSUtils import IntermediateFile, MapProjection, Projections, write_slab
 
+import cache
 import params
+import storage
 import utils
+from domain_tree import DomainTree
 
 
 # WPS intermediate format constants
 XLVL_SURFACE = 200100.0
 MAP_SOURCE = 'CCI SST v3 L4 (CEDA via mirror)'
+MAP_SOURCE_COARSE = 'CCI SST v3 L4 coarsened x{factor}'  # MAP_SOURCE is 32 chars in the int format
+DEDUP_MODES = ('rewrite', 'link', 'none')
+M_PER_DEG = 111195.0  # metres per degree of latitude on the WPS sphere
 DATE_FMT_FILENAME = '%Y-%m-%d_%H'
 DATE_FMT_HDATE = '%Y-%m-%d_%H:%M:%S'
 
@@ -50,92 +57,212 @@ def _filename_for(date, variant):
     return FILENAME_TMPL.format(yyyymmdd=date.strftime('%Y%m%d'), variant=variant)
 
 
-def _wps_timestamps(start_date, end_date, hour_interval):
-    """Yield timestamps from start to end, inclusive, stepping hour_interval."""
-    curr = start_date.replace(minute=0, second=0, microsecond=0)
-    end = end_date.replace(minute=0, second=0, microsecond=0)
-    step = timedelta(hours=hour_interval)
-    while curr <= end:
-        yield curr
-        curr += step
-
-
-def _rclone_copy(src, dst, config_path):
-    """rclone copyto from remote → local. Returns (ok, stderr)."""
-    cmd = [
-        'rclone', 'copyto', src, str(dst),
-        '--config', str(config_path),
-        '--retries', '3',
-        '--low-level-retries', '5',
-        '--contimeout', '30s',
-        '--timeout', '5m',
-    ]
-    p = subprocess.run(cmd, capture_output=True, text=True)
-    if p.returncode == 0 and Path(dst).exists():
-        return True, None
-    return False, (p.stderr or p.stdout or f'exit code {p.returncode}').strip()
-
-
-def _download_day(date, remote_path, local_dir, config_path):
-    """Try primary variant first, fall back to the other on failure.
-
-    Returns the Path to the downloaded NetCDF.
-    Raises ValueError if neither variant is on the mirror.
+def _cache_key(rel_path):
+    h = cache.hash_key('cci', rel_path)
+    return f'{h[:2]}/{h}'
+
+
+def resolve_cci_days(dates, store, sst_cache=None):
+    """Pick the mirror file (primary variant, else fallback) for every date.
+
+    Days already in sst_cache are resolved from it; the mirror is listed once
+    per year for the rest. Returns {date: 'YYYY/filename'}.
+    Raises ValueError naming every date that has neither variant.
     """
-    primary, fallback = _expected_variants(date.year)
-    errors = {}
-    for variant in (primary, fallback):
-        filename = _filename_for(date, variant)
-        src = f'sst:{remote_path.rstrip("/")}/{date.year}/{filename}'
-        dst = local_dir / filename
-        ok, err = _rclone_copy(src, dst, config_path)
-        if ok:
-            return dst
-        errors[variant] = err
-    detail = '; '.join(f'{v}: {msg[:200]}' for v, msg in errors.items())
-    raise ValueError(
-        f'CCI SST mirror has no file for {date} (tried {"/".join(errors)}). '
-        f'Extend the mirror with cci-sst-dl and retry. Details: {detail}'
-    )
+    rel_paths = {}
+    if sst_cache is not None:
+        for d in dates:
+            for variant in _expected_variants(d.year):
+                rel = f'{d.year}/{_filename_for(d, variant)}'
+                if sst_cache.get(_cache_key(rel)) is not None:
+                    rel_paths[d] = rel
+                    break
+
+    unresolved = [d for d in dates if d not in rel_paths]
+    listings = {year: set(store.list(str(year))) for year in sorted({d.year for d in unresolved})}
+
+    missing = []
+    for d in unresolved:
+        for variant in _expected_variants(d.year):
+            filename = _filename_for(d, variant)
+            if filename in listings[d.year]:
+                rel_paths[d] = f'{d.year}/{filename}'
+                break
+        else:
+            missing.append(d)
+
+    if missing:
+        days_str = ', '.join(str(d) for d in missing)
+        raise ValueError(
+            f'CCI SST mirror has no file for {len(missing)} day(s) (tried CDR/ICDR): {days_str}. '
+            f'Extend the mirror with cci-sst-dl and retry.'
+        )
+    return rel_paths
+
+
+def _download_days(rel_paths, store, local_dir):
+    """Fetch every resolved day in one parallel batch from the mirror.
+
+    Returns {date: local Path}. Raises ValueError listing each day that did
+    not arrive together with the error for its file.
+    """
+    transfers = params.file.get('sst', {}).get('transfers', 8)
+    failed = store.download(sorted(rel_paths.values()), local_dir, transfers=transfers)
+
+    if failed:
+        details = [f'  {d}: {failed[rel]}' for d, rel in sorted(rel_paths.items()) if rel in failed]
+        raise ValueError(f'Failed to download {len(details)} CCI SST day(s) from the mirror:\n' + '\n'.join(details))
+
+    return {d: local_dir / rel for d, rel in rel_paths.items()}
+
+
+def _link_cached_days(sst_cache, rel_paths, local_dir):
+    """Link every cached day into local_dir. Returns ({date: local Path}, missing dates)."""
+    local_paths = {}
+    missing = []
+    for d, rel in rel_paths.items():
+        entry = sst_cache.get(_cache_key(rel))
+        if entry is None:
+            missing.append(d)
+        else:
+            local_paths[d] = sst_cache.materialize(entry, local_dir)[0]
+    return local_paths, missing
+
+
+def _fetch_days(rel_paths, store, local_dir, sst_cache=None):
+    """
+    Get the mirror files for rel_paths into local_dir, going through the shared
+    'sst' cache when one is configured. Cached days are hard-linked; only the
+    rest are downloaded (one task per file at a time) and then published.
+    """
+    if sst_cache is None:
+        return _download_days(rel_paths, store, local_dir)
+
+    local_paths, missing = _link_cached_days(sst_cache, rel_paths, local_dir)
+    if missing:
+        with contextlib.ExitStack() as stack:
+            # Sorted so concurrent tasks always take overlapping locks in the same order
+            for d in sorted(missing):
+                stack.enter_context(sst_cache.lock(_cache_key(rel_paths[d])))
+
+            # Another task may have published some days while we waited
+            linked, missing = _link_cached_days(sst_cache, {d: rel_paths[d] for d in missing}, local_dir)
+            local_paths.update(linked)
+
+            if missing:
+                downloaded = _download_days({d: rel_paths[d] for d in missing}, store, local_dir)
+                for d, path in downloaded.items():
+                    sst_cache.publish(_cache_key(rel_paths[d]), {rel_paths[d]: path}, {'rel_path': rel_paths[d]})
+                local_paths.update(downloaded)
+
+    sst_cache.evict()
+    return local_paths
 
 
 def _bbox_indices(nc_path, min_lon, min_lat, max_lon, max_lat, pad_deg=1.0):
-    """Compute lat/lon slice indices for the bbox + pad. Also returns the
-    subset lat/lon coord arrays (used to build MapProjection)."""
+    """Compute lat slice and lon slice indices for the bbox + pad. Also returns the
+    subset lat/lon coord arrays (used to build MapProjection). A bbox crossing the
+    file's longitude seam gives two lon slices, and the coords of the second run on
+    past the seam so they stay ascending."""
     with h5netcdf.File(str(nc_path), 'r') as f:
         lat = np.asarray(f.variables['lat'][:])
         lon = np.asarray(f.variables['lon'][:])
 
     lat_lo = int(np.searchsorted(lat, min_lat - pad_deg, side='left'))
     lat_hi = int(np.searchsorted(lat, max_lat + pad_deg, side='right'))
-    lon_lo = int(np.searchsorted(lon, min_lon - pad_deg, side='left'))
-    lon_hi = int(np.searchsorted(lon, max_lon + pad_deg, side='right'))
 
-    if lat_hi - lat_lo < 2 or lon_hi - lon_lo < 2:
+    lon_start = float(np.floor(lon[0]))
+    lon_slices = []
+    lon_sub = []
+    for lo, hi in utils.lon_ranges(min_lon - pad_deg, max_lon + pad_deg, lon_start):
+        lon_lo = int(np.searchsorted(lon, lo, side='left'))
+        lon_hi = int(np.searchsorted(lon, hi, side='right'))
+        if lon_hi > lon_lo:
+            lon_slices.append((lon_lo, lon_hi))
+            lon_sub.append(lon[lon_lo:lon_hi] + 360 * len(lon_sub))
+    lon_sub = np.concatenate(lon_sub) if lon_sub else lon[:0]
+
+    if lat_hi - lat_lo < 2 or len(lon_sub) < 2:
         raise ValueError(
             f'CCI subset for bbox ({min_lon}, {min_lat}, {max_lon}, {max_lat}) '
-            f'produced only {lat_hi - lat_lo} lat × {lon_hi - lon_lo} lon points.'
+            f'produced only {lat_hi - lat_lo} lat × {len(lon_sub)} lon points.'
         )
 
-    return (lat_lo, lat_hi, lon_lo, lon_hi), lat[lat_lo:lat_hi], lon[lon_lo:lon_hi]
+    return (lat_lo, lat_hi, lon_slices), lat[lat_lo:lat_hi], lon_sub
 
 
-def _read_day_slab(nc_path, var_name, idx):
-    """Read a single 2-D slab with CF decoding (scale_factor, add_offset, _FillValue)."""
-    lat_lo, lat_hi, lon_lo, lon_hi = idx
-    with h5netcdf.File(str(nc_path), 'r') as f:
-        var = f.variables[var_name]
-        raw = np.asarray(var[0, lat_lo:lat_hi, lon_lo:lon_hi])
-        scale = float(var.attrs['scale_factor']) if 'scale_factor' in var.attrs else 1.0
-        offset = float(var.attrs['add_offset']) if 'add_offset' in var.attrs else 0.0
-        fill = var.attrs.get('_FillValue')
-
-    data = raw.astype(np.float64) * scale + offset
+def _cf_decode(raw, attrs):
+    """Vectorized float32 CF decoding (scale_factor, add_offset, _FillValue → NaN)."""
+    scale = np.float32(attrs['scale_factor']) if 'scale_factor' in attrs else np.float32(1.0)
+    offset = np.float32(attrs['add_offset']) if 'add_offset' in attrs else np.float32(0.0)
+    data = raw.astype(np.float32)
+    data *= scale
+    data += offset
+    fill = attrs.get('_FillValue')
     if fill is not None:
-        data[raw == fill] = np.nan
+        np.copyto(data, np.float32(np.nan), where=(raw == fill))
     return data
 
 
+def _finest_dx_deg():
+    """Grid spacing in degrees of the finest domain metgrid writes SST to (the max_dom domains of namelist.wps)."""
+    wps_nml = f90nml.read(params.wps_nml_path)
+    tree = DomainTree.from_namelist(wps_nml)
+    dx = float(tree.dx[:wps_nml['share']['max_dom']].min())
+
+    # lat-lon grids give dx in degrees already, the others in metres
+    if tree.map_proj == 'lat-lon':
+        return dx
+    return dx / M_PER_DEG
+
+
+def _coarsen_factor(src_deg):
+    """Block size for [sst] coarsen: keep coarsen_points_per_dx source-derived points per finest dx."""
+    sst_cfg = params.file.get('sst', {})
+    if not sst_cfg.get('coarsen', False):
+        return 1
+    points_per_dx = sst_cfg.get('coarsen_points_per_dx', 2)
+    return max(1, int(_finest_dx_deg() / (points_per_dx * src_deg)))
+
+
+def _coarsen(slab, factor):
+    """NaN-aware block average over factor x factor cells, trimming any ragged edge."""
+    if factor == 1:
+        return slab
+    ny, nx = slab.shape[0] // factor, slab.shape[1] // factor
+    blocks = slab[:ny * factor, :nx * factor].reshape(ny, factor, nx, factor)
+    valid = ~np.isnan(blocks)
+    counts = valid.sum(axis=(1, 3))
+    sums = np.where(valid, blocks, np.float32(0)).sum(axis=(1, 3), dtype=np.float32)
+    out = np.full((ny, nx), np.nan, dtype=np.float32)
+    np.divide(sums, counts, out=out, where=counts > 0)
+    return out
+
+
+def _coarsen_coords(vals, factor):
+    """Block-centre coordinates matching _coarsen."""
+    n = len(vals) // factor
+    return vals[:n * factor].reshape(n, factor).mean(axis=1)
+
+
+def _read_day_slabs(nc_path, idx, factor=1):
+    """Open a day's file once and return the decoded (sst, ice) float32 slabs."""
+    lat_lo, lat_hi, lon_slices = idx
+    slabs = []
+    with h5netcdf.File(str(nc_path), 'r') as f:
+        for var_name in ('analysed_sst', 'sea_ice_fraction'):
+            var = f.variables[var_name]
+            raw = np.concatenate([np.asarray(var[0, lat_lo:lat_hi, lon_lo:lon_hi]) for lon_lo, lon_hi in lon_slices],
+                                 axis=1)
+            slabs.append(_coarsen(_cf_decode(raw, dict(var.attrs)), factor))
+    return tuple(slabs)
+
+
+def _day_windows(dates, window_days):
+    """Split the sorted dates into consecutive windows of at most window_days."""
+    return [dates[i:i + window_days] for i in range(0, len(dates), window_days)]
+
+
 def _build_projection(lat_vals, lon_vals):
     delta_lat = float(lat_vals[1] - lat_vals[0])
     delta_lon = float(lon_vals[1] - lon_vals[0])
@@ -150,20 +277,109 @@ def _build_projection(lat_vals, lon_vals):
     )
 
 
-def _write_intermediate(ts, sst_slab, ice_slab, proj):
+def _write_intermediate(ts, sst_slab, ice_slab, proj, map_source=MAP_SOURCE):
     datestr = ts.strftime(DATE_FMT_FILENAME)
     hdate = ts.strftime(DATE_FMT_HDATE)
 
     intfile = IntermediateFile('SST', datestr)
     try:
         write_slab(intfile, sst_slab, XLVL_SURFACE, proj,
-                   'SST', hdate, 'K', MAP_SOURCE, 'Sea-Surface Temperature')
+                   'SST', hdate, 'K', map_source, 'Sea-Surface Temperature')
         write_slab(intfile, ice_slab, XLVL_SURFACE, proj,
-                   'SEAICE', hdate, 'fraction', MAP_SOURCE, 'Sea-Ice Fraction')
+                   'SEAICE', hdate, 'fraction', map_source, 'Sea-Ice Fraction')
     finally:
         intfile.close()
 
 
+def _hdate_offsets(int_path):
+    """Byte offsets of every HDATE field in a version-5 WPS intermediate file.
+
+    Walks the big-endian Fortran unformatted records: a 4-byte record holding
+    version 5 is followed by the header record whose first 24 bytes are HDATE.
+    """
+    offsets = []
+    expect_header = False
+    with open(int_path, 'rb') as f:
+        while True:
+            marker = f.read(4)
+            if len(marker) < 4:
+                break
+            (n,) = struct.unpack('>i', marker)
+            start = f.tell()
+            if expect_header:
+                offsets.append(start)
+                expect_header = False
+            elif n == 4:
+                (value,) = struct.unpack('>i', f.read(4))
+                expect_header = value == 5
+            f.seek(start + n + 4)
+    return offsets
+
+
+def _dedup_intermediate(src_path, ts, mode, offsets):
+    """Create the SST intermediate for ts from src_path, a file of the same day."""
+    dst_path = Path(f'SST:{ts.strftime(DATE_FMT_FILENAME)}')
+    if mode == 'link':
+        cache.link_or_copy(src_path, dst_path)
+        return
+
+    # 'rewrite': a byte copy with each record's HDATE patched for this timestamp
+    if dst_path.exists():
+        dst_path.unlink()
+    shutil.copyfile(src_path, dst_path)
+    hdate = ts.strftime(DATE_FMT_HDATE).ljust(24).encode()
+    with open(dst_path, 'r+b') as f:
+        for offset in offsets:
+            f.seek(offset)
+            f.write(hdate)
+
+
+def _write_day(decoded, ts_by_date, nc_by_date, proj, map_source):
+    """Write every intermediate for one decoded day, then delete its NetCDF.
+
+    Only the day's first timestamp is encoded from the slabs; with [sst] dedup
+    'rewrite' (default) or 'link' the others are copied or hard-linked from it.
+    """
+    d, future = decoded
+    sst_slab, ice_slab = future.result()
+    mode = params.file.get('sst', {}).get('dedup', 'rewrite')
+    if mode not in DEDUP_MODES:
+        raise ValueError(f"[sst] dedup must be one of {', '.join(DEDUP_MODES)}, got '{mode}'.")
+
+    first, *rest = ts_by_date[d]
+    _write_intermediate(first, sst_slab, ice_slab, proj, map_source)
+    if mode == 'none':
+        for ts in rest:
+            _write_intermediate(ts, sst_slab, ice_slab, proj, map_source)
+    elif rest:
+        src_path = Path(f'SST:{first.strftime(DATE_FMT_FILENAME)}')
+        offsets = _hdate_offsets(src_path) if mode == 'rewrite' else None
+        for ts in rest:
+            _dedup_intermediate(src_path, ts, mode, offsets)
+    nc_by_date[d].unlink()
+
+
+def prefetch_cci_days(dates, batch_days=31):
+    """Fill the shared 'sst' cache with the mirror files of dates.
+
+    Used to warm the cache for many runs at once; days already cached are
+    skipped. Scratch holds at most batch_days files at a time.
+    """
+    sst_cache = cache.get_cache('sst')
+    if sst_cache is None:
+        raise ValueError('Prefetching CCI SST needs a [cache] path.')
+
+    store = storage.get_storage('sst', params.file['remote']['sst'])
+    rel_paths = resolve_cci_days(sorted(dates), store, sst_cache)
+
+    local_dir = params.data_path.joinpath('sst_prefetch')
+    for window in _day_windows(sorted(rel_paths), batch_days):
+        _fetch_days({d: rel_paths[d] for d in window}, store, local_dir, sst_cache)
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+    return len(rel_paths)
+
+
 def process_sst_cci(start_date, end_date, hour_interval,
                     min_lon, min_lat, max_lon, max_lat):
     """Pull per-day CCI SST NetCDFs from the mirror and write SST:* intermediates.
@@ -175,40 +391,65 @@ def process_sst_cci(start_date, end_date, hour_interval,
     sst_dir = params.data_path.joinpath('sst')
     sst_dir.mkdir(exist_ok=True)
 
-    # Build rclone config for the 'sst:' remote (reuse the [remote.sst] TOML section)
-    remote_cfg = copy.deepcopy(params.file['remote']['sst'])
-    remote_path = remote_cfg.pop('path', '')
-    config_path = utils.create_rclone_config('sst', params.data_path, remote_cfg)
+    store = storage.get_storage('sst', params.file['remote']['sst'])
 
-    # Collect unique dates needed (one NetCDF per date, reused across sub-daily slots)
-    timestamps = list(_wps_timestamps(start_date, end_date, hour_interval))
+    # Collect unique dates needed (one NetCDF per date, reused across its sub-daily slots)
+    timestamps = list(utils.wps_timestamps(start_date, end_date, hour_interval))
     unique_dates = sorted({ts.date() for ts in timestamps})
 
-    # Download each day once; map date -> local NetCDF path
-    nc_by_date = {}
-    for d in unique_dates:
-        nc_by_date[d] = _download_day(d, remote_path, sst_dir, config_path)
+    # Resolve each day's variant from the cache, else with one mirror listing per year
+    sst_cache = cache.get_cache('sst')
+    rel_paths = resolve_cci_days(unique_dates, store, sst_cache)
+
+    ts_by_date = {}
+    for ts in timestamps:
+        ts_by_date.setdefault(ts.date(), []).append(ts)
+
+    # Stream the days in windows: download -> decode -> write -> delete, with
+    # the next window downloading in the background. Scratch disk holds at
+    # most two windows.
+    window_days = max(1, int(params.file.get('sst', {}).get('window_days', 5)))
+    windows = _day_windows(unique_dates, window_days)
+
+    # Days are decoded concurrently but written in order; at most decode_workers
+    # days are in flight so memory stays bounded
+    decode_workers = max(1, int(params.file.get('sst', {}).get('decode_workers', 2)))
 
-    # Build projection + bbox indices from the first file (all share the same grid)
-    first_nc = nc_by_date[unique_dates[0]]
-    idx, lat_sub, lon_sub = _bbox_indices(first_nc, min_lon, min_lat, max_lon, max_lat)
-    proj = _build_projection(lat_sub, lon_sub)
+    def fetch(window):
+        return _fetch_days({d: rel_paths[d] for d in window}, store, sst_dir, sst_cache)
 
-    # Write one WPS intermediate per timestamp, reading each NetCDF only once
     orig_cwd = Path.cwd()
     import os
     os.chdir(params.data_path)
     try:
-        slab_cache = {}  # date -> (sst_slab, ice_slab)
-        for ts in timestamps:
-            d = ts.date()
-            if d not in slab_cache:
-                nc_path = nc_by_date[d]
-                sst_slab = _read_day_slab(nc_path, 'analysed_sst', idx)
-                ice_slab = _read_day_slab(nc_path, 'sea_ice_fraction', idx)
-                slab_cache[d] = (sst_slab, ice_slab)
-            sst_slab, ice_slab = slab_cache[d]
-            _write_intermediate(ts, sst_slab, ice_slab, proj)
+        with ThreadPoolExecutor(max_workers=1) as dl_pool, ThreadPoolExecutor(max_workers=decode_workers) as decode_pool:
+            pending = dl_pool.submit(fetch, windows[0])
+            idx = proj = None
+            factor = 1
+            map_source = MAP_SOURCE
+            for i, window in enumerate(windows):
+                nc_by_date = pending.result()
+                if i + 1 < len(windows):
+                    pending = dl_pool.submit(fetch, windows[i + 1])
+
+                if idx is None:
+                    # All files share the same grid, so the first one sets the subset and projection
+                    idx, lat_sub, lon_sub = _bbox_indices(nc_by_date[window[0]], min_lon, min_lat, max_lon, max_lat)
+                    factor = _coarsen_factor(abs(float(lat_sub[1] - lat_sub[0])))
+                    factor = min(factor, len(lat_sub) // 2, len(lon_sub) // 2)
+                    if factor > 1:
+                        print(f'-- Coarsening CCI SST by {factor}x{factor} blocks')
+                        lat_sub, lon_sub = _coarsen_coords(lat_sub, factor), _coarsen_coords(lon_sub, factor)
+                        map_source = MAP_SOURCE_COARSE.format(factor=factor)
+                    proj = _build_projection(lat_sub, lon_sub)
+
+                decoding = deque()
+                for d in window:
+                    decoding.append((d, decode_pool.submit(_read_day_slabs, nc_by_date[d], idx, factor)))
+                    if len(decoding) >= decode_workers:
+                        _write_day(decoding.popleft(), ts_by_date, nc_by_date, proj, map_source)
+                while decoding:
+                    _write_day(decoding.popleft(), ts_by_date, nc_by_date, proj, map_source)
     finally:
         os.chdir(orig_cwd)
 
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Variable and time subsetting of remote wrfout files with byte-range reads.
+
+The remote HDF5 file is opened through fsspec (optional dependency: fsspec,
+plus s3fs for s3 remotes or aiohttp for http ones). Only the chunks of the
+requested variables and time frames are read, and they are written to a
+compact local netCDF4 file with the same dimensions and global attributes.
+Remotes that fsspec cannot reach this way return None from remote_url and
+the caller downloads the whole file instead.
+"""
+import concurrent.futures
+import os
+import pathlib
+
+import h5netcdf
+import numpy as np
+
+import defaults
+import utils
+
+############################################
+### Parameters
+
+BLOCK_SIZE = 4 * 1024**2
+
+WRF_TIME_FORMAT = '%Y-%m-%d_%H:%M:%S'
+
+# Read by the pipeline itself (pressure levels, input extent) on top of the preset
+PIPELINE_VARS = {'P_TOP', 'XLAT', 'XLONG'}
+
+###########################################
+### Functions
+
+
+def wrf_to_int_variables():
+    """The wrfout variables needed to convert a file with wrf_to_int."""
+    return sorted(set(utils.resolve_output_variables(defaults.OUTPUT_PRESETS['wrf_to_int'])) | PIPELINE_VARS)
+
+
+def remote_url(remote_cfg):
+    """
+    (base url, fsspec storage options) for an rclone-style remote section, or
+    None when it cannot be range-read (fsspec or its protocol package missing,
+    or an unsupported remote type).
+    """
+    try:
+        import fsspec
+    except ImportError:
+        return None
+
+    type_ = remote_cfg.get('type')
+    path = str(remote_cfg.get('path', '')).strip('/')
+
+    if type_ == 'local':
+        return f'file:///{path}', {}
+
+    if type_ == 's3':
+        try:
+            fsspec.get_filesystem_class('s3')
+        except ImportError:
+            return None
+        # Credentials as storage.S3Storage takes them: keys, else env_auth, else anonymous
+        access_key_id = remote_cfg.get('access_key_id') or None
+        env_auth = str(remote_cfg.get('env_auth', False)).lower() == 'true'
+        options = {
+            'key': access_key_id,
+            'secret': remote_cfg.get('secret_access_key') or None,
+            'anon': access_key_id is None and not env_auth,
+        }
+        client_kwargs = {}
+        if remote_cfg.get('endpoint'):
+            client_kwargs['endpoint_url'] = remote_cfg['endpoint']
+        if remote_cfg.get('region'):
+            client_kwargs['region_name'] = remote_cfg['region']
+        if client_kwargs:
+            options['client_kwargs'] = client_kwargs
+        return f's3://{path}', options
+
+    if type_ == 'http':
+        try:
+            fsspec.get_filesystem_class('http')
+        except ImportError:
+            return None
+        return f"{remote_cfg['url'].rstrip('/')}/{path}".rstrip('/'), {}
+
+    return None
+
+
+def _time_indices(times_var, times):
+    """Indices of the Times entries in times (all of them if times is None)."""
+    stamps = [b''.join(row).decode() if row.dtype.kind == 'S' else ''.join(row) for row in np.asarray(times_var[:])]
+    if times is None:
+        return list(range(len(stamps)))
+
+    wanted = {t.strftime(WRF_TIME_FORMAT) for t in times}
+    idx = [i for i, stamp in enumerate(stamps) if stamp in wanted]
+    if len(idx) < len(wanted):
+        missing = sorted(wanted - {stamps[i] for i in idx})
+        raise ValueError(f'{len(missing)} requested time(s) are not in the file: {", ".join(missing[:5])}')
+    return idx
+
+
+def subset_file(url, dest, variables, times=None, storage_options=None):
+    """
+    Copy variables (those present) at the valid times (datetimes, or None
+    for all of them) from the remote netCDF4 file at url into dest. The file
+    is written next to dest and renamed into place once complete.
+    """
+    import fsspec
+
+    dest = pathlib.Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(dest.name + '.part')
+
+    with fsspec.open(url, 'rb', block_size=BLOCK_SIZE, cache_type='blockcache', **(storage_options or {})) as fobj:
+        with h5netcdf.File(fobj, 'r') as src, h5netcdf.File(tmp, 'w') as dst:
+            t_idx = _time_indices(src['Times'], times)
+
+            names = [v for v in variables if v in src.variables]
+            dims = {}
+            for name in names:
+                for dim in src[name].dimensions:
+                    dims[dim] = len(t_idx) if dim == 'Time' else src.dimensions[dim].size
+            dst.dimensions = dims
+            dst.attrs.update(src.attrs)
+
+            for name in names:
+                var = src[name]
+                if var.dimensions and var.dimensions[0] == 'Time':
+                    data = var[t_idx] if t_idx != list(range(var.shape[0])) else var[:]
+                else:
+                    data = var[:]
+                out = dst.create_variable(name, var.dimensions, dtype=var.dtype, data=data)
+                out.attrs.update(var.attrs)
+
+    os.replace(tmp, dest)
+
+    return dest
+
+
+def fetch_subsets(remote_cfg, names, dest_dir, variables, times=None, workers=4):
+    """
+    Range-read subsets of the remote files names into dest_dir (same names),
+    several files in parallel. times is None or {name: datetimes}. Returns
+    {name: error message} for the files that failed, like storage downloads.
+    """
+    base, options = remote_url(remote_cfg)
+    dest_dir = pathlib.Path(dest_dir)
+
+    failed = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(subset_file, f'{base}/{name}', dest_dir.joinpath(name), variables,
+                               None if times is None else times[name], options): name
+                   for name in names}
+        for future in concurrent.futures.as_completed(futures):
+            err = future.exception()
+            if err is not None:
+                failed[futures[future]] = str(err)
+
+    return failed
@@ -11,7 +11,10 @@ import subprocess
 import pendulum
 import shutil
 
+import cache
 import params
+import utils
+from download_era5 import era5_archive, level_min, thin_file
 
 
 
@@ -23,25 +26,78 @@ import params
 ### Functions
 
 
-def run_era5_to_int(start_date, end_date, hour_interval, del_old=True):
+def era5_int_source(min_lon, min_lat, max_lon, max_lat):
+    """Everything besides the valid time that the ERA5:* intermediate files depend on."""
+    archive = era5_archive()
+    if archive is not None:
+        return {
+            'source': 'era5_local',
+            'path': str(archive),
+            'bbox': [min_lon, min_lat, max_lon, max_lat],
+            'skip_vars': 'SST,SEAICE' if params.sst_source == 'cci' else None,
+            'level_min': level_min(),
+        }
+
+    return {
+        'source': 'era5',
+        'bbox': [min_lon, min_lat, max_lon, max_lat],
+        'skip_vars': 'SST,SEAICE' if params.sst_source == 'cci' else None,
+        'level_min': level_min(),
+    }
+
+
+def missing_era5_int(start_date, end_date, hour_interval, bbox):
+    """Valid times whose ERA5:* intermediate file is not in the cache."""
+    timestamps = list(utils.wps_timestamps(start_date, end_date, hour_interval))
+    int_cache = cache.get_cache('int')
+    if int_cache is None:
+        return timestamps
+
+    source = era5_int_source(*bbox)
+
+    return [ts for ts in timestamps if int_cache.get(utils.int_cache_key('ERA5', source, ts)) is None]
+
+
+def run_era5_to_int(start_date, end_date, hour_interval, bbox=None, del_old=True):
     """
+    Write ERA5:* intermediate files for every valid time into data_path.
 
+    With an intermediate cache and a bbox, cached timestamps are linked in and
+    era5_to_int only converts the missing ones (one call per contiguous run).
+    Pressure levels above level_min() are dropped from the source files first
+    (files subset from [input.era5_local] already are).
     """
     era5_path = params.data_path.joinpath('era5')
 
-    cmd_str = f'era5_to_int -h {hour_interval} {era5_path} "{start_date}" "{end_date}"'
-    if params.sst_source == 'cci':
-        cmd_str += ' --skip-vars SST,SEAICE'
-    cmd_list = shlex.split(cmd_str)
-    p = subprocess.run(cmd_list, capture_output=True, text=True, check=False, cwd=params.data_path)
+    timestamps = list(utils.wps_timestamps(start_date, end_date, hour_interval))
 
-    if len(p.stderr) > 0:
-        raise ValueError(p.stderr)
+    if bbox is not None:
+        source = era5_int_source(*bbox)
+        missing = utils.link_cached_intermediates('ERA5', source, timestamps)
     else:
-        if del_old:
-            shutil.rmtree(era5_path)
-        return True
+        source = None
+        missing = timestamps
+
+    # Cached source files from before level pruning still hold every level
+    min_level = level_min()
+    if missing and min_level is not None:
+        for nc_path in era5_path.rglob('*.pl.*.nc'):
+            thin_file(nc_path, min_level=min_level)
+
+    for run_start, run_end in utils.contiguous_runs(missing, hour_interval):
+        cmd_str = f'era5_to_int -h {hour_interval} {era5_path} "{run_start}" "{run_end}"'
+        if params.sst_source == 'cci':
+            cmd_str += ' --skip-vars SST,SEAICE'
+        cmd_list = shlex.split(cmd_str)
+        p = subprocess.run(cmd_list, capture_output=True, text=True, check=False, cwd=params.data_path)
 
+        if len(p.stderr) > 0:
+            raise ValueError(p.stderr)
 
+    if source is not None:
+        utils.publish_intermediates('ERA5', source, missing)
 
+    if del_old and era5_path.exists():
+        shutil.rmtree(era5_path)
 
+    return True
@@ -8,10 +8,15 @@ Created on Tue Sep 23 15:16:12 2025
 import subprocess
 import os
 import pathlib
+import f90nml
 import h5netcdf
 import numpy as np
 
+import cache
 import params
+import utils
+import wps_mpi
+from stage_geog import stage_geog
 
 ####################################################
 ### Geogrid
@@ -26,6 +31,151 @@ import params
 
 # p = subprocess.Popen([str(params.geogrid_exe)], cwd=params.data_path)
 
+DOMAIN_CHAIN_FIELDS = ('parent_id', 'parent_grid_ratio', 'i_parent_start', 'j_parent_start', 'e_we', 'e_sn')
+
+PROJECTION_FIELDS = ('map_proj', 'ref_lat', 'ref_lon', 'truelat1', 'truelat2', 'stand_lon', 'pole_lat', 'pole_lon', 'dx', 'dy')
+
+
+def _geog_version():
+    """
+    Cheap fingerprint of the WPS_GEOG tree: the top-level dataset names and their
+    mtimes, plus an optional [cache.geo_em].geog_version string to force a refresh.
+    """
+    entries = sorted((e.name, e.stat().st_mtime_ns) for e in os.scandir(params.geog_data_path))
+    user_version = params.file.get('cache', {}).get('geo_em', {}).get('geog_version')
+    return [entries, user_version]
+
+
+def geo_em_keys(wps_nml):
+    """
+    Cache key for every domain's geo_em file in namelist.wps.
+
+    Each key hashes the projection, the domain's own geog_data_res, the nest
+    geometry of the domain and its whole parent chain, and the GEOGRID.TBL and
+    WPS_GEOG versions.
+    """
+    geogrid = wps_nml['geogrid']
+    max_dom = wps_nml['share']['max_dom']
+
+    tbl_path = pathlib.Path(geogrid.get('opt_geogrid_tbl_path', params.geogrid_exe.parent.joinpath('geogrid')))
+    tbl_hash = cache.hash_file(tbl_path.joinpath('GEOGRID.TBL'))
+    geog_version = _geog_version()
+
+    projection = {f: geogrid.get(f) for f in PROJECTION_FIELDS}
+    chain_fields = {f: utils.to_list(geogrid[f]) for f in DOMAIN_CHAIN_FIELDS}
+    geog_data_res = utils.to_list(geogrid['geog_data_res'])
+
+    keys = {}
+    for domain in range(1, max_dom + 1):
+        chain = []
+        index = domain - 1
+        while True:
+            chain.append({f: v[index] for f, v in chain_fields.items()})
+            parent_id = chain_fields['parent_id'][index]
+            if index == 0 or parent_id == index + 1:
+                break
+            index = parent_id - 1
+
+        key = cache.hash_key(
+            domain, projection, chain, geog_data_res[domain - 1], tbl_hash, geog_version,
+            wps_nml['share'].get('wrf_core'), wps_nml['share'].get('io_form_geogrid'),
+        )
+        keys[domain] = f'{key[:2]}/{key}'
+
+    return keys
+
+
+def _exec_geogrid(max_dom=None):
+    """
+    Run geogrid.exe, optionally for only the first max_dom domains of
+    namelist.wps, reading WPS_GEOG from the node-local copy when [geog]
+    stage_path is set.
+    """
+    nml_text = params.wps_nml_path.read_text()
+    wps_nml = f90nml.read(params.wps_nml_path)
+    stage_path = stage_geog(wps_nml, max_dom)
+    if max_dom is not None or stage_path is not None:
+        if max_dom is not None:
+            wps_nml['share']['max_dom'] = max_dom
+        if stage_path is not None:
+            wps_nml['geogrid']['geog_data_path'] = str(stage_path)
+        wps_nml.write(params.wps_nml_path, force=True)
+
+    cwd = params.wps_nml_path.parent
+    cmd_list, ranks = wps_mpi.wps_command(params.geogrid_exe, wps_nml, max_dom)
+    if ranks > 1:
+        print(f'-- geogrid.exe on {ranks} MPI ranks')
+    wps_mpi.clear_logs('geogrid', cwd)
+
+    try:
+        p = subprocess.Popen(
+                cmd_list,
+                cwd=cwd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+
+        stdout, stderr = p.communicate()
+    finally:
+        params.wps_nml_path.write_text(nml_text)
+
+    # mpirun writes its own notices to stderr, so a dmpar run is judged by rank 0's completion message
+    if cmd_list[0] == 'mpirun':
+        if 'Successful completion of geogrid.' not in stdout:
+            errors = wps_mpi.log_errors(wps_mpi.rank_logs('geogrid', cwd))
+            raise ValueError(f'geogrid failed:\n{errors or stderr}')
+    elif len(stderr) > 0:
+        raise ValueError(stderr)
+
+
+def _run_geogrid_cached(geo_cache):
+    """
+    Link cached geo_em files into data_path and run geogrid.exe only up to the
+    highest domain that missed. geogrid.exe always processes domains 1..max_dom,
+    so domains below a miss are regenerated rather than linked (geogrid would
+    otherwise overwrite the cached file through the hard link).
+    """
+    wps_nml = f90nml.read(params.wps_nml_path)
+    keys = geo_em_keys(wps_nml)
+
+    hits = {domain: geo_cache.get(key) for domain, key in keys.items()}
+    missing = [domain for domain, entry in hits.items() if entry is None]
+    last_run = max(missing) if missing else 0
+
+    for domain, entry in hits.items():
+        if domain > last_run:
+            cache.link_or_copy(entry.joinpath('geo_em.nc'), params.data_path.joinpath(f'geo_em.d{domain:02d}.nc'))
+
+    print(f'-- geo_em cache: {len(keys) - len(missing)} of {len(keys)} domains cached')
+
+    if missing:
+        _exec_geogrid(last_run)
+
+        for domain in range(1, last_run + 1):
+            file_path = params.data_path.joinpath(f'geo_em.d{domain:02d}.nc')
+            geo_cache.publish(keys[domain], {'geo_em.nc': file_path}, {'domain': domain})
+
+        geo_cache.evict()
+
+
+def domain_bbox(geo_em_path, pad=0.5):
+    """
+    Download bbox (min_lon, min_lat, max_lon, max_lat) of a domain from the
+    XLAT_M/XLONG_M boundary ring of its geo_em file, padded by pad degrees
+    and rounded out to whole degrees. Longitudes are 0-360; for a domain
+    crossing the prime meridian max_lon exceeds 360 (see utils.lon_ranges).
+    """
+    with h5netcdf.File(geo_em_path, 'r') as f:
+        lat = np.asarray(f['XLAT_M'][0])
+        lon = np.asarray(f['XLONG_M'][0])
+
+    ring_lat = np.concatenate([lat[0], lat[-1], lat[:, 0], lat[:, -1]])
+    ring_lon = np.concatenate([lon[0], lon[-1], lon[:, 0], lon[:, -1]])
+
+    return utils.ring_bbox(ring_lon, ring_lat, pad)
+
+
 def run_geogrid(src_n_domains, domains, rm_existing=True):
     # f = os.open('/home/mike/data/wrf/tests/geogrid.log', os.O_WRONLY)
 
@@ -33,22 +183,11 @@ def run_geogrid(src_n_domains, domains, rm_existing=True):
         for file in params.data_path.glob('geo_em*.nc'):
             file.unlink()
 
-    p = subprocess.Popen(
-            [str(params.geogrid_exe)],
-            cwd=params.wps_nml_path.parent,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-
-    # response = p.poll()
-
-    stdout, stderr = p.communicate()
-
-    if len(stderr) > 0:
-        raise ValueError(stderr)
-
-    # print(stdout)
+    geo_cache = cache.get_cache('geo_em')
+    if geo_cache is not None:
+        _run_geogrid_cached(geo_cache)
+    else:
+        _exec_geogrid()
 
     ## Remove and rename files if needed
     if len(domains) < src_n_domains:
@@ -65,16 +204,8 @@ def run_geogrid(src_n_domains, domains, rm_existing=True):
             if src_file_path != dst_file_path:
                 os.rename(src_file_path, dst_file_path)
 
-    with h5netcdf.File(params.data_path.joinpath('geo_em.d01.nc')) as f:
-        corner_lats = f.attrs['corner_lats']
-        corner_lons = f.attrs['corner_lons']
-
-    corner_lons = [lon if lon > 0 else 360 + lon for lon in corner_lons]
-
-    min_lon = np.floor(np.min(corner_lons))
-    max_lon = np.ceil(np.max(corner_lons))
-    min_lat = np.floor(np.min(corner_lats))
-    max_lat = np.ceil(np.max(corner_lats))
+    pad = params.file.get('input', {}).get('bbox_pad', 0.5)
+    min_lon, min_lat, max_lon, max_lat = domain_bbox(params.data_path.joinpath('geo_em.d01.nc'), pad)
 
     return min_lon, min_lat, max_lon, max_lat
 
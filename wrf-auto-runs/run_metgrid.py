@@ -6,12 +6,17 @@ Created on Mon Oct  6 10:40:23 2025
 @author: mike
 """
 import pathlib
-import shlex
 import subprocess
+from datetime import datetime
+
+import f90nml
 import pendulum
 import sentry_sdk
 
+import cache
 import params
+import utils
+import wps_mpi
 
 
 
@@ -23,29 +28,96 @@ import params
 ### Functions
 
 
-def run_metgrid(del_old=True):
+def met_em_keys(wps_nml):
     """
+    Cache key for every met_em file metgrid.exe will write, as {file name: key}.
 
+    metgrid writes every domain for every valid time between that domain's
+    &share start_date and end_date (real.exe needs the nest files at every
+    time for wrflowinp with sst_update). Each key hashes the domain's geo_em
+    file, the intermediate files for that valid time (every fg_name prefix),
+    the valid time, METGRID.TBL and the remaining &metgrid options.
     """
-    cmd_str = f'{params.metgrid_exe}'
-    cmd_list = shlex.split(cmd_str)
+    share = wps_nml['share']
+    metgrid = wps_nml['metgrid']
+
+    start_dates = utils.to_list(share['start_date'])
+    end_dates = utils.to_list(share['end_date'])
+    hour_interval = int(share['interval_seconds']) // 3600
+
+    tbl_path = pathlib.Path(metgrid.get('opt_metgrid_tbl_path', params.metgrid_exe.parent.joinpath('metgrid')))
+    tbl_hash = cache.hash_file(tbl_path.joinpath('METGRID.TBL'))
+
+    options = {k: v for k, v in metgrid.items() if k not in ('fg_name', 'opt_metgrid_tbl_path', 'opt_output_from_metgrid_path')}
+
+    int_hashes = {}
+    keys = {}
+    for domain in range(1, share['max_dom'] + 1):
+        geo_hash = cache.hash_file(params.data_path.joinpath(f'geo_em.d{domain:02d}.nc'))
+        start_date = datetime.strptime(start_dates[min(domain, len(start_dates)) - 1], params.wps_date_format)
+        end_date = datetime.strptime(end_dates[min(domain, len(end_dates)) - 1], params.wps_date_format)
+
+        for ts in utils.wps_timestamps(start_date, end_date, hour_interval):
+            if ts not in int_hashes:
+                int_hashes[ts] = [
+                    cache.hash_file(f'{prefix}:{ts.strftime("%Y-%m-%d_%H")}')
+                    for prefix in utils.to_list(metgrid['fg_name'])
+                ]
+            key = cache.hash_key(geo_hash, int_hashes[ts], ts, tbl_hash, options)
+            keys[f'met_em.d{domain:02d}.{ts.strftime(params.wps_date_format)}.nc'] = f'{key[:2]}/{key}'
+
+    return keys
+
+
+def _del_intermediates():
+    for path in params.data_path.glob('ERA5:*'):
+        path.unlink()
+    for path in params.data_path.glob('WRF:*'):
+        path.unlink()
+    for path in params.data_path.glob('SST:*'):
+        path.unlink()
+
+
+def run_metgrid(del_old=True):
+    """
+    Run metgrid.exe, or link every met_em file from the met_em cache when all
+    of them are cached (e.g. runs that only change [physics]/[dynamics]).
+    """
+    met_cache = cache.get_cache('met_em')
+    if met_cache is not None:
+        keys = met_em_keys(f90nml.read(params.wps_nml_path))
+        hits = {name: met_cache.get(key) for name, key in keys.items()}
+        n_hits = sum(entry is not None for entry in hits.values())
+        print(f'-- met_em cache: {n_hits} of {len(keys)} files cached')
+
+        if n_hits == len(keys):
+            for name, entry in hits.items():
+                cache.link_or_copy(entry.joinpath('met_em.nc'), params.data_path.joinpath(name))
+            if del_old:
+                _del_intermediates()
+            return True
+
+    cmd_list, ranks = wps_mpi.wps_command(params.metgrid_exe, f90nml.read(params.wps_nml_path))
+    if ranks > 1:
+        print(f'-- metgrid.exe on {ranks} MPI ranks')
+    wps_mpi.clear_logs('metgrid', params.data_path)
     p = subprocess.run(cmd_list, capture_output=True, text=True, check=False, cwd=params.data_path)
 
     if 'Successful completion of metgrid.' in p.stdout:
+        if met_cache is not None:
+            for name, key in keys.items():
+                file_path = params.data_path.joinpath(name)
+                if file_path.exists():
+                    met_cache.publish(key, {'met_em.nc': file_path}, {'file_name': name})
+            met_cache.evict()
         if del_old:
-            for path in params.data_path.glob('ERA5:*'):
-                path.unlink()
-            for path in params.data_path.glob('WRF:*'):
-                path.unlink()
-            for path in params.data_path.glob('SST:*'):
-                path.unlink()
+            _del_intermediates()
         return True
     else:
+        logs = wps_mpi.rank_logs('metgrid', params.data_path)
         if params.is_sentry:
             scope = sentry_sdk.get_current_scope()
-            scope.add_attachment(path=params.data_path.joinpath('metgrid.log'))
-        raise ValueError(f'metgrid failed. Look at the metgrid.log file for details: {p.stderr}')
-
-
-
-
+            for log_path in logs:
+                scope.add_attachment(path=log_path)
+        errors = wps_mpi.log_errors(logs)
+        raise ValueError(f'metgrid failed. Look at the metgrid.log file(s) for details: {errors or p.stderr}')
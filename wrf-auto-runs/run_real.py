@@ -6,16 +6,15 @@ Created on Mon Oct  6 10:40:23 2025
 @author: mike
 """
 import os
-import pathlib
 import resource
 import shlex
 import subprocess
 import pendulum
 import sentry_sdk
 import shutil
-import copy
 
 import params
+import utils
 
 ############################################
 ### Parameters
@@ -94,22 +93,9 @@ def run_real(run_uuid, del_old=True):
         # scope = sentry_sdk.get_current_scope()
         # scope.add_attachment(path=real_log_path)
 
-        if params.is_remote_output:
-            remote = copy.deepcopy(params.file['remote']['output'])
-
-            name = 'output'
-
-            if 'path' in remote:
-                out_path = pathlib.Path(remote.pop('path'))
-            else:
-                out_path = None
-
-            if out_path is not None:
-                print(f'-- Uploading WRF/real.exe log files for run uuid: {run_uuid}')
-                dest_str = f'{name}:{out_path}/logs/{run_uuid}/'
-                cmd_str = f'rclone copy {params.run_path} {dest_str} --no-check-dest --config={params.config_path} --include "rsl.*" --transfers=8'
-                cmd_list = shlex.split(cmd_str)
-                p = subprocess.run(cmd_list, capture_output=True, text=True, check=True)
+        if utils.output_storage() is not None:
+            print(f'-- Uploading WRF/real.exe log files for run uuid: {run_uuid}')
+            utils.ul_rsl_logs(params.run_path, run_uuid)
 
         raise ValueError(f'real.exe failed. Look at the logs for details: {results_str}')
 
@@ -5,14 +5,21 @@ Created on Sun Mar 22 2026
 
 @author: mike
 """
+import concurrent.futures
 import shlex
 import subprocess
 import shutil
+from collections import deque
 
 import numpy as np
-import h5netcdf
 
+import governor
+import meta_index
 import params
+import range_read
+import storage
+import utils
+from download_wrf import wrf_input_files
 
 
 ############################################
@@ -23,21 +30,21 @@ import params
 ### Functions
 
 
-def _compute_pressure_levels(wrfout_path):
+def _compute_pressure_levels(wrfout_path, pattern='wrfout_*.nc'):
     """
     Generate log-spaced pressure levels matching the source wrfout vertical resolution.
 
-    Reads the number of eta levels and P_TOP from the first wrfout file, then
-    produces the same number of integer pressure levels evenly spaced in
-    log-pressure from 1000 hPa down to P_TOP.
+    Takes the number of eta levels and P_TOP of the wrfout files matching
+    pattern from the header index (they must all agree), then produces the
+    same number of integer pressure levels evenly spaced in log-pressure
+    from 1000 hPa down to P_TOP.
     """
-    wrfout_files = sorted(wrfout_path.glob('wrfout_*.nc'))
-    if not wrfout_files:
+    metas = meta_index.scan_dir(wrfout_path, pattern)
+    if not metas:
         raise FileNotFoundError(f'No wrfout files found in {wrfout_path}')
 
-    with h5netcdf.File(str(wrfout_files[0]), 'r') as nc:
-        n_eta = nc.dimensions['bottom_top'].size
-        p_top_hpa = float(np.asarray(nc['P_TOP'][0])) / 100.0
+    n_eta = meta_index.uniform(metas, 'levels', 'wrfout')['bottom_top']
+    p_top_hpa = meta_index.uniform(metas, 'p_top', 'wrfout') / 100.0
 
     log_levels = np.linspace(np.log(1000), np.log(max(p_top_hpa, 1)), n_eta)
     levels_hpa = sorted(set(np.round(np.exp(log_levels)).astype(int)), reverse=True)
@@ -45,22 +52,140 @@ def _compute_pressure_levels(wrfout_path):
     return ','.join(str(l) for l in levels_hpa)
 
 
-def run_wrf_to_int(start_date, end_date, hour_interval, del_old=True):
+def _check_wrfout(wrfout_path, pattern, bbox, timestamps):
     """
-    Convert wrfout files to WPS intermediate format using wrf_to_int.
+    Check the wrfout files matching pattern against the header index: each
+    covers bbox and together they hold every timestamp. Returns their
+    pressure levels.
     """
-    wrfout_path = params.data_path.joinpath('wrfout')
-    domain = params.file['remote']['wrf']['domain']
+    utils.check_input_extent('wrf', *bbox, pattern)
+
+    missing = meta_index.missing_times(meta_index.scan_dir(wrfout_path, pattern), timestamps)
+    if missing:
+        raise ValueError(f'The wrfout files lack {len(missing)} valid time(s) the run needs: {", ".join(missing[:5])}')
+
+    return _compute_pressure_levels(wrfout_path, pattern)
+
+
+def wrf_int_source():
+    """Everything besides the valid time that the WRF:* intermediate files depend on."""
+    remote = params.file['remote']['wrf']
+    return {
+        'source': 'wrf',
+        'endpoint': remote.get('endpoint'),
+        'path': remote['path'],
+        'domain': remote['domain'],
+    }
 
-    pressure_levels = _compute_pressure_levels(wrfout_path)
 
-    cmd_str = f'wrf_to_int {wrfout_path} -s "{start_date}" -e "{end_date}" -h {hour_interval} -d {domain} -l {pressure_levels}'
+def _convert(wrfout, start, end, hour_interval, domain, pressure_levels):
+    """Run wrf_to_int on wrfout (a file or directory) for start..end."""
+    cmd_str = f'wrf_to_int {wrfout} -s "{start}" -e "{end}" -h {hour_interval} -d {domain} -l {pressure_levels}'
     cmd_list = shlex.split(cmd_str)
     p = subprocess.run(cmd_list, capture_output=True, text=True, check=False, cwd=params.data_path)
 
     if len(p.stderr) > 0:
         raise ValueError(p.stderr)
-    else:
-        if del_old:
-            shutil.rmtree(wrfout_path)
+
+
+def stream_wrf_to_int(start_date, end_date, hour_interval, bbox):
+    """
+    Download the parent wrfout files one day at a time and convert each day
+    as soon as its file lands, deleting it afterwards.
+
+    At most [input.wrf] window_days (default 2) files are on disk at once;
+    the downloads of the following days overlap the conversion of the
+    current one. Cached WRF:* files are linked in and their days skipped.
+    When the remote can be range-read ([input.wrf] range_read, default
+    true), only the wrf_to_int variables at the missing times are fetched.
+    bbox is the domain bounds each file is checked against.
+    """
+    source = wrf_int_source()
+    timestamps = list(utils.wps_timestamps(start_date, end_date, hour_interval))
+    missing = utils.link_cached_intermediates('WRF', source, timestamps)
+    if not missing:
+        print('-- All WRF intermediate files are cached, skipping the download...')
         return True
+
+    missing_by_day = {}
+    for ts in missing:
+        missing_by_day.setdefault(ts.date(), []).append(ts)
+    days = sorted(missing_by_day)
+
+    store, domain, file_names = wrf_input_files(missing[0], missing[-1])
+
+    wrfout_path = params.data_path.joinpath('wrfout')
+    wrfout_path.mkdir(exist_ok=True)
+    input_cfg = params.file.get('input', {}).get('wrf', {})
+    window_days = max(1, int(input_cfg.get('window_days', 2)))
+
+    remote_cfg = dict(params.file['remote']['wrf'])
+    del remote_cfg['domain']
+    range_read_ok = input_cfg.get('range_read', True) and range_read.remote_url(remote_cfg) is not None
+    if range_read_ok:
+        variables = range_read.wrf_to_int_variables()
+        print(f'-- Range-reading {len(variables)} variables from the wrfout files')
+
+    def fetch(day):
+        name = file_names[day]
+        if range_read_ok:
+            with governor.slots('wrf').acquire(1):
+                failed = range_read.fetch_subsets(remote_cfg, [name], wrfout_path, variables, {name: missing_by_day[day]})
+        else:
+            failed = store.download([name], wrfout_path)
+        storage.check_failures(failed, 'download wrfout')
+        return wrfout_path.joinpath(name)
+
+    pressure_levels = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=window_days) as pool:
+        pending = deque(pool.submit(fetch, day) for day in days[:window_days])
+        next_day = window_days
+        for day in days:
+            file_path = pending.popleft().result()
+
+            # Every file is checked as it lands; the vertical grid must not change between days
+            levels = _check_wrfout(wrfout_path, file_path.name, bbox, missing_by_day[day])
+            if pressure_levels is not None and levels != pressure_levels:
+                raise ValueError(f'{file_path.name} has a different vertical grid from the previous wrfout files.')
+            pressure_levels = levels
+
+            print(f'-- Converting {file_path.name}')
+            for run_start, run_end in utils.contiguous_runs(missing_by_day[day], hour_interval):
+                _convert(file_path, run_start, run_end, hour_interval, domain, pressure_levels)
+            file_path.unlink()
+
+            if next_day < len(days):
+                pending.append(pool.submit(fetch, days[next_day]))
+                next_day += 1
+
+    utils.publish_intermediates('WRF', source, missing)
+
+    return True
+
+
+def run_wrf_to_int(start_date, end_date, hour_interval, del_old=True):
+    """
+    Convert wrfout files to WPS intermediate format using wrf_to_int.
+
+    Cached WRF:* files are linked in and only the missing timestamps are
+    converted (one wrf_to_int call per contiguous run).
+    """
+    wrfout_path = params.data_path.joinpath('wrfout')
+    domain = params.file['remote']['wrf']['domain']
+
+    source = wrf_int_source()
+    timestamps = list(utils.wps_timestamps(start_date, end_date, hour_interval))
+    missing = utils.link_cached_intermediates('WRF', source, timestamps)
+
+    if missing:
+        pressure_levels = _compute_pressure_levels(wrfout_path)
+
+    for run_start, run_end in utils.contiguous_runs(missing, hour_interval):
+        _convert(wrfout_path, run_start, run_end, hour_interval, domain, pressure_levels)
+
+    utils.publish_intermediates('WRF', source, missing)
+
+    if del_old and wrfout_path.exists():
+        shutil.rmtree(wrfout_path)
+
+    return True
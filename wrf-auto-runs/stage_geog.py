@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stage the WPS_GEOG tiles geogrid.exe will read onto node-local scratch.
+
+geogrid.exe reads WPS_GEOG tile by tile, which over a shared network mount
+is mostly small random reads. With [geog] stage_path set, the tiles a run
+needs are worked out up front and copied in parallel into a mirror of
+WPS_GEOG under stage_path, and geogrid.exe reads the mirror instead:
+
+- GEOGRID.TBL gives the dataset directory of every field for each domain's
+  geog_data_res ('modis_15s_lake+modis_15s+default' style priority lists).
+- Each dataset's index file gives its lon/lat grid, so a tile's extent
+  follows from its xstart-xend.ystart-yend name.
+- Each domain's lon/lat bounds come from the namelist.wps projection and
+  nest geometry (domain_tree.DomainTree).
+
+Only tiles overlapping a domain (padded by [geog] pad degrees) are copied.
+Staged files are kept, so later runs on the same node copy only what is new.
+Datasets not on a regular lon/lat grid, and lat-lon map projections, are
+staged whole.
+"""
+import concurrent.futures
+import os
+import pathlib
+import re
+import shutil
+
+import params
+import utils
+from domain_tree import DomainTree
+
+############################################
+### Parameters
+
+TILE_RE = re.compile(r'^(\d+)-(\d+)\.(\d+)-(\d+)$')
+
+###########################################
+### Functions
+
+
+def read_geogrid_tbl(tbl_path):
+    """
+    Entries of a GEOGRID.TBL as dicts: name, optional, and paths, the
+    {resolution: relative dataset path} of its rel_path lines.
+    """
+    entries = []
+    entry = None
+    for line in pathlib.Path(tbl_path).read_text().splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line.startswith('='):
+            entry = None
+            continue
+        if '=' not in line:
+            continue
+        key, _, value = (part.strip() for part in line.partition('='))
+        if key == 'name':
+            entry = {'name': value, 'optional': False, 'paths': {}}
+            entries.append(entry)
+        elif entry is None:
+            continue
+        elif key == 'optional':
+            entry['optional'] = value.lower() == 'yes'
+        elif key == 'rel_path':
+            res, _, path = value.partition(':')
+            entry['paths'][res.strip()] = path.strip().strip('/')
+
+    return entries
+
+
+def dataset_paths(entries, geog_data_res):
+    """
+    Relative dataset paths geogrid reads for one domain: per entry, the first
+    resolution of the '+' separated geog_data_res it has, else 'default'.
+    """
+    options = [res.strip() for res in str(geog_data_res).split('+')] + ['default']
+    paths = set()
+    for entry in entries:
+        for res in options:
+            if res in entry['paths']:
+                paths.add(entry['paths'][res])
+                break
+
+    return paths
+
+
+def read_index(index_path):
+    """The key = value pairs of a WPS_GEOG dataset index file, as strings."""
+    index = {}
+    for line in pathlib.Path(index_path).read_text().splitlines():
+        key, sep, value = line.partition('=')
+        if sep:
+            index[key.strip().lower()] = value.strip().strip('"\'')
+
+    return index
+
+
+def _overlaps(lon_lo, lon_hi, lat_lo, lat_hi, bbox, pad):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if lat_lo > max_lat + pad or lat_hi < min_lat - pad:
+        return False
+    return any(lon_lo + k <= max_lon + pad and lon_hi + k >= min_lon - pad for k in (-360, 0, 360, 720))
+
+
+def needed_files(dataset_dir, bboxes, pad=0.5):
+    """
+    Names of the files in dataset_dir to stage for bboxes: the index and
+    every other non-tile file, plus the tiles overlapping any bbox. All files
+    when bboxes is None or the dataset is not on a regular lon/lat grid.
+    """
+    names = sorted(entry.name for entry in os.scandir(dataset_dir) if entry.is_file())
+    index = read_index(pathlib.Path(dataset_dir).joinpath('index'))
+    if bboxes is None or index.get('projection', 'regular_ll').lower() != 'regular_ll':
+        return names
+
+    dx = float(index['dx'])
+    dy = float(index['dy'])
+    known_x = float(index.get('known_x', 1))
+    known_y = float(index.get('known_y', 1))
+    known_lon = float(index['known_lon'])
+    known_lat = float(index['known_lat'])
+    # Interpolation stencils reach a couple of source cells past the domain
+    pad = max(pad, 2 * abs(dx), 2 * abs(dy))
+
+    files = []
+    for name in names:
+        m = TILE_RE.match(name)
+        if m is None:
+            files.append(name)
+            continue
+        x0, x1, y0, y1 = map(int, m.groups())
+        lon_lo = known_lon + (x0 - known_x - 0.5) * dx
+        lon_hi = known_lon + (x1 - known_x + 0.5) * dx
+        lat_lo, lat_hi = sorted((known_lat + (y0 - known_y - 0.5) * dy, known_lat + (y1 - known_y + 0.5) * dy))
+        if any(_overlaps(lon_lo, lon_hi, lat_lo, lat_hi, bbox, pad) for bbox in bboxes):
+            files.append(name)
+
+    return files
+
+
+def plan_geog(wps_nml, max_dom=None, pad=0.5):
+    """
+    {relative dataset path: [file names]} of the WPS_GEOG files geogrid.exe
+    reads for the first max_dom domains of wps_nml. Datasets missing from
+    WPS_GEOG are left out (geogrid reports them as before).
+    """
+    geogrid = wps_nml['geogrid']
+    max_dom = max_dom or wps_nml['share']['max_dom']
+
+    tbl_path = pathlib.Path(geogrid.get('opt_geogrid_tbl_path', params.geogrid_exe.parent.joinpath('geogrid')))
+    entries = read_geogrid_tbl(tbl_path.joinpath('GEOGRID.TBL'))
+
+    tree = DomainTree(geogrid)
+    bounds = tree.bounds()[:max_dom] if tree.map_proj != 'lat-lon' else None
+    geog_data_res = utils.to_list(geogrid.get('geog_data_res', 'default'))
+
+    datasets = {}
+    for domain in range(max_dom):
+        res = geog_data_res[domain] if domain < len(geog_data_res) else geog_data_res[-1]
+        for path in dataset_paths(entries, res):
+            bboxes = datasets.setdefault(path, [])
+            if bounds is not None:
+                bboxes.append(bounds[domain])
+
+    plan = {}
+    for path, bboxes in sorted(datasets.items()):
+        dataset_dir = params.geog_data_path.joinpath(path)
+        if dataset_dir.joinpath('index').is_file():
+            plan[path] = needed_files(dataset_dir, bboxes if bounds is not None else None, pad)
+
+    return plan
+
+
+def _stage_file(src, dst):
+    """Copy src to dst unless an identical-size copy is already staged."""
+    if dst.exists() and dst.stat().st_size == src.stat().st_size:
+        return 0
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f'{dst.name}.{os.getpid()}.part')
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+    return src.stat().st_size
+
+
+def stage_geog(wps_nml, max_dom=None):
+    """
+    Copy the WPS_GEOG files geogrid.exe needs for wps_nml into [geog]
+    stage_path and return that path, or None when staging is not configured.
+    """
+    geog_cfg = params.file.get('geog', {})
+    if not geog_cfg.get('stage_path'):
+        return None
+
+    stage_path = pathlib.Path(geog_cfg['stage_path'])
+    plan = plan_geog(wps_nml, max_dom, geog_cfg.get('pad', 0.5))
+
+    pairs = [(params.geog_data_path.joinpath(path, name), stage_path.joinpath(path, name))
+             for path, names in plan.items() for name in names]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=geog_cfg.get('workers', 16)) as pool:
+        copied = sum(pool.map(lambda pair: _stage_file(*pair), pairs))
+
+    print(f'-- WPS_GEOG: staged {len(pairs)} files from {len(plan)} datasets ({round(copied / 1024**2)} MB copied)')
+
+    return stage_path
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-process access to the remotes in parameters.toml ([remote.*], [ndown.input]).
+
+Each remote section is an rclone-style dict (type, provider, endpoint,
+access_key_id, secret_access_key, path, ...). get_storage picks a backend:
+
+- type 'local': LocalStorage, plain filesystem copies (also used by the tests).
+- type 's3' with boto3 installed: S3Storage, one pooled client per remote,
+  parallel multipart transfers and paginated (streaming) listings. Remotes
+  without keys (and without env_auth) are read anonymously, as rclone does.
+- anything else, or [storage] backend = 'rclone': RcloneStorage, which
+  writes the rclone config once per remote and shells out to rclone.
+
+All names are relative to the remote's path and may contain '/'. download
+and upload return {name: error message} for the files that failed, so
+callers can report every failure at once.
+"""
+import concurrent.futures
+import copy
+import os
+import pathlib
+import shutil
+import subprocess
+
+import cache
+import governor
+import params
+
+############################################
+### Parameters
+
+MULTIPART_CHUNK_BYTES = 64 * 1024**2
+
+_storages = {}
+
+###########################################
+### Backends
+
+
+class LocalStorage:
+    """A remote that is a directory on a mounted filesystem."""
+
+    def __init__(self, path, transfers=8):
+        self.root = pathlib.Path(path)
+        self.transfers = transfers
+
+    def list(self, prefix=''):
+        """Yield the names of the files directly under prefix."""
+        base = self.root.joinpath(prefix)
+        if not base.is_dir():
+            return
+        for entry in sorted(os.scandir(base), key=lambda e: e.name):
+            if entry.is_file():
+                yield entry.name
+
+    def _transfer(self, pairs):
+        failed = {}
+        for name, src, dst in pairs:
+            try:
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(src, dst)
+            except OSError as err:
+                failed[name] = str(err)
+        return failed
+
+    def download(self, names, dest_dir, prefix='', transfers=None):
+        dest_dir = pathlib.Path(dest_dir)
+        return self._transfer([(n, self.root.joinpath(prefix, n), dest_dir.joinpath(n)) for n in names])
+
+    def upload(self, paths, prefix='', transfers=None):
+        return self._transfer([(pathlib.Path(p).name, pathlib.Path(p), self.root.joinpath(prefix, pathlib.Path(p).name))
+                               for p in paths])
+
+
+class S3Storage:
+    """
+    An S3-compatible remote accessed with boto3 (optional dependency).
+
+    Credentials follow rclone: access_key_id/secret_access_key when given,
+    else the environment/instance chain with env_auth = true, else anonymous
+    (unsigned) requests. Each file moves as a multipart transfer of up to
+    streams parallel connections.
+    """
+
+    def __init__(self, remote_cfg, transfers=8, streams=4):
+        import boto3
+        import botocore
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        bucket, _, key_prefix = str(remote_cfg.get('path', '')).strip('/').partition('/')
+        if not bucket:
+            raise ValueError('An s3 remote needs a path starting with the bucket name.')
+        self.bucket = bucket
+        self.key_prefix = key_prefix
+        self.transfers = transfers
+        self.streams = streams
+
+        access_key_id = remote_cfg.get('access_key_id') or None
+        env_auth = str(remote_cfg.get('env_auth', False)).lower() == 'true'
+        config = {'max_pool_connections': transfers * streams, 'retries': {'max_attempts': 5, 'mode': 'adaptive'}}
+        if access_key_id is None and not env_auth:
+            config['signature_version'] = botocore.UNSIGNED
+
+        self.client = boto3.client(
+            's3',
+            endpoint_url=remote_cfg.get('endpoint') or None,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=remote_cfg.get('secret_access_key') or None,
+            region_name=remote_cfg.get('region') or None,
+            config=Config(**config),
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_CHUNK_BYTES,
+            multipart_chunksize=MULTIPART_CHUNK_BYTES,
+            max_concurrency=streams,
+        )
+
+    def _key(self, *parts):
+        return '/'.join(p.strip('/') for p in (self.key_prefix, *parts) if p.strip('/'))
+
+    def list(self, prefix=''):
+        """Yield the names of the files directly under prefix, page by page."""
+        key = self._key(prefix)
+        key = f'{key}/' if key else ''
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=key, Delimiter='/'):
+            for obj in page.get('Contents', []):
+                name = obj['Key'][len(key):]
+                if name:
+                    yield name
+
+    def _parallel(self, func, items, transfers):
+        failed = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=transfers or self.transfers) as pool:
+            futures = {pool.submit(func, *item): item[0] for item in items}
+            for future in concurrent.futures.as_completed(futures):
+                err = future.exception()
+                if err is not None:
+                    failed[futures[future]] = str(err)
+        return failed
+
+    def _get(self, name, key, dst):
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dst.with_name(dst.name + '.part')
+        self.client.download_file(self.bucket, key, str(tmp), Config=self.transfer_config)
+        os.replace(tmp, dst)
+
+    def _put(self, name, src, key):
+        self.client.upload_file(str(src), self.bucket, key, Config=self.transfer_config)
+
+    def download(self, names, dest_dir, prefix='', transfers=None):
+        dest_dir = pathlib.Path(dest_dir)
+        items = [(n, self._key(prefix, n), dest_dir.joinpath(n)) for n in names]
+        return self._parallel(self._get, items, transfers)
+
+    def upload(self, paths, prefix='', transfers=None):
+        items = [(pathlib.Path(p).name, pathlib.Path(p), self._key(prefix, pathlib.Path(p).name)) for p in paths]
+        return self._parallel(self._put, items, transfers)
+
+
+class RcloneStorage:
+    """
+    Fallback backend: any rclone remote type, via the rclone CLI. With
+    streams = 1 rclone's multi-thread downloads and multipart upload
+    concurrency are turned off, so each transfer is one connection.
+    """
+
+    def __init__(self, name, remote_cfg, transfers=8, streams=4):
+        remote_cfg = dict(remote_cfg)
+        self.base = str(remote_cfg.pop('path', '')).rstrip('/')
+        self.name = name
+        self.transfers = transfers
+        self.streams = streams
+
+        # utils imports this module for its upload helpers
+        import utils
+        self.config_path = utils.create_rclone_config(name, params.data_path, remote_cfg)
+
+    def _remote(self, prefix=''):
+        return f'{self.name}:{self.base}/{prefix.strip("/")}'.rstrip('/') + '/'
+
+    def _run(self, cmd, files=None):
+        cmd = cmd + ['--config', str(self.config_path), '--retries', '3', '--low-level-retries', '5']
+        if self.streams == 1:
+            cmd += ['--multi-thread-streams', '0', '--s3-upload-concurrency', '1']
+        return subprocess.run(cmd, input=files, capture_output=True, text=True, check=False)
+
+    def list(self, prefix=''):
+        p = self._run(['rclone', 'lsf', self._remote(prefix), '--max-depth', '1', '--files-only'])
+        if p.returncode != 0:
+            raise ValueError(f'rclone could not list {self._remote(prefix)}: {p.stderr.strip()[:500]}')
+        yield from (line for line in p.stdout.split('\n') if line)
+
+    def _failures(self, names, p, done):
+        """Map each name that did not arrive to the last rclone error mentioning it."""
+        err_lines = (p.stderr or '').splitlines()
+        failed = {}
+        for name in names:
+            if not done(name):
+                msgs = [line.strip() for line in err_lines if name.split('/')[-1] in line]
+                failed[name] = msgs[-1][:300] if msgs else f'not transferred (rclone exit code {p.returncode})'
+        return failed
+
+    def download(self, names, dest_dir, prefix='', transfers=None):
+        dest_dir = pathlib.Path(dest_dir)
+        p = self._run(['rclone', 'copy', self._remote(prefix), str(dest_dir),
+                       '--files-from-raw', '-', '--no-traverse',
+                       '--transfers', str(transfers or self.transfers)],
+                      '\n'.join(names))
+        return self._failures(names, p, lambda n: dest_dir.joinpath(n).exists())
+
+    def upload(self, paths, prefix='', transfers=None):
+        failed = {}
+        by_dir = {}
+        for path in map(pathlib.Path, paths):
+            by_dir.setdefault(path.parent, []).append(path.name)
+        for src_dir, names in by_dir.items():
+            p = self._run(['rclone', 'copy', str(src_dir), self._remote(prefix),
+                           '--files-from-raw', '-', '--no-traverse', '--no-check-dest',
+                           '--transfers', str(transfers or self.transfers)],
+                          '\n'.join(names))
+            if p.returncode != 0:
+                failed.update(self._failures(names, p, lambda n: False))
+        return failed
+
+
+class GovernedStorage:
+    """
+    A backend whose transfers hold slots of the remote's cluster-wide cap
+    (governor.py); each call runs with as many parallel transfers as slots held.
+    get_storage builds the S3 and rclone backends single-stream under a cap,
+    so one slot is one connection to the remote.
+    """
+
+    def __init__(self, store, slots):
+        self.store = store
+        self.slots = slots
+        self.transfers = store.transfers
+
+    def list(self, prefix=''):
+        return self.store.list(prefix)
+
+    def download(self, names, dest_dir, prefix='', transfers=None):
+        with self.slots.acquire(transfers or self.transfers) as n:
+            return self.store.download(names, dest_dir, prefix, transfers=n)
+
+    def upload(self, paths, prefix='', transfers=None):
+        with self.slots.acquire(transfers or self.transfers) as n:
+            return self.store.upload(paths, prefix, transfers=n)
+
+
+###########################################
+### Functions
+
+
+def get_storage(name, remote_cfg):
+    """
+    Return the (memoized) storage backend for the remote section remote_cfg,
+    registered as name. [storage] backend = 'rclone' forces the rclone
+    backend; [storage] transfers sets the parallel transfer count and
+    [storage] max_transfers caps it across every task (see governor.py).
+    """
+    memo_key = (name, str(params.data_path), cache.hash_key(remote_cfg))
+    if memo_key in _storages:
+        return _storages[memo_key]
+
+    storage_cfg = params.file.get('storage', {})
+    transfers = storage_cfg.get('transfers', 8)
+    remote_cfg = copy.deepcopy(remote_cfg)
+    type_ = remote_cfg.get('type')
+
+    # Under a cap a slot must be one stream, so multipart transfers go single-stream
+    slots = governor.slots(name)
+    governed = isinstance(slots, governor.TransferSlots)
+
+    store = None
+    if storage_cfg.get('backend', 'auto') != 'rclone':
+        if type_ == 'local':
+            store = LocalStorage(remote_cfg.get('path', ''), transfers)
+        elif type_ == 's3':
+            try:
+                store = S3Storage(remote_cfg, transfers, streams=1 if governed else 4)
+            except ImportError:
+                store = None
+
+    if store is None:
+        store = RcloneStorage(name, remote_cfg, transfers, streams=1 if governed else 4)
+
+    if governed:
+        store = GovernedStorage(store, slots)
+
+    _storages[memo_key] = store
+    return store
+
+
+def check_failures(failed, action):
+    """Raise a ValueError listing every failed file, if any."""
+    if failed:
+        details = '\n'.join(f'  {name}: {msg}' for name, msg in sorted(failed.items()))
+        raise ValueError(f'Failed to {action} {len(failed)} file(s):\n{details}')
@@ -1,6 +1,6 @@
 import pytest
 
-from set_params import broadcast_field
+from namelists import broadcast_field
 
 
 class TestBroadcastField:
@@ -0,0 +1,124 @@
+import multiprocessing
+import os
+import time
+
+import params
+import cache
+from cache import FileCache, bbox_contains, hash_key
+
+
+def _write(path, content=b'x'):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return path
+
+
+def _hold_lock(root, key, locked, release):
+    with FileCache(root).lock(key):
+        locked.set()
+        release.wait(10)
+
+
+class TestFileCache:
+    def test_publish_and_get(self, tmp_path):
+        c = FileCache(tmp_path / 'cache')
+        src = _write(tmp_path / 'src' / 'a.nc', b'abc')
+
+        assert c.get('k1') is None
+        entry = c.publish('k1', [src], {'bbox': [0, 0, 1, 1]})
+
+        assert c.get('k1') == entry
+        assert entry.joinpath('a.nc').read_bytes() == b'abc'
+        assert c.read_meta(entry)['bbox'] == [0, 0, 1, 1]
+
+    def test_publish_keeps_existing_entry(self, tmp_path):
+        c = FileCache(tmp_path / 'cache')
+        first = c.publish('k1', [_write(tmp_path / 'one' / 'a.nc', b'first')])
+        second = c.publish('k1', [_write(tmp_path / 'two' / 'a.nc', b'second')])
+
+        assert first == second
+        assert first.joinpath('a.nc').read_bytes() == b'first'
+        assert not any(c.root.joinpath('.tmp').iterdir())
+
+    def test_find_superset_bbox(self, tmp_path):
+        c = FileCache(tmp_path / 'cache')
+        src = _write(tmp_path / 'a.nc')
+        c.publish('grp/big', [src], {'bbox': [160, -50, 185, -30]})
+
+        def match(bbox):
+            return lambda meta: bbox_contains(meta['bbox'], bbox)
+
+        assert c.find('grp', match((165, -45, 180, -35))) == c.path('grp/big')
+        assert c.find('grp', match((150, -45, 180, -35))) is None
+        assert c.find('other', match((165, -45, 180, -35))) is None
+
+    def test_materialize_nested_names(self, tmp_path):
+        c = FileCache(tmp_path / 'cache')
+        src = _write(tmp_path / 'a.nc', b'abc')
+        entry = c.publish('k1', {'e5.oper.an.pl/202001/a.nc': src})
+
+        paths = c.materialize(entry, tmp_path / 'out')
+
+        assert paths == [tmp_path / 'out' / 'e5.oper.an.pl' / '202001' / 'a.nc']
+        assert paths[0].read_bytes() == b'abc'
+
+    def test_evict_least_recently_used(self, tmp_path):
+        c = FileCache(tmp_path / 'cache', max_bytes=250)
+        for i, name in enumerate(['k1', 'k2', 'k3']):
+            entry = c.publish(name, [_write(tmp_path / name / 'a.nc', b'x' * 100)])
+            past = time.time() - 100 + i
+            os.utime(entry / cache.META_FILE, (past, past))
+
+        # Using k1 makes k2 the least recently used
+        c.get('k1')
+        n_removed = c.evict()
+
+        assert n_removed >= 1
+        assert c.get('k2') is None
+        assert c.get('k1') is not None
+
+    def test_evict_skips_locked_entries(self, tmp_path):
+        c = FileCache(tmp_path / 'cache', max_bytes=1)
+        c.publish('k1', [_write(tmp_path / 'a.nc', b'x' * 100)])
+
+        # POSIX locks are per process, so hold the key's lock from a child process
+        ctx = multiprocessing.get_context('fork')
+        locked, release = ctx.Event(), ctx.Event()
+        proc = ctx.Process(target=_hold_lock, args=(c.root, 'k1', locked, release))
+        proc.start()
+        try:
+            assert locked.wait(10)
+            assert c.evict() == 0
+            assert c.get('k1') is not None
+        finally:
+            release.set()
+            proc.join()
+
+        assert c.evict() == 1
+        assert c.get('k1') is None
+
+    def test_lock_is_reentrant_across_calls(self, tmp_path):
+        c = FileCache(tmp_path / 'cache')
+        with c.lock('grp/k1') as held:
+            assert held
+        with c.lock('grp/k1', blocking=False) as held:
+            assert held
+
+
+class TestHelpers:
+    def test_hash_key_is_order_independent_for_dicts(self):
+        assert hash_key({'a': 1, 'b': 2}) == hash_key({'b': 2, 'a': 1})
+        assert hash_key('era5', (1, 2)) != hash_key('era5', (1, 3))
+
+    def test_get_cache_disabled_without_path(self, mock_params, monkeypatch):
+        monkeypatch.setattr(params, 'cache_path', None)
+        assert cache.get_cache('era5') is None
+
+    def test_get_cache_namespace_settings(self, mock_params, monkeypatch, tmp_path):
+        monkeypatch.setattr(params, 'cache_path', tmp_path / 'cache')
+        mock_params['cache'] = {'path': str(tmp_path / 'cache'), 'max_size_gb': 2, 'int': {'enabled': False}}
+
+        era5_cache = cache.get_cache('era5')
+        assert era5_cache.root == tmp_path / 'cache' / 'era5'
+        assert era5_cache.max_bytes == 2 * 1024**3
+        assert cache.get_cache('int') is None
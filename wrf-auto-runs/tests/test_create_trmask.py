@@ -113,6 +113,18 @@ class TestCreateTrmaskBbox:
         expected[2:7, 5:] = 1.0  # rows 2..6 AND ocean half (cols 5..9)
         np.testing.assert_array_equal(mask, expected)
 
+    def test_bbox_outside_domain_warns(self, mock_params, tmp_path, capsys):
+        _write_fake_geo_em(tmp_path / 'geo_em.d01.nc')
+        _configure(
+            mock_params,
+            {'mask_type': 'ocean', 'relax_width': 0, 'min_lat': 10.0, 'max_lat': 20.0, 'min_lon': -20.0, 'max_lon': -10.0},
+        )
+
+        create_trmask([1], START)
+
+        assert 'does not overlap domain d01' in capsys.readouterr().out
+        assert not _read_trmask(tmp_path / 'trmask_d01').any()
+
     def test_all_plus_bbox_reproduces_old_bbox(self, mock_params, tmp_path):
         """mask_type='all' + bbox should equal the old bbox-only behavior."""
         _write_fake_geo_em(tmp_path / 'geo_em.d01.nc')
@@ -0,0 +1,48 @@
+import h5netcdf
+import numpy as np
+
+import utils
+from run_geogrid import domain_bbox
+
+
+def _write_geo_em(path, lon0, lon1, lat0, lat1, bulge=0.0):
+    """geo_em-like file on a lon/lat mesh whose north edge bows up by bulge degrees mid-domain."""
+    lon = np.linspace(lon0, lon1, 20)
+    lat = np.linspace(lat0, lat1, 10)
+    lon2d, lat2d = np.meshgrid(lon, lat)
+    lat2d = lat2d + bulge * np.sin(np.linspace(0, np.pi, 20))[None, :] * np.linspace(0, 1, 10)[:, None]
+    lon2d = np.where(lon2d > 180, lon2d - 360, lon2d)
+    with h5netcdf.File(path, 'w') as f:
+        f.dimensions = {'Time': 1, 'south_north': 10, 'west_east': 20}
+        f.create_variable('XLAT_M', ('Time', 'south_north', 'west_east'), data=lat2d[None].astype('f4'))
+        f.create_variable('XLONG_M', ('Time', 'south_north', 'west_east'), data=lon2d[None].astype('f4'))
+
+
+class TestDomainBbox:
+    def test_ring_with_curved_edge(self, tmp_path):
+        _write_geo_em(tmp_path / 'geo_em.nc', 160.2, 179.6, -50.3, -30.4, bulge=2.0)
+
+        assert domain_bbox(tmp_path / 'geo_em.nc', pad=0.5) == (159, -51, 181, -27)
+
+    def test_dateline_crossing_stays_contiguous(self, tmp_path):
+        _write_geo_em(tmp_path / 'geo_em.nc', 165.0, 195.0, -50.0, -30.0)
+
+        assert domain_bbox(tmp_path / 'geo_em.nc', pad=0.5) == (164, -51, 196, -29)
+
+    def test_prime_meridian_crossing(self, tmp_path):
+        _write_geo_em(tmp_path / 'geo_em.nc', 350.0, 370.0, 40.0, 50.0)
+
+        min_lon, _, max_lon, _ = domain_bbox(tmp_path / 'geo_em.nc', pad=0.5)
+
+        assert (min_lon, max_lon) == (349, 371)
+        assert utils.lon_ranges(min_lon, max_lon) == [(349, 360), (0, 11)]
+
+
+class TestLonRanges:
+    def test_single_range(self):
+        assert utils.lon_ranges(160, 185, -180) == [(160, 180), (-180, -175)]
+        assert utils.lon_ranges(160, 175, -180) == [(160, 175)]
+        assert utils.lon_ranges(160, 185) == [(160, 185)]
+
+    def test_full_ring(self):
+        assert utils.lon_ranges(0, 360, -180) == [(-180, 180)]
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+import utils
+from domain_tree import DomainTree
+
+
+def _tree(mock_params):
+    return DomainTree(mock_params['domains'])
+
+
+class TestDomainTree:
+    def test_nest_spacing_and_chain(self, mock_params):
+        tree = _tree(mock_params)
+
+        np.testing.assert_allclose(tree.dx, [27000, 9000, 3000])
+        assert tree.depth.tolist() == [0, 1, 2]
+        assert tree.chain(3) == [1, 2, 3]
+        assert tree.chain(1) == [1]
+        np.testing.assert_allclose(tree.x0[1], tree.x0[0] + 29 * 27000)
+
+    def test_bounds_are_nested(self, mock_params):
+        d01, d02, d03 = _tree(mock_params).bounds()
+
+        for outer, inner in ((d01, d02), (d02, d03)):
+            assert outer[0] < inner[0] and outer[1] < inner[1]
+            assert outer[2] > inner[2] and outer[3] > inner[3]
+        assert d01[0] < 170 < d01[2] and d01[1] < -40 < d01[3]
+
+    def test_bbox_matches_ring_rounding(self, mock_params):
+        tree = _tree(mock_params)
+        lon, lat = tree.boundary()
+
+        assert tree.bbox(2) == utils.ring_bbox(lon[1], lat[1], 0.5)
+
+    def test_subset_renumbers_nests(self, mock_params):
+        geogrid = mock_params['domains']
+        subset = _tree(mock_params).subset([2, 3])
+
+        assert subset['dx'] == 9000 and subset['dy'] == 9000
+        assert subset['parent_id'] == [1, 1]
+        assert subset['parent_grid_ratio'] == [1, 3]
+        assert subset['i_parent_start'] == [1, 10]
+        assert subset['e_we'] == [130, 160]
+        assert subset['geog_data_res'] == ['default', 'default']
+        assert geogrid['e_we'] == [100, 130, 160]
+
+    def test_reanchored_on_nest_centre(self, mock_params):
+        tree = _tree(mock_params)
+        subset = tree.subset([3], reanchor=True)
+        ref_lon, ref_lat = tree.proj_to_geo.transform(tree.x_center[2], tree.y_center[2])
+
+        assert subset['dx'] == 3000
+        assert subset['ref_lat'] == pytest.approx(ref_lat, abs=1e-6)
+        assert subset['ref_lon'] == pytest.approx(ref_lon, abs=1e-6)
+        assert subset['truelat1'] == subset['truelat2'] == subset['ref_lat']
+        assert subset['stand_lon'] == subset['ref_lon']
+
+        # The reanchored grid covers roughly the nest area (the projection changes with it)
+        single = DomainTree(subset)
+        np.testing.assert_allclose(single.bounds()[0], tree.bounds()[2], atol=0.2)
+
+    def test_parent_must_come_first(self, mock_params):
+        mock_params['domains']['parent_id'] = [1, 3, 2]
+
+        with pytest.raises(ValueError, match='earlier domain'):
+            _tree(mock_params)
@@ -0,0 +1,189 @@
+import datetime
+
+import h5netcdf
+import numpy as np
+import pytest
+
+import cache
+import download_era5
+import params
+import utils
+
+
+PL_KEY = 'e5.oper.an.pl/202001/e5.oper.an.pl.128_130_t.ll025sc.2020010100_2020010123.nc'
+INV_KEY = 'e5.oper.invariant/197901/e5.oper.invariant.128_172_lsm.ll025sc.1979010100_1979010100.nc'
+BBOX = (160, -50, 185, -30)
+
+
+def _write_era5(path):
+    """Hourly ERA5-like file for 2020-01-01 with a compressed, chunked variable."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with h5netcdf.File(path, 'w') as nc:
+        nc.dimensions = {'time': 24, 'level': 2, 'latitude': 3, 'longitude': 4}
+        nc.attrs['DATA_SOURCE'] = 'ERA5'
+        time = nc.create_variable('time', ('time',), data=np.arange(1051896, 1051920, dtype='int32'))
+        time.attrs['units'] = 'hours since 1900-01-01 00:00:00'
+        nc.create_variable('level', ('level',), data=np.array([1000, 30], dtype='float64'))
+        nc.create_variable('latitude', ('latitude',), data=np.array([-30, -40, -50], dtype='float64'))
+        data = np.arange(24 * 2 * 3 * 4, dtype='float32').reshape(24, 2, 3, 4)
+        var = nc.create_variable('T', ('time', 'level', 'latitude', 'longitude'), data=data,
+                                 compression='gzip', chunks=(24, 1, 3, 4), fillvalue=np.float32(9999))
+        var.attrs['units'] = 'K'
+
+
+def _times(start_hour, end_hour, step):
+    return list(utils.wps_timestamps(datetime.datetime(2020, 1, 1, start_hour),
+                                     datetime.datetime(2020, 1, 1, end_hour), step))
+
+
+class TestThinFile:
+    def test_keeps_only_requested_times(self, tmp_path):
+        path = tmp_path / 'pl.nc'
+        _write_era5(path)
+
+        assert download_era5.thin_file(path, download_era5._time_strs(_times(6, 12, 6)))
+
+        with h5netcdf.File(path, 'r') as nc:
+            assert nc.dimensions['time'].size == 2
+            assert download_era5._file_times(nc) == ['2020010106', '2020010112']
+            assert nc['T'].compression == 'gzip'
+            assert nc['T'].attrs['units'] == 'K'
+            assert nc.attrs['DATA_SOURCE'] == 'ERA5'
+            np.testing.assert_array_equal(nc['T'][1], np.arange(288, 312, dtype='float32').reshape(2, 3, 4))
+            np.testing.assert_array_equal(nc['latitude'][:], [-30, -40, -50])
+
+    def test_all_times_needed_leaves_file(self, tmp_path):
+        path = tmp_path / 'pl.nc'
+        _write_era5(path)
+        before = path.read_bytes()
+
+        assert not download_era5.thin_file(path, download_era5._time_strs(_times(0, 23, 1)))
+        assert path.read_bytes() == before
+
+
+    def test_prunes_levels_above_min_level(self, tmp_path):
+        path = tmp_path / 'pl.nc'
+        _write_era5(path)
+
+        assert download_era5.thin_file(path, min_level=50)
+
+        with h5netcdf.File(path, 'r') as nc:
+            assert nc.dimensions['time'].size == 24
+            np.testing.assert_array_equal(nc['level'][:], [1000])
+            np.testing.assert_array_equal(nc['T'][1, 0], np.arange(24, 36, dtype='float32').reshape(3, 4))
+
+
+class TestLevelMin:
+    def test_first_level_above_p_top_plus_margin(self, mock_params):
+        mock_params['domains']['p_top_requested'] = 5000
+        assert download_era5.level_min() == 20
+
+        mock_params['input'] = {'era5': {'level_margin': 0}}
+        assert download_era5.level_min() == 30
+
+        mock_params['input'] = {'era5': {'prune_levels': False}}
+        assert download_era5.level_min() is None
+
+
+class TestCachedHours:
+    def test_entry_serves_subsets_of_its_hours(self, mock_params, monkeypatch, tmp_path):
+        monkeypatch.setattr(params, 'cache_path', tmp_path / 'cache')
+        era5_cache = cache.get_cache('era5')
+        staged = tmp_path / 'staging' / PL_KEY
+        _write_era5(staged)
+        hours = download_era5._key_hours(PL_KEY, _times(0, 18, 6))
+        download_era5.thin_file(staged, hours)
+        era5_cache.publish(f'{download_era5._cache_prefix(PL_KEY)}/{cache.hash_key(BBOX, hours)[:16]}',
+                           {PL_KEY: staged}, {'source_key': PL_KEY, 'bbox': list(BBOX), 'hours': hours})
+
+        out = tmp_path / 'era5'
+        assert download_era5._link_cached(era5_cache, [PL_KEY], BBOX, out, _times(6, 12, 6)) == []
+        assert (out / PL_KEY).exists()
+        assert download_era5._link_cached(era5_cache, [PL_KEY], BBOX, out, _times(0, 21, 3)) == [PL_KEY]
+
+    def test_pruned_entry_needs_enough_levels(self):
+        meta = {'bbox': list(BBOX), 'hours': None, 'level_min': 20}
+
+        assert download_era5._covers(meta, BBOX, None, 30)
+        assert not download_era5._covers(meta, BBOX, None, 10)
+        assert not download_era5._covers(meta, BBOX, None, None)
+
+    def test_invariant_files_are_not_thinned(self):
+        assert download_era5._key_hours(INV_KEY, _times(0, 18, 6)) is None
+        assert download_era5._key_hours(PL_KEY, _times(0, 18, 6)) == ['2020010100', '2020010106',
+                                                                     '2020010112', '2020010118']
+
+
+def _write_global(path, day=None):
+    """Global 5-degree ERA5-like file: hourly for 2020-01-{day}, or one invariant time."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    n_time = 24 if day else 1
+    with h5netcdf.File(path, 'w') as nc:
+        nc.dimensions = {'time': n_time, 'level': 3, 'latitude': 37, 'longitude': 72}
+        first = 1051896 + 24 * (day - 1) if day else 692496
+        nc.create_variable('time', ('time',), data=np.arange(first, first + n_time, dtype='int32')).attrs['units'] = \
+            'hours since 1900-01-01 00:00:00'
+        nc.create_variable('level', ('level',), data=np.array([1, 500, 1000], dtype='float64'))
+        nc.create_variable('latitude', ('latitude',), data=np.linspace(90, -90, 37))
+        nc.create_variable('longitude', ('longitude',), data=np.arange(0, 360, 5, dtype='float64'))
+        data = np.arange(n_time * 3 * 37 * 72, dtype='float32').reshape(n_time, 3, 37, 72)
+        nc.create_variable('T', ('time', 'level', 'latitude', 'longitude'), data=data,
+                           compression='gzip', chunks=(1, 1, 37, 72))
+
+
+class TestArchive:
+    CODES = {'e5.oper.an.pl': ('128_130_t',), 'e5.oper.an.sfc': ('128_134_sp',), 'e5.oper.invariant': ('128_172_lsm',)}
+    FILES = {PL_KEY: 1, INV_KEY: None,
+             'e5.oper.an.pl/202001/e5.oper.an.pl.128_130_t.ll025sc.2020010200_2020010223.nc': 2,
+             'e5.oper.an.pl/202001/e5.oper.an.pl.128_130_t.ll025sc.2020010300_2020010323.nc': 3,
+             'e5.oper.an.sfc/202001/e5.oper.an.sfc.128_134_sp.ll025sc.2020010100_2020013123.nc': None}
+
+    def _archive(self, root, write=False):
+        for rel, day in self.FILES.items():
+            root.joinpath(rel).parent.mkdir(parents=True, exist_ok=True)
+            if write:
+                _write_global(root.joinpath(rel), day)
+            else:
+                root.joinpath(rel).write_bytes(b'nc')
+
+    def test_reads_only_the_needed_slabs(self, mock_params, monkeypatch, tmp_path):
+        monkeypatch.setattr(download_era5.defaults, 'ERA5_FILE_CODES', self.CODES)
+        mock_params['input'] = {'era5_local': {'path': str(tmp_path / 'archive')}}
+        self._archive(tmp_path / 'archive', write=True)
+
+        download_era5.subset_era5_archive(datetime.datetime(2020, 1, 1, 6), datetime.datetime(2020, 1, 2, 18),
+                                          *BBOX, hour_interval=6)
+
+        out = tmp_path / 'era5'
+        names = sorted(str(p.relative_to(out)) for p in out.rglob('*.nc'))
+        assert len(names) == 4
+        assert not any('2020010300' in name for name in names)
+        assert not any(p.is_symlink() for p in out.rglob('*.nc'))
+
+        with h5netcdf.File(out / PL_KEY, 'r') as nc:
+            assert download_era5._file_times(nc) == ['2020010106', '2020010112', '2020010118']
+            assert np.asarray(nc['level'][:]).tolist() == [500, 1000]
+            lat = np.asarray(nc['latitude'][:])
+            lon = np.asarray(nc['longitude'][:])
+            assert (lat.max(), lat.min()) == (-25, -55)
+            assert (lon.min(), lon.max()) == (155, 190)
+            with h5netcdf.File(tmp_path / 'archive' / PL_KEY, 'r') as src:
+                expected = np.asarray(src['T'][6:24:6, 1:, 23:30, 31:39])
+            np.testing.assert_array_equal(np.asarray(nc['T'][:]), expected)
+
+        utils.check_input_extent('era5', *BBOX)
+
+    def test_intermediates_are_keyed_on_the_bbox(self, mock_params, tmp_path):
+        from run_era5_to_int import era5_int_source
+        mock_params['input'] = {'era5_local': {'path': str(tmp_path / 'archive')}}
+
+        assert era5_int_source(*BBOX)['source'] == 'era5_local'
+        assert era5_int_source(*BBOX) != era5_int_source(150, -50, 185, -30)
+
+    def test_missing_days_are_reported(self, mock_params, monkeypatch, tmp_path):
+        monkeypatch.setattr(download_era5.defaults, 'ERA5_FILE_CODES', self.CODES)
+        mock_params['input'] = {'era5_local': {'path': str(tmp_path / 'archive')}}
+        self._archive(tmp_path / 'archive')
+
+        with pytest.raises(ValueError, match='128_130_t: 1 day'):
+            download_era5.subset_era5_archive(datetime.datetime(2020, 1, 3), datetime.datetime(2020, 1, 4), *BBOX)
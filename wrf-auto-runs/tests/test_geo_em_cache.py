@@ -0,0 +1,63 @@
+import f90nml
+import pytest
+
+import params
+from run_geogrid import geo_em_keys
+from set_params import set_nml_params
+
+
+@pytest.fixture()
+def wps_env(mock_params, tmp_path):
+    tbl_dir = tmp_path / 'WPS' / 'geogrid'
+    tbl_dir.mkdir(parents=True)
+    tbl_dir.joinpath('GEOGRID.TBL').write_text('name = HGT_M\n')
+    (tmp_path / 'WPS_GEOG' / 'topo_gmted2010_30s').mkdir(parents=True)
+    return mock_params
+
+
+def _keys():
+    set_nml_params()
+    return geo_em_keys(f90nml.read(params.wps_nml_path))
+
+
+class TestGeoEmKeys:
+    def test_one_key_per_domain(self, wps_env):
+        keys = _keys()
+        assert sorted(keys) == [1, 2, 3]
+        assert len(set(keys.values())) == 3
+
+    def test_keys_are_stable(self, wps_env):
+        assert _keys() == _keys()
+
+    def test_leaf_change_only_affects_leaf(self, wps_env):
+        before = _keys()
+        wps_env['domains']['e_we'] = [100, 130, 170]
+        after = _keys()
+
+        assert before[1] == after[1]
+        assert before[2] == after[2]
+        assert before[3] != after[3]
+
+    def test_parent_change_propagates_to_children(self, wps_env):
+        before = _keys()
+        wps_env['domains']['i_parent_start'] = [1, 31, 10]
+        after = _keys()
+
+        assert before[1] == after[1]
+        assert before[2] != after[2]
+        assert before[3] != after[3]
+
+    def test_geog_data_res_is_per_domain(self, wps_env):
+        before = _keys()
+        wps_env['domains']['geog_data_res'] = ['default', 'default', 'modis_15s_lake+default']
+        after = _keys()
+
+        assert before[2] == after[2]
+        assert before[3] != after[3]
+
+    def test_geogrid_tbl_change_affects_all(self, wps_env, tmp_path):
+        before = _keys()
+        tmp_path.joinpath('WPS', 'geogrid', 'GEOGRID.TBL').write_text('name = LANDUSEF\n')
+        after = _keys()
+
+        assert all(before[d] != after[d] for d in before)
@@ -0,0 +1,80 @@
+import multiprocessing
+import threading
+
+import governor
+import params
+import storage
+
+
+def _hold(path, n, held, release):
+    slots = governor.TransferSlots(path, 'era5', 3)
+    with slots.acquire(n):
+        held.set()
+        release.wait(10)
+
+
+class TestTransferSlots:
+    def test_other_task_gets_the_remaining_slots(self, tmp_path):
+        ctx = multiprocessing.get_context('fork')
+        held, release = ctx.Event(), ctx.Event()
+        task = ctx.Process(target=_hold, args=(tmp_path, 2, held, release))
+        task.start()
+        try:
+            assert held.wait(10)
+            slots = governor.TransferSlots(tmp_path, 'era5', 3)
+            with slots.acquire(3) as n:
+                assert n == 1
+        finally:
+            release.set()
+            task.join()
+
+        with slots.acquire(3) as n:
+            assert n == 3
+
+    def test_threads_wait_for_a_free_slot(self, tmp_path):
+        slots = governor.TransferSlots(tmp_path, 'sst', 2, poll=0.01)
+        active = []
+        peak = []
+        guard = threading.Lock()
+
+        def transfer():
+            with slots.acquire(1):
+                with guard:
+                    active.append(1)
+                    peak.append(len(active))
+                threading.Event().wait(0.05)
+                with guard:
+                    active.pop()
+
+        threads = [threading.Thread(target=transfer) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(peak) == 6
+        assert max(peak) == 2
+
+
+class TestSlots:
+    def test_no_cap_without_max_transfers(self, mock_params):
+        with governor.slots('era5').acquire(4) as n:
+            assert n == 4
+
+    def test_per_remote_table(self, mock_params, monkeypatch, tmp_path):
+        monkeypatch.setitem(params.file, 'storage', {'max_transfers': {'output': 2}, 'slots_path': str(tmp_path / 'slots')})
+
+        assert isinstance(governor.slots('era5'), governor._Unlimited)
+        with governor.slots('output').acquire(8) as n:
+            assert n == 2
+
+    def test_storage_transfers_take_slots(self, mock_params, monkeypatch, tmp_path):
+        monkeypatch.setitem(params.file, 'storage', {'max_transfers': 1, 'slots_path': str(tmp_path / 'slots')})
+        (tmp_path / 'remote').mkdir()
+        (tmp_path / 'remote' / 'a.nc').write_bytes(b'abc')
+        store = storage.get_storage('sst', {'type': 'local', 'path': str(tmp_path / 'remote')})
+
+        assert isinstance(store, storage.GovernedStorage)
+        assert store.download(['a.nc'], tmp_path / 'local') == {}
+        assert (tmp_path / 'local' / 'a.nc').read_bytes() == b'abc'
+        assert (tmp_path / 'slots' / 'sst' / 'slot_000.lock').exists()
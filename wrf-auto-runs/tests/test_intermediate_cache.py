@@ -0,0 +1,61 @@
+import datetime
+
+import params
+import utils
+
+
+def _ts(day, hour):
+    return datetime.datetime(2020, 1, day, hour)
+
+
+class TestContiguousRuns:
+    def test_single_run(self):
+        ts = [_ts(1, 0), _ts(1, 3), _ts(1, 6)]
+        assert utils.contiguous_runs(ts, 3) == [(_ts(1, 0), _ts(1, 6))]
+
+    def test_gaps_split_runs(self):
+        ts = [_ts(1, 0), _ts(1, 3), _ts(1, 12), _ts(2, 0)]
+        assert utils.contiguous_runs(ts, 3) == [
+            (_ts(1, 0), _ts(1, 3)),
+            (_ts(1, 12), _ts(1, 12)),
+            (_ts(2, 0), _ts(2, 0)),
+        ]
+
+    def test_empty(self):
+        assert utils.contiguous_runs([], 6) == []
+
+
+class TestIntermediateCache:
+    SOURCE = {'source': 'era5', 'bbox': [160, -50, 185, -30], 'skip_vars': None}
+
+    def test_no_cache_everything_missing(self, mock_params, monkeypatch):
+        monkeypatch.setattr(params, 'cache_path', None)
+        ts = list(utils.wps_timestamps(_ts(1, 0), _ts(1, 12), 6))
+
+        assert utils.link_cached_intermediates('ERA5', self.SOURCE, ts) == ts
+
+    def test_publish_then_link(self, mock_params, monkeypatch, tmp_path):
+        monkeypatch.setattr(params, 'cache_path', tmp_path / 'cache')
+        ts = list(utils.wps_timestamps(_ts(1, 0), _ts(1, 12), 6))
+
+        for t in ts[:2]:
+            tmp_path.joinpath(f'ERA5:{t:%Y-%m-%d_%H}').write_bytes(b'int')
+        utils.publish_intermediates('ERA5', self.SOURCE, ts[:2])
+
+        for path in tmp_path.glob('ERA5:*'):
+            path.unlink()
+
+        missing = utils.link_cached_intermediates('ERA5', self.SOURCE, ts)
+
+        assert missing == ts[2:]
+        assert sorted(p.name for p in tmp_path.glob('ERA5:*')) == ['ERA5:2020-01-01_00', 'ERA5:2020-01-01_06']
+
+    def test_source_is_part_of_key(self, mock_params, monkeypatch, tmp_path):
+        monkeypatch.setattr(params, 'cache_path', tmp_path / 'cache')
+        ts = [_ts(1, 0)]
+        tmp_path.joinpath('ERA5:2020-01-01_00').write_bytes(b'int')
+        utils.publish_intermediates('ERA5', self.SOURCE, ts)
+
+        other = dict(self.SOURCE, skip_vars='SST,SEAICE')
+
+        assert utils.link_cached_intermediates('ERA5', other, ts) == ts
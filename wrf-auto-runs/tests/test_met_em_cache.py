@@ -0,0 +1,76 @@
+import f90nml
+import pytest
+
+import params
+import utils
+from run_metgrid import met_em_keys
+from set_params import set_nml_params
+
+
+@pytest.fixture()
+def metgrid_env(mock_params, tmp_path):
+    tbl_dir = tmp_path / 'WPS' / 'metgrid'
+    tbl_dir.mkdir(parents=True)
+    tbl_dir.joinpath('METGRID.TBL').write_text('name = TT\n')
+    mock_params['time_control']['duration_hours'] = 12
+
+    start, end, hour_interval, _ = set_nml_params()
+    for domain in (1, 2, 3):
+        tmp_path.joinpath(f'geo_em.d{domain:02d}.nc').write_bytes(f'geo{domain}'.encode())
+    for ts in utils.wps_timestamps(start, end, hour_interval):
+        tmp_path.joinpath(f'ERA5:{ts:%Y-%m-%d_%H}').write_bytes(f'int {ts}'.encode())
+
+    return mock_params
+
+
+def _keys():
+    return met_em_keys(f90nml.read(params.wps_nml_path))
+
+
+class TestMetEmKeys:
+    def test_every_domain_every_time(self, metgrid_env):
+        names = sorted(_keys())
+
+        assert len(names) == 3 * 5
+        assert 'met_em.d01.2020-01-01_12:00:00.nc' in names
+        assert 'met_em.d02.2020-01-01_00:00:00.nc' in names
+        assert 'met_em.d03.2020-01-01_03:00:00.nc' in names
+
+    def test_nest_window_from_its_own_dates(self, metgrid_env):
+        wps_nml = f90nml.read(params.wps_nml_path)
+        wps_nml['share']['start_date'][2] = '2020-01-01_06:00:00'
+        names = sorted(met_em_keys(wps_nml))
+
+        assert 'met_em.d03.2020-01-01_03:00:00.nc' not in names
+        assert 'met_em.d03.2020-01-01_06:00:00.nc' in names
+        assert len(names) == 5 + 5 + 3
+
+    def test_physics_change_keeps_keys(self, metgrid_env):
+        before = _keys()
+        metgrid_env['physics'] = {'mp_physics': 8}
+        set_nml_params()
+
+        assert _keys() == before
+
+    def test_intermediate_change_only_affects_its_time(self, metgrid_env, tmp_path):
+        before = _keys()
+        tmp_path.joinpath('ERA5:2020-01-01_06').write_bytes(b'changed')
+        after = _keys()
+
+        changed = sorted(name for name in before if before[name] != after[name])
+        assert changed == [f'met_em.d0{domain}.2020-01-01_06:00:00.nc' for domain in (1, 2, 3)]
+
+    def test_geo_em_change_only_affects_its_domain(self, metgrid_env, tmp_path):
+        before = _keys()
+        tmp_path.joinpath('geo_em.d03.nc').write_bytes(b'changed')
+        after = _keys()
+
+        changed = sorted(name for name in before if before[name] != after[name])
+        assert changed == [f'met_em.d03.2020-01-01_{hour:02d}:00:00.nc' for hour in (0, 3, 6, 9, 12)]
+
+    def test_metgrid_tbl_change_affects_all(self, metgrid_env, tmp_path):
+        before = _keys()
+        tmp_path.joinpath('WPS', 'metgrid', 'METGRID.TBL').write_text('name = UU\n')
+        after = _keys()
+
+        assert all(before[name] != after[name] for name in before)
@@ -0,0 +1,86 @@
+import datetime
+
+import h5netcdf
+import numpy as np
+import pytest
+
+import meta_index
+import run_wrf_to_int
+import utils
+
+
+def _write_era5(path, lon0=160.0, lon1=185.0, hours=(0, 6)):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with h5netcdf.File(path, 'w') as f:
+        f.dimensions = {'time': len(hours), 'latitude': 5, 'longitude': 6}
+        f.create_variable('time', ('time',), data=np.array(hours, 'f8')).attrs['units'] = 'hours since 2020-01-01 00:00:00'
+        f.create_variable('latitude', ('latitude',), data=np.linspace(-30, -50, 5))
+        f.create_variable('longitude', ('longitude',), data=np.linspace(lon0, lon1, 6))
+        f.create_variable('VAR_2T', ('time', 'latitude', 'longitude'), data=np.zeros((len(hours), 5, 6), 'f4'))
+
+
+def _write_wrfout(path, times, n_eta=40, p_top=5000.0):
+    with h5netcdf.File(path, 'w') as f:
+        f.dimensions = {'Time': len(times), 'DateStrLen': 19, 'south_north': 4, 'west_east': 4, 'bottom_top': n_eta}
+        chars = np.array([list(t.encode()) for t in times], 'u1').view('S1')
+        f.create_variable('Times', ('Time', 'DateStrLen'), data=chars)
+        lat, lon = np.meshgrid(np.linspace(-50, -30, 4), np.linspace(160, 185, 4), indexing='ij')
+        f.create_variable('XLAT', ('Time', 'south_north', 'west_east'), data=np.repeat(lat[None], len(times), 0))
+        f.create_variable('XLONG', ('Time', 'south_north', 'west_east'), data=np.repeat(lon[None], len(times), 0))
+        f.create_variable('P_TOP', ('Time',), data=np.full(len(times), p_top))
+
+
+class TestScanDir:
+    def test_headers_are_read_once(self, tmp_path, monkeypatch):
+        _write_era5(tmp_path / 'e5.oper.an.sfc' / 'a.nc')
+        _write_era5(tmp_path / 'e5.oper.an.sfc' / 'b.nc', hours=(12, 18))
+
+        metas = meta_index.scan_dir(tmp_path, '**/*.nc')
+        assert metas['e5.oper.an.sfc/b.nc']['times'] == ['2020-01-01_12:00:00', '2020-01-01_18:00:00']
+        assert metas['e5.oper.an.sfc/a.nc']['extent'] == [160.0, -50.0, 185.0, -30.0]
+        assert (tmp_path / meta_index.INDEX_NAME).exists()
+
+        reads = []
+        monkeypatch.setattr(meta_index, 'read_meta', lambda path: reads.append(path) or {'times': []})
+        _write_era5(tmp_path / 'e5.oper.an.sfc' / 'c.nc')
+        (tmp_path / 'e5.oper.an.sfc' / 'a.nc').unlink()
+
+        metas = meta_index.scan_dir(tmp_path, '**/*.nc')
+        assert reads == [tmp_path / 'e5.oper.an.sfc' / 'c.nc']
+        assert sorted(metas) == ['e5.oper.an.sfc/b.nc', 'e5.oper.an.sfc/c.nc']
+
+    def test_disagreeing_files(self, tmp_path):
+        _write_wrfout(tmp_path / 'wrfout_d02_a.nc', ['2020-01-01_00:00:00'])
+        _write_wrfout(tmp_path / 'wrfout_d02_b.nc', ['2020-01-02_00:00:00'], n_eta=33)
+
+        with pytest.raises(ValueError, match='disagree on levels'):
+            run_wrf_to_int._compute_pressure_levels(tmp_path)
+        assert run_wrf_to_int._compute_pressure_levels(tmp_path, 'wrfout_d02_a.nc').startswith('1000,')
+
+
+class TestChecks:
+    def test_every_era5_file_is_checked(self, mock_params, tmp_path):
+        _write_era5(tmp_path / 'era5' / 'e5.oper.an.sfc' / 'a.nc')
+        _write_era5(tmp_path / 'era5' / 'e5.oper.an.pl' / 'b.nc', lon1=175.0)
+
+        with pytest.raises(ValueError, match=r'e5.oper.an.pl/b.nc .*\n.*\n  - lon east of 175.0'):
+            utils.check_input_extent('era5', 160, -50, 185, -30)
+        utils.check_input_extent('era5', 160, -50, 174, -30)
+
+    def test_wrfout_times(self, mock_params, tmp_path):
+        wrfout_path = tmp_path / 'wrfout'
+        wrfout_path.mkdir()
+        _write_wrfout(wrfout_path / 'wrfout_d02_2020-01-01.nc', ['2020-01-01_00:00:00', '2020-01-01_06:00:00'])
+        times = [datetime.datetime(2020, 1, 1, h) for h in (0, 6, 12)]
+
+        with pytest.raises(ValueError, match='lack 1 valid time.*2020-01-01_12:00:00'):
+            run_wrf_to_int._check_wrfout(wrfout_path, 'wrfout_d02_2020-01-01.nc', (160, -50, 185, -30), times)
+        assert run_wrf_to_int._check_wrfout(wrfout_path, 'wrfout_d02_2020-01-01.nc', (160, -50, 185, -30), times[:2])
+
+    def test_uniform(self):
+        metas = {'a': {'p_top': 5000.0}, 'b': {'p_top': 5000.0}}
+        assert meta_index.uniform(metas, 'p_top', 'wrfout') == 5000.0
+
+        metas['c'] = {'p_top': 1000.0}
+        with pytest.raises(ValueError, match='c'):
+            meta_index.uniform(metas, 'p_top', 'wrfout')
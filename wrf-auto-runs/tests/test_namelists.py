@@ -0,0 +1,69 @@
+import copy
+import datetime
+import io
+
+import f90nml
+
+import prefetch
+from namelists import NamelistConfig, build_namelists
+from set_params import set_nml_params
+
+
+def _text(nml):
+    buf = io.StringIO()
+    nml.write(buf)
+    return buf.getvalue()
+
+
+class TestBuildNamelists:
+    def test_no_side_effects(self, mock_params, tmp_path):
+        before = copy.deepcopy(mock_params)
+        domains = [2, 1]
+
+        nml = build_namelists(NamelistConfig.from_params(), '2020-03-01 00:00:00', '2020-03-02 00:00:00', domains)
+
+        assert mock_params == before
+        assert domains == [2, 1]
+        assert not (tmp_path / 'namelist.wps').exists()
+        assert not (tmp_path / 'namelist.input').exists()
+        assert nml.wps['share']['max_dom'] == 2
+        assert nml.wps['share']['start_date'] == ['2020-03-01_00:00:00'] * 2
+        assert nml.wrf['time_control']['end_day'] == [2, 2]
+
+    def test_period_and_outputs(self, mock_params):
+        nml = build_namelists(NamelistConfig.from_params(), datetime.datetime(2020, 5, 1), datetime.datetime(2020, 5, 4), [3])
+
+        assert (nml.start_date, nml.end_date, nml.interval_hours) == (datetime.datetime(2020, 5, 1), datetime.datetime(2020, 5, 4), 3)
+        assert nml.output_files == [f'wrfout_d01_2020-05-0{day}_00:00:00.nc' for day in (1, 2, 3)]
+        assert nml.wps['geogrid']['dx'] == 3000
+
+    def test_written_namelists_match(self, mock_params, tmp_path):
+        nml = build_namelists(NamelistConfig.from_params(), domains=[1, 2])
+        set_nml_params([1, 2])
+
+        wps_nml, wrf_nml = nml.to_f90nml()
+
+        assert (tmp_path / 'namelist.wps').read_text() == _text(wps_nml)
+        assert (tmp_path / 'namelist.input').read_text() == _text(wrf_nml)
+        assert f90nml.read(tmp_path / 'namelist.input')['domains']['max_dom'] == 2
+
+    def test_ndown_state(self, mock_params):
+        nml = build_namelists(NamelistConfig.from_params(), domains=[2, 3], ndown_interval_seconds=3600)
+
+        assert nml.wrf['bdy_control']['have_bcs_moist'] is True
+        assert nml.wrf['time_control']['io_form_auxinput2'] == 2
+        assert nml.wrf['time_control']['interval_seconds'] == 3600
+        assert nml.wps['share']['interval_seconds'] == 10800
+
+
+class TestInputWindows:
+    def test_windows_leave_params_alone(self, mock_params, tmp_path):
+        before = copy.deepcopy(mock_params)
+        periods = [('2020-01-01 00:00:00', '2020-01-03 00:00:00'), ('2020-02-01 00:00:00', '2020-02-02 00:00:00')]
+
+        windows = prefetch.input_windows(periods, [1, 2])
+
+        assert windows == [(datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 3), 3),
+                           (datetime.datetime(2020, 2, 1), datetime.datetime(2020, 2, 2), 3)]
+        assert mock_params == before
+        assert not (tmp_path / 'namelist.input').exists()
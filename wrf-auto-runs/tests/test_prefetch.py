@@ -0,0 +1,84 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import prefetch
+import utils
+from domain_tree import DomainTree
+
+
+def _dt(day, hour=0):
+    return datetime.datetime(2020, 1, day, hour)
+
+
+class TestPeriods:
+    def test_read_periods(self, tmp_path):
+        csv_path = tmp_path / 'periods.csv'
+        csv_path.write_text('start_date,end_date\n2020-01-01 00:00:00,2020-01-03 00:00:00\r\n'
+                            '2020-01-03 00:00:00,2020-01-05 00:00:00\n')
+
+        assert prefetch.read_periods(csv_path) == [('2020-01-01 00:00:00', '2020-01-03 00:00:00'),
+                                                   ('2020-01-03 00:00:00', '2020-01-05 00:00:00')]
+
+
+class TestMergeWindows:
+    def test_back_to_back_periods_form_one_span(self):
+        windows = [(_dt(2, 18), _dt(5), 6), (_dt(1), _dt(3), 6), (_dt(10), _dt(12), 6)]
+
+        assert prefetch.merge_windows(windows) == [(_dt(1), _dt(5), 6), (_dt(10), _dt(12), 6)]
+
+    def test_off_grid_start_falls_back_to_hourly(self):
+        windows = [(_dt(1), _dt(3), 6), (_dt(2, 3), _dt(4), 6)]
+
+        assert prefetch.merge_windows(windows) == [(_dt(1), _dt(4), 1)]
+
+
+def _mass_ring_bbox(tree, domain, pad=0.5):
+    """Bbox main.py takes from the outer ring of a geo_em mass grid (XLONG_M/XLAT_M)."""
+    d = domain - 1
+    x = tree.x0[d] + (np.arange(tree.e_we[d] - 1) + 0.5) * tree.dx[d]
+    y = tree.y0[d] + (np.arange(tree.e_sn[d] - 1) + 0.5) * tree.dy[d]
+    xx, yy = np.meshgrid(x, y)
+    edge = np.zeros(xx.shape, dtype=bool)
+    edge[[0, -1], :] = True
+    edge[:, [0, -1]] = True
+    lon, lat = tree.proj_to_geo.transform(xx[edge], yy[edge])
+    return utils.ring_bbox(lon, lat, pad)
+
+
+class TestInputBbox:
+    @pytest.fixture
+    def no_geogrid(self, monkeypatch):
+        def fail(*args, **kwargs):
+            raise AssertionError('geogrid should not run')
+
+        monkeypatch.setattr(prefetch, 'set_geogrid_nml_params', fail)
+        monkeypatch.setattr(prefetch, 'run_geogrid', fail)
+
+    @pytest.mark.parametrize('domains_init', [[2, 3], [3], [1, 3]])
+    def test_bbox_is_the_top_domains_without_geogrid(self, mock_params, no_geogrid, domains_init):
+        tree = DomainTree(mock_params['domains'])
+
+        bbox = prefetch.input_bbox(3, domains_init)
+
+        assert bbox == tree.bbox(domains_init[0], 0.5)
+        min_lon, min_lat, max_lon, max_lat = _mass_ring_bbox(tree, domains_init[0])
+        assert bbox[0] <= min_lon and bbox[1] <= min_lat and bbox[2] >= max_lon and bbox[3] >= max_lat
+
+    def test_ndown_bbox_is_inside_the_parents(self, mock_params, no_geogrid):
+        outer = prefetch.input_bbox(3, [1, 2, 3])
+        inner = prefetch.input_bbox(3, [2, 3])
+
+        assert inner != outer
+        assert outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+    def test_lat_lon_runs_geogrid_like_main(self, mock_params, monkeypatch):
+        mock_params['domains']['map_proj'] = 'lat-lon'
+        calls = []
+        monkeypatch.setattr(prefetch, 'set_geogrid_nml_params', lambda domains: calls.append(('nml', domains)))
+        monkeypatch.setattr(prefetch, 'run_geogrid',
+                            lambda n, domains: calls.append(('geogrid', n, domains)) or (160, -50, 180, -30))
+
+        assert prefetch.input_bbox(3, [2, 3]) == (160, -50, 180, -30)
+        assert calls == [('nml', [2, 3]), ('geogrid', 3, [2, 3])]
@@ -0,0 +1,99 @@
+import datetime
+
+import pytest
+
+import defaults
+import params
+import preflight
+import storage
+
+
+START = datetime.datetime(2020, 1, 30)
+END = datetime.datetime(2020, 2, 1, 18)
+
+
+def _touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'nc')
+
+
+def _era5_remote(root, skip_day=None):
+    """Local ERA5 source laid out like the NCAR bucket, covering Jan-Feb 2020."""
+    for product, codes in defaults.ERA5_FILE_CODES.items():
+        for code in codes:
+            if 'invariant' in product:
+                _touch(root / product / '197901' / f'{product}.{code}.ll025sc.1979010100_1979010100.nc')
+            elif product.endswith('sfc'):
+                for month, last in (('202001', 31), ('202002', 29)):
+                    _touch(root / product / month / f'{product}.{code}.ll025sc.{month}0100_{month}{last}23.nc')
+            else:
+                for day in range(1, 32):
+                    if skip_day != (1, day):
+                        _touch(root / product / '202001' / f'{product}.{code}.ll025sc.202001{day:02d}00_202001{day:02d}23.nc')
+                if skip_day != (2, 1):
+                    _touch(root / product / '202002' / f'{product}.{code}.ll025sc.2020020100_2020020123.nc')
+
+
+@pytest.fixture()
+def era5_env(mock_params, monkeypatch, tmp_path):
+    monkeypatch.setattr(params, 'is_wrf_input', False)
+    monkeypatch.setattr(params, 'sst_source', 'era5')
+    monkeypatch.setattr(params, 'cache_path', None)
+    mock_params['remote'] = {'era5': {'type': 'local', 'path': str(tmp_path / 'era5')}}
+    return mock_params
+
+
+class TestChecks:
+    def test_era5_complete(self, era5_env, tmp_path):
+        _era5_remote(tmp_path / 'era5')
+
+        assert preflight.run_preflight(START, END)
+
+    def test_era5_missing_day_is_reported(self, era5_env, tmp_path):
+        _era5_remote(tmp_path / 'era5', skip_day=(1, 31))
+
+        with pytest.raises(ValueError, match='Pre-flight') as exc:
+            preflight.run_preflight(START, END)
+
+        assert 'e5.oper.an.pl 128_129_z is missing 1 day(s): 2020-01-31' in str(exc.value)
+
+    def test_wrf_and_ndown_inputs(self, mock_params, monkeypatch, tmp_path):
+        monkeypatch.setattr(params, 'is_wrf_input', True)
+        monkeypatch.setattr(params, 'cache_path', None)
+        mock_params['remote'] = {'wrf': {'type': 'local', 'path': str(tmp_path / 'wrf'), 'domain': 'd03'}}
+        mock_params['ndown'] = {'input': {'type': 'local', 'path': str(tmp_path / 'ndown')}}
+        for day in ('2020-01-30', '2020-01-31', '2020-02-01'):
+            _touch(tmp_path / 'wrf' / f'wrfout_d03_{day}_00:00:00.nc')
+        _touch(tmp_path / 'ndown' / 'wrfout_d02_2020-01-30_00:00:00.nc')
+
+        with pytest.raises(ValueError) as exc:
+            preflight.run_preflight(START, END, ndown_domain=2)
+
+        assert '[remote.wrf]' not in str(exc.value)
+        assert '[ndown.input] is missing 2 of 3 wrfout files' in str(exc.value)
+
+
+class TestRemoteIndex:
+    def test_listings_are_shared_within_ttl(self, mock_params, monkeypatch, tmp_path):
+        _touch(tmp_path / 'remote' / 'a' / 'x.nc')
+        remote_cfg = {'type': 'local', 'path': str(tmp_path / 'remote')}
+        calls = []
+
+        class Counting(storage.LocalStorage):
+            def list(self, prefix=''):
+                calls.append(prefix)
+                return super().list(prefix)
+
+        monkeypatch.setattr(storage, 'get_storage', lambda name, cfg: Counting(cfg['path']))
+
+        first = preflight.RemoteIndex(tmp_path / 'index.json', ttl=60)
+        assert first.list('r', remote_cfg, ['a']) == {'a': {'x.nc'}}
+
+        # A second task reading the same index file does not list again
+        second = preflight.RemoteIndex(tmp_path / 'index.json', ttl=60)
+        assert second.list('r', remote_cfg, ['a']) == {'a': {'x.nc'}}
+        assert calls == ['a']
+
+        expired = preflight.RemoteIndex(tmp_path / 'index.json', ttl=0)
+        expired.list('r', remote_cfg, ['a'])
+        assert calls == ['a', 'a']
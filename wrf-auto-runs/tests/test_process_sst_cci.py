@@ -0,0 +1,275 @@
+import datetime
+import pathlib
+
+import h5netcdf
+import numpy as np
+import pytest
+
+import params
+import process_sst_cci
+import storage
+from process_sst_cci import _download_days, resolve_cci_days
+
+
+def _name(day, variant):
+    return process_sst_cci._filename_for(day, variant)
+
+
+class CountingStorage(storage.LocalStorage):
+    """Local mirror that records list/download calls."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.calls = []
+
+    def list(self, prefix=''):
+        self.calls.append(('list', prefix))
+        return super().list(prefix)
+
+    def download(self, names, dest_dir, prefix='', transfers=None):
+        self.calls.append(('download', transfers))
+        return super().download(names, dest_dir, prefix, transfers)
+
+
+def _mirror_files(mirror, names_by_year):
+    for year, names in names_by_year.items():
+        for name in names:
+            path = mirror / str(year) / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b'nc')
+    return CountingStorage(mirror)
+
+
+@pytest.fixture()
+def days():
+    return [datetime.date(2021, 12, 31), datetime.date(2022, 1, 1), datetime.date(2022, 1, 2)]
+
+
+class TestResolveDays:
+    def test_one_listing_per_year_with_fallback(self, tmp_path, days):
+        store = _mirror_files(tmp_path / 'mirror', {
+            2021: [_name(days[0], 'CDR')],
+            2022: [_name(days[1], 'ICDR'), _name(days[2], 'CDR')],
+        })
+
+        rel_paths = resolve_cci_days(days, store)
+
+        assert store.calls == [('list', '2021'), ('list', '2022')]
+        assert rel_paths[days[0]] == f'2021/{_name(days[0], "CDR")}'
+        assert rel_paths[days[2]] == f'2022/{_name(days[2], "CDR")}'
+
+    def test_missing_days_are_all_reported(self, tmp_path, days):
+        store = _mirror_files(tmp_path / 'mirror', {2022: [_name(days[1], 'ICDR')]})
+
+        with pytest.raises(ValueError, match='2 day') as exc:
+            resolve_cci_days(days, store)
+
+        assert '2021-12-31' in str(exc.value)
+        assert '2022-01-02' in str(exc.value)
+
+
+class TestDownloadDays:
+    def test_single_batch(self, mock_params, tmp_path, days):
+        store = _mirror_files(tmp_path / 'mirror', {2021: [_name(days[0], 'CDR')], 2022: [_name(d, 'CDR') for d in days[1:]]})
+        mock_params['sst'] = {'transfers': 16}
+        rel_paths = {d: f'{d.year}/{_name(d, "CDR")}' for d in days}
+
+        local = _download_days(rel_paths, store, tmp_path / 'sst')
+
+        assert store.calls == [('download', 16)]
+        assert all(path.exists() for path in local.values())
+
+    def test_failed_days_name_the_error(self, mock_params, tmp_path, days):
+        store = _mirror_files(tmp_path / 'mirror', {2021: [_name(days[0], 'CDR')], 2022: [_name(d, 'CDR') for d in days[1:]]})
+        rel_paths = {d: f'{d.year}/{_name(d, "CDR")}' for d in days}
+        (tmp_path / 'mirror' / rel_paths[days[1]]).unlink()
+
+        with pytest.raises(ValueError, match='1 CCI SST day') as exc:
+            _download_days(rel_paths, store, tmp_path / 'sst')
+
+        assert '2022-01-01: ' in str(exc.value)
+        assert 'No such file' in str(exc.value)
+
+
+def _write_cci_file(path, day, lat, lon):
+    """Small CCI-shaped file: int16 packed SST / int8 ice with CF attributes."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    shape = (1, len(lat), len(lon))
+    with h5netcdf.File(str(path), 'w') as f:
+        f.dimensions = {'time': 1, 'lat': len(lat), 'lon': len(lon)}
+        f.create_variable('lat', ('lat',), data=lat.astype('f4'))
+        f.create_variable('lon', ('lon',), data=lon.astype('f4'))
+        sst = f.create_variable('analysed_sst', ('time', 'lat', 'lon'), dtype='i2',
+                                data=np.full(shape, day.day * 10, dtype='i2'))
+        sst.attrs['scale_factor'] = 0.01
+        sst.attrs['add_offset'] = 273.15
+        sst.attrs['_FillValue'] = np.int16(-32768)
+        ice = f.create_variable('sea_ice_fraction', ('time', 'lat', 'lon'), dtype='i1',
+                                data=np.zeros(shape, dtype='i1'))
+        ice.attrs['scale_factor'] = 0.01
+        ice.attrs['_FillValue'] = np.int8(-128)
+
+
+class TestProcessSstCci:
+    START = datetime.datetime(2020, 1, 1)
+    END = datetime.datetime(2020, 1, 5, 18)
+
+    def _mirror(self, mock_params, monkeypatch, tmp_path):
+        dates = [self.START.date() + datetime.timedelta(days=i) for i in range(5)]
+        lat = np.arange(-50, -29.9, 0.5)
+        lon = np.arange(160, 185.1, 0.5)
+
+        mirror = tmp_path / 'mirror'
+        for d in dates:
+            _write_cci_file(mirror / '2020' / _name(d, 'CDR'), d, lat, lon)
+        store = CountingStorage(mirror)
+        monkeypatch.setattr(storage, 'get_storage', lambda name, remote: store)
+        mock_params['remote'] = {'sst': {'type': 'local', 'path': str(mirror)}}
+        mock_params['sst'] = {'window_days': 2, 'decode_workers': 2}
+        return store
+
+    def test_streams_days_in_windows(self, mock_params, monkeypatch, tmp_path):
+        fake = self._mirror(mock_params, monkeypatch, tmp_path)
+
+        process_sst_cci.process_sst_cci(self.START, self.END, 6, 165, -45, 180, -35)
+
+        downloads = [call for call in fake.calls if call[0] == 'download']
+        assert len(downloads) == 3
+        written = sorted(p.name for p in params.data_path.glob('SST:*'))
+        assert len(written) == 5 * 4
+        assert written[0] == 'SST:2020-01-01_00'
+        assert not params.data_path.joinpath('sst').exists()
+
+    def test_rerun_served_from_cache(self, mock_params, monkeypatch, tmp_path):
+        fake = self._mirror(mock_params, monkeypatch, tmp_path)
+        monkeypatch.setattr(params, 'cache_path', tmp_path / 'cache')
+
+        process_sst_cci.process_sst_cci(self.START, self.END, 6, 165, -45, 180, -35)
+        first_run = len(fake.calls)
+        for path in params.data_path.glob('SST:*'):
+            path.unlink()
+        process_sst_cci.process_sst_cci(self.START, self.END, 6, 165, -45, 180, -35)
+
+        assert first_run > 0
+        assert len(fake.calls) == first_run
+        assert len(list(params.data_path.glob('SST:*'))) == 5 * 4
+        assert len(list(tmp_path.joinpath('cache', 'sst').glob('*/*/meta.json'))) == 5
+
+    def test_slabs_are_float32(self, tmp_path):
+        d = datetime.date(2020, 1, 3)
+        lat = np.arange(-50, -29.9, 0.5)
+        lon = np.arange(160, 185.1, 0.5)
+        nc_path = tmp_path / 'day.nc'
+        _write_cci_file(nc_path, d, lat, lon)
+
+        idx, _, _ = process_sst_cci._bbox_indices(nc_path, 165, -45, 180, -35)
+        sst, ice = process_sst_cci._read_day_slabs(nc_path, idx)
+
+        assert sst.dtype == ice.dtype == np.float32
+        np.testing.assert_allclose(sst, 273.15 + 0.3, rtol=1e-6)
+        np.testing.assert_array_equal(ice, 0)
+
+    def test_bbox_across_the_seam(self, tmp_path):
+        d = datetime.date(2020, 1, 3)
+        lat = np.arange(-50, -29.9, 0.5)
+        lon = np.arange(-180, 180, 0.5)
+        nc_path = tmp_path / 'day.nc'
+        _write_cci_file(nc_path, d, lat, lon)
+
+        idx, _, lon_sub = process_sst_cci._bbox_indices(nc_path, 170, -45, 190, -35)
+        sst, _ = process_sst_cci._read_day_slabs(nc_path, idx)
+
+        assert len(idx[2]) == 2
+        assert lon_sub[0] == 169 and lon_sub[-1] == 191
+        assert np.all(np.diff(lon_sub) == 0.5)
+        assert sst.shape[1] == len(lon_sub)
+
+    def test_cf_decode_fill_is_nan(self):
+        raw = np.array([[100, -32768]], dtype='i2')
+        data = process_sst_cci._cf_decode(raw, {'scale_factor': 0.01, 'add_offset': 273.15, '_FillValue': -32768})
+
+        assert data.dtype == np.float32
+        assert data[0, 0] == pytest.approx(274.15)
+        assert np.isnan(data[0, 1])
+
+
+class TestCoarsen:
+    def test_block_average_ignores_nan(self):
+        slab = np.array([
+            [1, 3, 5, 5, 9],
+            [np.nan, 2, 5, 5, 9],
+            [np.nan, np.nan, 7, 8, 9],
+            [np.nan, np.nan, 9, 10, 9],
+        ], dtype=np.float32)
+
+        out = process_sst_cci._coarsen(slab, 2)
+
+        assert out.shape == (2, 2)
+        assert out.dtype == np.float32
+        np.testing.assert_allclose(out[0], [2, 5])
+        assert np.isnan(out[1, 0])
+        assert out[1, 1] == pytest.approx(8.5)
+
+    def test_coords_are_block_centres(self):
+        np.testing.assert_allclose(process_sst_cci._coarsen_coords(np.arange(0, 0.5, 0.05), 4), [0.075, 0.275])
+
+    def test_finest_dx_from_nesting(self, mock_params):
+        from set_params import set_nml_params
+        set_nml_params()
+
+        assert process_sst_cci._finest_dx_deg() == pytest.approx(3000 / process_sst_cci.M_PER_DEG)
+
+    def test_finest_dx_of_the_sst_domains_only(self, mock_params):
+        import f90nml
+        from set_params import set_nml_params
+        set_nml_params()
+        wps_nml = f90nml.read(params.wps_nml_path)
+        wps_nml['share']['max_dom'] = 2
+        wps_nml.write(params.wps_nml_path, force=True)
+
+        assert process_sst_cci._finest_dx_deg() == pytest.approx(9000 / process_sst_cci.M_PER_DEG)
+
+    def test_factor_only_when_enabled(self, mock_params, monkeypatch):
+        monkeypatch.setattr(process_sst_cci, '_finest_dx_deg', lambda: 27000 / process_sst_cci.M_PER_DEG)
+
+        assert process_sst_cci._coarsen_factor(0.05) == 1
+        mock_params['sst'] = {'coarsen': True}
+        assert process_sst_cci._coarsen_factor(0.05) == 2
+        mock_params['sst']['coarsen_points_per_dx'] = 1
+        assert process_sst_cci._coarsen_factor(0.05) == 4
+
+
+class TestDedup:
+    def _setup(self, monkeypatch, tmp_path):
+        monkeypatch.chdir(tmp_path)
+        lat = np.arange(-45, -35, 0.5)
+        lon = np.arange(165, 180, 0.5)
+        proj = process_sst_cci._build_projection(lat, lon)
+        sst = np.full((len(lat), len(lon)), 290.0, dtype=np.float32)
+        ice = np.zeros_like(sst)
+        return sst, ice, proj
+
+    def test_rewrite_matches_direct_write(self, monkeypatch, tmp_path):
+        sst, ice, proj = self._setup(monkeypatch, tmp_path)
+        t0, t1 = datetime.datetime(2020, 1, 1, 0), datetime.datetime(2020, 1, 1, 9)
+
+        process_sst_cci._write_intermediate(t1, sst, ice, proj)
+        direct = pathlib.Path('SST:2020-01-01_09').read_bytes()
+        pathlib.Path('SST:2020-01-01_09').unlink()
+
+        process_sst_cci._write_intermediate(t0, sst, ice, proj)
+        src = pathlib.Path('SST:2020-01-01_00')
+        offsets = process_sst_cci._hdate_offsets(src)
+        process_sst_cci._dedup_intermediate(src, t1, 'rewrite', offsets)
+
+        assert len(offsets) == 2
+        assert pathlib.Path('SST:2020-01-01_09').read_bytes() == direct
+
+    def test_link_shares_inode(self, monkeypatch, tmp_path):
+        sst, ice, proj = self._setup(monkeypatch, tmp_path)
+        t0, t1 = datetime.datetime(2020, 1, 1, 0), datetime.datetime(2020, 1, 1, 9)
+
+        process_sst_cci._write_intermediate(t0, sst, ice, proj)
+        process_sst_cci._dedup_intermediate(pathlib.Path('SST:2020-01-01_00'), t1, 'link', None)
+
+        assert pathlib.Path('SST:2020-01-01_09').stat().st_ino == pathlib.Path('SST:2020-01-01_00').stat().st_ino
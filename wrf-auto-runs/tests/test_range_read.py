@@ -0,0 +1,83 @@
+import datetime
+
+import h5netcdf
+import numpy as np
+import pytest
+
+pytest.importorskip('fsspec')
+
+import range_read
+
+
+TIMES = [datetime.datetime(2020, 1, 1, h) for h in range(0, 24, 6)]
+
+
+def _write_wrfout(path):
+    """Small wrfout-like file with a variable wrf_to_int does not need."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with h5netcdf.File(path, 'w') as nc:
+        nc.dimensions = {'Time': None, 'DateStrLen': 19, 'bottom_top': 3, 'south_north': 4, 'west_east': 5}
+        nc.attrs['MAP_PROJ'] = np.int32(1)
+        nc.attrs['DX'] = np.float32(27000.0)
+        nc.resize_dimension('Time', len(TIMES))
+
+        times = np.array([list(t.strftime(range_read.WRF_TIME_FORMAT)) for t in TIMES], dtype='S1')
+        nc.create_variable('Times', ('Time', 'DateStrLen'), data=times)
+        for name in ('T', 'W'):
+            data = np.arange(len(TIMES) * 60, dtype='float32').reshape(len(TIMES), 3, 4, 5)
+            var = nc.create_variable(name, ('Time', 'bottom_top', 'south_north', 'west_east'), data=data)
+            var.attrs['units'] = 'K'
+        nc.create_variable('XLAT', ('Time', 'south_north', 'west_east'),
+                           data=np.zeros((len(TIMES), 4, 5), dtype='float32'))
+        nc.create_variable('P_TOP', ('Time',), data=np.full(len(TIMES), 5000.0, dtype='float32'))
+
+
+class TestRemoteUrl:
+    def test_local_and_unsupported(self):
+        assert range_read.remote_url({'type': 'local', 'path': '/data/wrf/'}) == ('file:///data/wrf', {})
+        assert range_read.remote_url({'type': 'b2', 'path': '/bucket'}) is None
+
+    def test_s3_credentials_follow_s3_storage(self, monkeypatch):
+        import fsspec
+
+        monkeypatch.setattr(fsspec, 'get_filesystem_class', lambda protocol: object)
+        base = {'type': 's3', 'path': '/bucket/wrf/', 'region': 'ap-southeast-2'}
+
+        url, options = range_read.remote_url(base)
+        assert url == 's3://bucket/wrf'
+        assert options['anon'] is True
+        assert options['client_kwargs'] == {'region_name': 'ap-southeast-2'}
+
+        assert range_read.remote_url({**base, 'env_auth': 'true'})[1]['anon'] is False
+        options = range_read.remote_url({**base, 'access_key_id': 'id', 'secret_access_key': 'secret'})[1]
+        assert (options['key'], options['secret'], options['anon']) == ('id', 'secret', False)
+
+
+class TestSubset:
+    def test_variables_and_times(self, tmp_path):
+        _write_wrfout(tmp_path / 'remote' / 'wrfout_d02.nc')
+        remote_cfg = {'type': 'local', 'path': str(tmp_path / 'remote')}
+
+        failed = range_read.fetch_subsets(remote_cfg, ['wrfout_d02.nc'], tmp_path / 'local',
+                                          range_read.wrf_to_int_variables(),
+                                          {'wrfout_d02.nc': TIMES[1:3]})
+
+        assert failed == {}
+        with h5netcdf.File(tmp_path / 'local' / 'wrfout_d02.nc', 'r') as nc:
+            assert sorted(nc.variables) == ['P_TOP', 'T', 'Times', 'XLAT']
+            assert nc.attrs['MAP_PROJ'] == 1
+            assert nc['T'].attrs['units'] == 'K'
+            assert nc.dimensions['Time'].size == 2
+            assert b''.join(nc['Times'][0]).decode() == '2020-01-01_06:00:00'
+            np.testing.assert_array_equal(nc['T'][1], np.arange(120, 180, dtype='float32').reshape(3, 4, 5))
+
+    def test_missing_time_is_reported(self, tmp_path):
+        _write_wrfout(tmp_path / 'remote' / 'wrfout_d02.nc')
+        remote_cfg = {'type': 'local', 'path': str(tmp_path / 'remote')}
+
+        failed = range_read.fetch_subsets(remote_cfg, ['wrfout_d02.nc', 'absent.nc'], tmp_path / 'local', ['T'],
+                                          {'wrfout_d02.nc': [datetime.datetime(2020, 1, 2)], 'absent.nc': None})
+
+        assert 'not in the file' in failed['wrfout_d02.nc']
+        assert 'absent.nc' in failed
+        assert not list((tmp_path / 'local').glob('*.nc'))
@@ -0,0 +1,83 @@
+import datetime
+
+import pytest
+
+import params
+import range_read
+import run_wrf_to_int
+import utils
+
+
+START = datetime.datetime(2020, 1, 1)
+END = datetime.datetime(2020, 1, 4, 18)
+
+
+@pytest.fixture()
+def wrf_env(mock_params, monkeypatch, tmp_path):
+    monkeypatch.setattr(params, 'cache_path', tmp_path / 'cache')
+    mock_params['remote'] = {'wrf': {'type': 'local', 'path': str(tmp_path / 'remote'), 'domain': 'd02'}}
+    mock_params['input'] = {'wrf': {'window_days': 2, 'range_read': False}}
+    for day in range(1, 5):
+        path = tmp_path / 'remote' / f'wrfout_d02_2020-01-0{day}_00:00:00.nc'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'nc')
+
+    calls = []
+
+    def convert(wrfout, start, end, hour_interval, domain, pressure_levels):
+        on_disk = sorted(p.name for p in (tmp_path / 'wrfout').glob('wrfout_*.nc'))
+        calls.append((wrfout.name, start, end, on_disk))
+        for ts in utils.wps_timestamps(start, end, hour_interval):
+            tmp_path.joinpath(f'WRF:{ts:%Y-%m-%d_%H}').write_bytes(b'int')
+
+    monkeypatch.setattr(run_wrf_to_int, '_convert', convert)
+    monkeypatch.setattr(run_wrf_to_int, '_check_wrfout', lambda *args: '1000,500')
+    return calls
+
+
+class TestStreamWrfToInt:
+    def test_converts_day_by_day_and_deletes(self, wrf_env, tmp_path):
+        run_wrf_to_int.stream_wrf_to_int(START, END, 6, (160, -50, 185, -30))
+
+        assert [c[0] for c in wrf_env] == [f'wrfout_d02_2020-01-0{d}_00:00:00.nc' for d in range(1, 5)]
+        assert all(len(c[3]) <= 2 for c in wrf_env)
+        assert wrf_env[0][1:3] == (datetime.datetime(2020, 1, 1, 0), datetime.datetime(2020, 1, 1, 18))
+        assert not list((tmp_path / 'wrfout').iterdir())
+        assert len(list(tmp_path.glob('WRF:*'))) == 16
+
+    def test_cached_days_are_not_downloaded(self, wrf_env, tmp_path):
+        run_wrf_to_int.stream_wrf_to_int(START, datetime.datetime(2020, 1, 2, 18), 6, (160, -50, 185, -30))
+        for path in tmp_path.glob('WRF:*'):
+            path.unlink()
+        wrf_env.clear()
+
+        run_wrf_to_int.stream_wrf_to_int(START, END, 6, (160, -50, 185, -30))
+
+        assert [c[0] for c in wrf_env] == ['wrfout_d02_2020-01-03_00:00:00.nc', 'wrfout_d02_2020-01-04_00:00:00.nc']
+        assert len(list(tmp_path.glob('WRF:*'))) == 16
+
+    def test_missing_remote_file_fails_before_converting(self, wrf_env, tmp_path):
+        (tmp_path / 'remote' / 'wrfout_d02_2020-01-03_00:00:00.nc').unlink()
+
+        with pytest.raises(ValueError, match='1 are missing'):
+            run_wrf_to_int.stream_wrf_to_int(START, END, 6, (160, -50, 185, -30))
+
+        assert wrf_env == []
+
+    def test_range_read_fetches_missing_times_only(self, wrf_env, mock_params, monkeypatch, tmp_path):
+        mock_params['input']['wrf']['range_read'] = True
+        requests = []
+
+        def fetch_subsets(remote_cfg, names, dest_dir, variables, times):
+            requests.append((names, times))
+            for name in names:
+                (dest_dir / name).write_bytes(b'subset')
+            return {}
+
+        monkeypatch.setattr(range_read, 'fetch_subsets', fetch_subsets)
+
+        run_wrf_to_int.stream_wrf_to_int(START, datetime.datetime(2020, 1, 2, 6), 6, (160, -50, 185, -30))
+
+        assert [r[0] for r in requests] == [['wrfout_d02_2020-01-01_00:00:00.nc'], ['wrfout_d02_2020-01-02_00:00:00.nc']]
+        assert requests[1][1] == {'wrfout_d02_2020-01-02_00:00:00.nc': [datetime.datetime(2020, 1, 2, 0),
+                                                                        datetime.datetime(2020, 1, 2, 6)]}
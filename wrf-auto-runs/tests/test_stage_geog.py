@@ -0,0 +1,108 @@
+import params
+import stage_geog
+from domain_tree import DomainTree
+
+TBL = """\
+===============================
+name = HGT_M
+        priority = 1
+        dest_type = continuous
+        rel_path = default:topo_1deg/
+===============================
+name = LANDUSEF
+        priority = 1
+        rel_path = default:landuse_lo/  # comment
+        rel_path = hi:landuse_hi/
+===============================
+"""
+
+INDEX = """\
+type = continuous
+projection = regular_ll
+dx = 1.0
+dy = 1.0
+known_x = 1.0
+known_y = 1.0
+known_lat = -89.5
+known_lon = -179.5
+tile_x = 10
+tile_y = 10
+tile_z = 1
+units = "meters MSL"
+"""
+
+
+def _geogrid(**kwargs):
+    geogrid = {
+        'map_proj': 'lambert', 'ref_lat': -40.0, 'ref_lon': 172.0, 'truelat1': -40.0, 'truelat2': -40.0,
+        'stand_lon': 172.0, 'dx': 27000, 'dy': 27000, 'parent_id': [1, 1], 'parent_grid_ratio': [1, 3],
+        'i_parent_start': [1, 10], 'j_parent_start': [1, 10], 'e_we': [30, 31], 'e_sn': [30, 31],
+        'geog_data_res': ['default', 'default'],
+    }
+    geogrid.update(kwargs)
+    return geogrid
+
+
+def _write_geog(root):
+    dataset = root / 'topo_1deg'
+    dataset.mkdir(parents=True)
+    (dataset / 'index').write_text(INDEX)
+    for x0 in (331, 341, 351, 1):
+        for y0 in (31, 41, 51):
+            (dataset / f'{x0:05d}-{x0 + 9:05d}.{y0:05d}-{y0 + 9:05d}').write_bytes(b'\0' * 400)
+
+
+class TestPlan:
+    def test_resolution_priority(self, tmp_path):
+        (tmp_path / 'GEOGRID.TBL').write_text(TBL)
+        entries = stage_geog.read_geogrid_tbl(tmp_path / 'GEOGRID.TBL')
+
+        assert stage_geog.dataset_paths(entries, 'default') == {'topo_1deg', 'landuse_lo'}
+        assert stage_geog.dataset_paths(entries, 'hi+default') == {'topo_1deg', 'landuse_hi'}
+        assert stage_geog.dataset_paths(entries, 'unknown') == {'topo_1deg', 'landuse_lo'}
+
+    def test_nest_inside_parent(self):
+        (d01, d02) = DomainTree(_geogrid()).bounds()
+
+        assert d01[0] < d02[0] < d02[2] < d01[2]
+        assert d01[1] < d02[1] < d02[3] < d01[3]
+        assert 166 < d01[0] < 168 and 176 < d01[2] < 178
+
+    def test_only_overlapping_tiles(self, tmp_path):
+        _write_geog(tmp_path)
+        bounds = DomainTree(_geogrid()).bounds()[:1]
+
+        assert stage_geog.needed_files(tmp_path / 'topo_1deg', bounds) == [
+            '00341-00350.00041-00050', '00341-00350.00051-00060',
+            '00351-00360.00041-00050', '00351-00360.00051-00060',
+            'index',
+        ]
+
+    def test_dateline_tiles(self, tmp_path):
+        _write_geog(tmp_path)
+
+        files = stage_geog.needed_files(tmp_path / 'topo_1deg', [(178.5, -47, 182, -43)], pad=0)
+
+        assert files == ['00001-00010.00041-00050', '00351-00360.00041-00050', 'index']
+
+
+class TestStageGeog:
+    def test_disabled_without_stage_path(self, mock_params):
+        assert stage_geog.stage_geog({'share': {'max_dom': 1}, 'geogrid': _geogrid()}) is None
+
+    def test_stages_needed_files(self, mock_params, monkeypatch, tmp_path, capsys):
+        geog = tmp_path / 'WPS_GEOG'
+        _write_geog(geog)
+        (tmp_path / 'tbl').mkdir()
+        (tmp_path / 'tbl' / 'GEOGRID.TBL').write_text(TBL)
+        monkeypatch.setattr(params, 'geog_data_path', geog)
+        monkeypatch.setitem(params.file, 'geog', {'stage_path': str(tmp_path / 'staged')})
+        wps_nml = {'share': {'max_dom': 2}, 'geogrid': _geogrid(opt_geogrid_tbl_path=str(tmp_path / 'tbl'))}
+
+        assert stage_geog.stage_geog(wps_nml) == tmp_path / 'staged'
+        staged = sorted(p.name for p in (tmp_path / 'staged' / 'topo_1deg').iterdir())
+        assert len(staged) == 5 and 'index' in staged
+        assert not (tmp_path / 'staged' / 'landuse_lo').exists()
+
+        stage_geog.stage_geog(wps_nml)
+        assert '(0 MB copied)' in capsys.readouterr().out.splitlines()[-1]
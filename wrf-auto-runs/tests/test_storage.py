@@ -0,0 +1,182 @@
+import subprocess
+import sys
+import types
+
+import pytest
+
+import params
+import storage
+import utils
+
+
+def _write(path, content=b'x'):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return path
+
+
+class TestLocalStorage:
+    def test_list_is_files_only(self, tmp_path):
+        _write(tmp_path / 'remote' / 'a.nc')
+        _write(tmp_path / 'remote' / 'sub' / 'b.nc')
+        store = storage.LocalStorage(tmp_path / 'remote')
+
+        assert list(store.list()) == ['a.nc']
+        assert list(store.list('sub')) == ['b.nc']
+        assert list(store.list('missing')) == []
+
+    def test_download_and_upload(self, tmp_path):
+        _write(tmp_path / 'remote' / '2020' / 'a.nc', b'abc')
+        store = storage.LocalStorage(tmp_path / 'remote')
+
+        assert store.download(['2020/a.nc'], tmp_path / 'local') == {}
+        assert (tmp_path / 'local' / '2020' / 'a.nc').read_bytes() == b'abc'
+
+        assert store.upload([tmp_path / 'local' / '2020' / 'a.nc'], 'logs/run1') == {}
+        assert (tmp_path / 'remote' / 'logs' / 'run1' / 'a.nc').read_bytes() == b'abc'
+
+    def test_failures_are_reported_per_file(self, tmp_path):
+        _write(tmp_path / 'remote' / 'a.nc')
+        store = storage.LocalStorage(tmp_path / 'remote')
+
+        failed = store.download(['a.nc', 'b.nc'], tmp_path / 'local')
+
+        assert list(failed) == ['b.nc']
+        with pytest.raises(ValueError, match='1 file'):
+            storage.check_failures(failed, 'download')
+
+
+class TestGetStorage:
+    def test_local_type(self, mock_params, tmp_path):
+        store = storage.get_storage('sst', {'type': 'local', 'path': str(tmp_path)})
+
+        assert isinstance(store, storage.LocalStorage)
+        assert storage.get_storage('sst', {'type': 'local', 'path': str(tmp_path)}) is store
+
+    def test_rclone_fallback(self, mock_params, monkeypatch, tmp_path):
+        monkeypatch.setattr(storage, '_storages', {})
+        mock_params['storage'] = {'backend': 'rclone'}
+
+        store = storage.get_storage('output', {'type': 'local', 'path': '/out'})
+
+        assert isinstance(store, storage.RcloneStorage)
+        assert store._remote('logs/run1') == 'output:/out/logs/run1/'
+
+    def test_rclone_failures_name_the_error(self, mock_params, monkeypatch, tmp_path):
+        store = storage.RcloneStorage('wrf', {'type': 's3', 'path': '/bucket/wrf'})
+        stderr = 'ERROR : wrfout_d02_2020-01-02_00:00:00.nc: Failed to copy: 403 Forbidden'
+        monkeypatch.setattr(subprocess, 'run', lambda cmd, **kw: subprocess.CompletedProcess(cmd, 1, '', stderr))
+
+        failed = store.download(['wrfout_d02_2020-01-02_00:00:00.nc'], tmp_path)
+
+        assert '403 Forbidden' in failed['wrfout_d02_2020-01-02_00:00:00.nc']
+
+    def test_governed_rclone_is_single_stream(self, mock_params, monkeypatch, tmp_path):
+        monkeypatch.setitem(params.file, 'storage', {'max_transfers': 3, 'slots_path': str(tmp_path / 'slots'),
+                                                     'backend': 'rclone'})
+        cmds = []
+        monkeypatch.setattr(subprocess, 'run', lambda cmd, **kw: cmds.append(cmd) or subprocess.CompletedProcess(cmd, 0, '', ''))
+
+        store = storage.get_storage('wrf', {'type': 's3', 'path': '/bucket/wrf'})
+        store.download([], tmp_path)
+
+        assert store.store.streams == 1
+        assert cmds[-1][cmds[-1].index('--multi-thread-streams') + 1] == '0'
+
+
+class TestOutputUploads:
+    def test_ul_output_files_removes_uploaded(self, mock_params, monkeypatch, tmp_path):
+        mock_params['remote'] = {'output': {'type': 'local', 'path': str(tmp_path / 'remote')}}
+        monkeypatch.setattr(params, 'is_remote_output', True)
+        files = [str(_write(tmp_path / 'run' / 'wrfout_d01_2020-01-01_00:00:00.nc'))]
+
+        utils.ul_output_files(files, utils.output_storage())
+
+        assert (tmp_path / 'remote' / 'wrfout_d01_2020-01-01_00:00:00.nc').exists()
+        assert not (tmp_path / 'run' / 'wrfout_d01_2020-01-01_00:00:00.nc').exists()
+
+    def test_ul_output_files_keeps_only_failed(self, tmp_path):
+        files = [str(_write(tmp_path / 'run' / f'wrfout_d0{d}_2020-01-01_00:00:00.nc')) for d in (1, 2)]
+
+        class PartialStore:
+            def upload(self, paths):
+                return {'wrfout_d02_2020-01-01_00:00:00.nc': 'connection reset'}
+
+        utils.ul_output_files(files, PartialStore())
+
+        assert [p.name for p in (tmp_path / 'run').iterdir()] == ['wrfout_d02_2020-01-01_00:00:00.nc']
+
+    def test_ul_rsl_logs(self, mock_params, monkeypatch, tmp_path):
+        mock_params['remote'] = {'output': {'type': 'local', 'path': str(tmp_path / 'remote')}}
+        monkeypatch.setattr(params, 'is_remote_output', True)
+        _write(tmp_path / 'run' / 'rsl.out.0000')
+        _write(tmp_path / 'run' / 'wrf.exe')
+
+        utils.ul_rsl_logs(tmp_path / 'run', 'abc')
+
+        assert [p.name for p in (tmp_path / 'remote' / 'logs' / 'abc').iterdir()] == ['rsl.out.0000']
+
+
+@pytest.fixture()
+def fake_boto3(monkeypatch):
+    """Minimal boto3/botocore stand-ins recording the client and transfer settings."""
+    calls = {}
+    boto3 = types.ModuleType('boto3')
+    boto3.client = lambda service, **kwargs: calls.setdefault('client', kwargs)
+    transfer = types.ModuleType('boto3.s3.transfer')
+    transfer.TransferConfig = lambda **kwargs: calls.setdefault('transfer', kwargs)
+    botocore = types.ModuleType('botocore')
+    botocore.UNSIGNED = object()
+    config = types.ModuleType('botocore.config')
+    config.Config = lambda **kwargs: kwargs
+
+    modules = {'boto3': boto3, 'boto3.s3': types.ModuleType('boto3.s3'), 'boto3.s3.transfer': transfer,
+               'botocore': botocore, 'botocore.config': config}
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+
+    return calls, botocore.UNSIGNED
+
+
+class TestS3Storage:
+    def test_keyless_remote_is_anonymous(self, fake_boto3):
+        calls, unsigned = fake_boto3
+        storage.S3Storage({'type': 's3', 'path': '/era5-pds/data', 'access_key_id': '', 'secret_access_key': ''})
+
+        assert calls['client']['aws_access_key_id'] is None
+        assert calls['client']['config']['signature_version'] is unsigned
+
+    def test_governed_streams_fit_the_cap(self, mock_params, monkeypatch, tmp_path, fake_boto3):
+        calls, _ = fake_boto3
+        storage.get_storage('era5', {'type': 's3', 'path': '/bucket/era5'})
+        assert calls.pop('transfer')['max_concurrency'] == 4
+
+        monkeypatch.setitem(params.file, 'storage', {'max_transfers': 3, 'slots_path': str(tmp_path / 'slots')})
+        store = storage.get_storage('sst', {'type': 's3', 'path': '/bucket/sst'})
+
+        assert isinstance(store, storage.GovernedStorage)
+        assert calls['transfer']['max_concurrency'] == 1
+        with store.slots.acquire(8) as n:
+            assert n * store.store.streams <= 3
+
+    def test_env_auth_and_keys_are_signed(self, fake_boto3):
+        calls, _ = fake_boto3
+        storage.S3Storage({'type': 's3', 'path': '/bucket', 'env_auth': 'true'})
+        assert 'signature_version' not in calls.pop('client')['config']
+
+        storage.S3Storage({'type': 's3', 'path': '/bucket', 'access_key_id': 'id', 'secret_access_key': 'secret'})
+        assert calls['client']['aws_access_key_id'] == 'id'
+        assert 'signature_version' not in calls['client']['config']
+
+    def test_round_trip(self, tmp_path):
+        boto3 = pytest.importorskip('boto3')
+        moto = pytest.importorskip('moto')
+
+        with moto.mock_aws():
+            boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='bucket')
+            store = storage.S3Storage({'type': 's3', 'path': '/bucket/data', 'region': 'us-east-1', 'env_auth': True})
+
+            assert store.upload([_write(tmp_path / 'a.nc', b'abc')], '2020') == {}
+            assert list(store.list('2020')) == ['a.nc']
+            assert store.download(['2020/a.nc'], tmp_path / 'local') == {}
+            assert (tmp_path / 'local' / '2020' / 'a.nc').read_bytes() == b'abc'
@@ -0,0 +1,58 @@
+import pytest
+
+import params
+import wps_mpi
+
+
+@pytest.fixture
+def wps_env(mock_params, monkeypatch, tmp_path):
+    monkeypatch.setattr(params, 'wps_path', tmp_path)
+    monkeypatch.setattr(wps_mpi, 'free_cores', lambda: 48)
+    wps_mpi._detect_dmpar.cache_clear()
+    yield tmp_path
+    wps_mpi._detect_dmpar.cache_clear()
+
+
+def _wps_nml(e_we, e_sn):
+    return {'share': {'max_dom': len(e_we)}, 'geogrid': {'e_we': e_we, 'e_sn': e_sn}}
+
+
+class TestDmpar:
+    def test_detected_from_configure_wps(self, wps_env):
+        (wps_env / 'configure.wps').write_text('CPPFLAGS = -D_UNDERSCORE -DBYTESWAP -D_MPI -DIO_NETCDF\n')
+
+        cmd, ranks = wps_mpi.wps_command(wps_env / 'geogrid.exe', _wps_nml([200], [200]))
+
+        assert cmd == ['mpirun', '-np', '16', str(wps_env / 'geogrid.exe')]
+        assert ranks == 16
+
+    def test_serial_build(self, wps_env):
+        (wps_env / 'configure.wps').write_text('# -D_MPI\nCPPFLAGS = -D_UNDERSCORE -DIO_NETCDF\n')
+
+        assert wps_mpi.wps_command(wps_env / 'metgrid.exe', _wps_nml([200], [200])) == ([str(wps_env / 'metgrid.exe')], 1)
+
+    def test_config_overrides_detection(self, wps_env, monkeypatch):
+        monkeypatch.setitem(params.file, 'wps', {'dmpar': True, 'max_ranks': 4})
+
+        assert wps_mpi.wps_command(wps_env / 'metgrid.exe', _wps_nml([300], [300]))[1] == 4
+
+
+class TestRanks:
+    def test_smallest_domain_limits_ranks(self, wps_env):
+        assert wps_mpi.n_ranks({'e_we': [400, 101], 'e_sn': [400, 121]}, 2) == 4
+        assert wps_mpi.n_ranks({'e_we': [400, 101], 'e_sn': [400, 121]}, 1) == 48
+        assert wps_mpi.n_ranks({'e_we': [30], 'e_sn': [30]}, 1) == 1
+
+
+class TestLogs:
+    def test_rank_logs_and_errors(self, tmp_path):
+        (tmp_path / 'metgrid.log').write_text('old serial log\n')
+        assert wps_mpi.rank_logs('metgrid', tmp_path) == [tmp_path / 'metgrid.log']
+
+        wps_mpi.clear_logs('metgrid', tmp_path)
+        (tmp_path / 'metgrid.log.0000').write_text('Processing domain 1\n')
+        (tmp_path / 'metgrid.log.0001').write_text('ERROR: The mandatory field TT was not found\n')
+
+        logs = wps_mpi.rank_logs('metgrid', tmp_path)
+        assert [p.name for p in logs] == ['metgrid.log.0000', 'metgrid.log.0001']
+        assert wps_mpi.log_errors(logs) == 'metgrid.log.0001: ERROR: The mandatory field TT was not found'
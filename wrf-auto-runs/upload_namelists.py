@@ -6,12 +6,8 @@ Created on Mon Oct  6 15:41:48 2025
 @author: mike
 """
 import os
-import pathlib
-import shlex
-import subprocess
-import copy
 
-import params, utils
+import params, storage
 
 ############################################
 ### Parameters
@@ -29,25 +25,16 @@ def upload_namelists(run_uuid):
     if not params.is_remote_output:
         return
 
-    remote = copy.deepcopy(params.file['remote']['output'])
+    remote = params.file['remote']['output']
 
     if 'path' in remote:
-        out_path = pathlib.Path(remote.pop('path'))
+        store = storage.get_storage('output', remote)
 
-        name = 'output'
-        config_path = utils.create_rclone_config(name, params.data_path, remote)
+        failed = store.upload([params.wps_nml_path, params.wrf_nml_path], f'namelists/{run_uuid}')
 
-        files_from = "namelist.input\nnamelist.wps"
+        storage.check_failures(failed, 'upload namelists')
 
-        dest_str = f'{name}:{out_path}/namelists/{run_uuid}/'
-        cmd_str = f'rclone copy {params.data_path} {dest_str} --no-traverse --no-check-dest --config={config_path} --files-from -'
-        cmd_list = shlex.split(cmd_str)
-        p = subprocess.run(cmd_list, input=files_from, capture_output=True, text=True, check=False)
-
-        if p.stderr != '':
-            raise ValueError(p.stderr)
-        else:
-            return True
+        return True
 
 
 
@@ -5,18 +5,22 @@ Created on Tue Sep 23 15:03:38 2025
 
 @author: mike
 """
+import functools
 import os
 import shlex
 import subprocess
 import pathlib
+from datetime import timedelta
 
-import h5netcdf
 import numpy as np
 import pendulum
 import pyproj
 
 import params
 import defaults
+import cache
+import meta_index
+import storage
 
 ############################################
 ### Parameters
@@ -64,6 +68,127 @@ def dt_to_file_names(prefix, dts, domains):
     return out_list
 
 
+def wps_timestamps(start_date, end_date, hour_interval):
+    """Yield timestamps from start to end, inclusive, stepping hour_interval."""
+    curr = start_date.replace(minute=0, second=0, microsecond=0)
+    end = end_date.replace(minute=0, second=0, microsecond=0)
+    step = timedelta(hours=hour_interval)
+    while curr <= end:
+        yield curr
+        curr += step
+
+
+def lon_ranges(min_lon, max_lon, lon_start=0):
+    """
+    Split the longitude interval min_lon..max_lon (0-360, max_lon may exceed
+    360 across the prime meridian) into ascending (lo, hi) pieces within a
+    grid whose longitudes run from lon_start to lon_start + 360.
+    """
+    if max_lon - min_lon >= 360:
+        return [(lon_start, lon_start + 360)]
+
+    lo = (min_lon - lon_start) % 360 + lon_start
+    hi = lo + (max_lon - min_lon)
+    if hi <= lon_start + 360:
+        return [(lo, hi)]
+    return [(lo, lon_start + 360), (lon_start, hi - 360)]
+
+
+def lon_arc(lons):
+    """
+    Smallest (start, end) longitude arc (0-360, end may exceed 360) that
+    contains every longitude in lons: the complement of the widest gap.
+    """
+    lons = np.unique(np.mod(lons, 360))
+    gaps = np.diff(np.append(lons, lons[0] + 360))
+    widest = int(np.argmax(gaps))
+    if widest == len(lons) - 1:
+        return float(lons[0]), float(lons[-1])
+    return float(lons[widest + 1]), float(lons[widest] + 360)
+
+
+def ring_bbox(ring_lon, ring_lat, pad=0.5):
+    """
+    Download bbox (min_lon, min_lat, max_lon, max_lat) of a domain boundary
+    ring, padded by pad degrees and rounded out to whole degrees. Longitudes
+    are 0-360; across the prime meridian max_lon exceeds 360 (see lon_ranges).
+    """
+    start, end = lon_arc(ring_lon)
+    if end - start + 2 * pad >= 360:
+        start, end = 0.0, 360.0
+    else:
+        start -= pad
+        end += pad
+        if start < 0:
+            start += 360
+            end += 360
+
+    min_lat = max(float(np.floor(np.min(ring_lat) - pad)), -90.0)
+    max_lat = min(float(np.ceil(np.max(ring_lat) + pad)), 90.0)
+
+    return float(np.floor(start)), min_lat, float(np.ceil(end)), max_lat
+
+
+def contiguous_runs(timestamps, hour_interval):
+    """Group sorted timestamps into (first, last) runs spaced exactly hour_interval apart."""
+    step = timedelta(hours=hour_interval)
+    runs = []
+    for ts in timestamps:
+        if runs and ts - runs[-1][1] == step:
+            runs[-1][1] = ts
+        else:
+            runs.append([ts, ts])
+
+    return [tuple(run) for run in runs]
+
+
+def int_cache_key(prefix, source, ts):
+    return f'{prefix.lower()}/{cache.hash_key(source)[:16]}/{ts.strftime("%Y-%m-%d_%H")}'
+
+
+def _int_file_name(prefix, ts):
+    return f'{prefix}:{ts.strftime("%Y-%m-%d_%H")}'
+
+
+def link_cached_intermediates(prefix, source, timestamps):
+    """
+    Link cached {prefix}:YYYY-MM-DD_HH intermediate files into data_path.
+
+    source is a dict describing everything besides the valid time that the file
+    contents depend on (input source, bbox, skip-vars...). Returns the
+    timestamps that are not cached (all of them when no cache is configured).
+    """
+    int_cache = cache.get_cache('int')
+    if int_cache is None:
+        return list(timestamps)
+
+    missing = []
+    for ts in timestamps:
+        entry = int_cache.get(int_cache_key(prefix, source, ts))
+        if entry is None:
+            missing.append(ts)
+        else:
+            int_cache.materialize(entry, params.data_path)
+
+    return missing
+
+
+def publish_intermediates(prefix, source, timestamps):
+    """Publish freshly converted intermediate files in data_path to the cache."""
+    int_cache = cache.get_cache('int')
+    if int_cache is None:
+        return
+
+    for ts in timestamps:
+        file_name = _int_file_name(prefix, ts)
+        file_path = params.data_path.joinpath(file_name)
+        if not file_path.exists():
+            raise FileNotFoundError(f'Expected intermediate file was not written: {file_path}')
+        int_cache.publish(int_cache_key(prefix, source, ts), [file_path], {'source': source})
+
+    int_cache.evict()
+
+
 def read_last_line(file_path):
     """
 
@@ -152,72 +277,64 @@ def rename_files(files, rename_dict):
     return new_files
 
 
-def check_input_extent(input_type, min_lon, min_lat, max_lon, max_lat):
+def check_input_extent(input_type, min_lon, min_lat, max_lon, max_lat, pattern=None):
     """
     Verify that input data spatially covers the WRF domain.
 
-    Reads the first available source file (ERA5 or wrfout) and compares its
-    lat/lon extent against the domain bounds from run_geogrid().
-    Raises ValueError with a clear message if coverage is insufficient.
+    Compares the lat/lon extent of every source file (ERA5 or wrfout), from
+    the header index (meta_index.scan_dir), against the domain bounds from
+    run_geogrid(). Raises ValueError with a clear message if any file's
+    coverage is insufficient.
 
     Parameters
     ----------
     input_type : str
         'era5' or 'wrf'
     min_lon, min_lat, max_lon, max_lat : float
-        Domain bounds (0-360 longitude convention, from run_geogrid).
+        Domain bounds (0-360 longitude convention, from run_geogrid; max_lon
+        exceeds 360 for domains crossing the prime meridian).
+    pattern : str, optional
+        Glob of the files to check (default: every ERA5 file or wrfout file).
     """
     buffer = 0.5  # degrees buffer for interpolation margin
 
     if input_type == 'era5':
-        sfc_path = params.data_path.joinpath('era5', 'e5.oper.an.sfc')
-        nc_files = sorted(sfc_path.rglob('*.nc'))
-        if not nc_files:
-            raise FileNotFoundError(f'No ERA5 sfc files found in {sfc_path}')
-
-        with h5netcdf.File(str(nc_files[0]), 'r') as f:
-            lat = np.asarray(f['latitude'][:])
-            lon = np.asarray(f['longitude'][:])
-        input_lat_min, input_lat_max = float(lat.min()), float(lat.max())
-        input_lon = np.where(lon < 0, lon + 360, lon)
-        input_lon_min, input_lon_max = float(input_lon.min()), float(input_lon.max())
+        era5_path = params.data_path.joinpath('era5')
+        metas = meta_index.scan_dir(era5_path, pattern or '**/*.nc')
+        if pattern is None and not any(name.startswith('e5.oper.an.sfc') for name in metas):
+            raise FileNotFoundError(f'No ERA5 sfc files found in {era5_path.joinpath("e5.oper.an.sfc")}')
         source_desc = 'ERA5'
 
     elif input_type == 'wrf':
         wrfout_path = params.data_path.joinpath('wrfout')
-        nc_files = sorted(wrfout_path.glob('wrfout_*.nc'))
-        if not nc_files:
+        metas = meta_index.scan_dir(wrfout_path, pattern or 'wrfout_*.nc')
+        if not metas:
             raise FileNotFoundError(f'No wrfout files found in {wrfout_path}')
-
-        with h5netcdf.File(str(nc_files[0]), 'r') as f:
-            lat = np.asarray(f['XLAT'][0])
-            lon = np.asarray(f['XLONG'][0])
-        input_lat_min, input_lat_max = float(lat.min()), float(lat.max())
-        input_lon = np.where(lon < 0, lon + 360, lon)
-        input_lon_min, input_lon_max = float(input_lon.min()), float(input_lon.max())
         source_desc = 'WRF wrfout'
 
     else:
         raise ValueError(f"Unknown input_type: {input_type}")
 
-    # Check coverage
-    gaps = []
-    if input_lat_min > min_lat + buffer:
-        gaps.append(f'lat south of {input_lat_min:.1f} (domain needs {min_lat:.1f})')
-    if input_lat_max < max_lat - buffer:
-        gaps.append(f'lat north of {input_lat_max:.1f} (domain needs {max_lat:.1f})')
-    if input_lon_min > min_lon + buffer:
-        gaps.append(f'lon west of {input_lon_min:.1f} (domain needs {min_lon:.1f})')
-    if input_lon_max < max_lon - buffer:
-        gaps.append(f'lon east of {input_lon_max:.1f} (domain needs {max_lon:.1f})')
-
-    if gaps:
+    # Check coverage of every file
+    short = {}
+    for name, meta in metas.items():
+        if meta['extent'] is None:
+            continue
+        gaps = meta_index.extent_gaps(meta['extent'], (min_lon, min_lat, max_lon, max_lat), buffer,
+                                      lon_ranges(min_lon, max_lon))
+        if gaps:
+            short[name] = gaps
+
+    if short:
+        name, gaps = next(iter(short.items()))
+        input_lon_min, input_lat_min, input_lon_max, input_lat_max = metas[name]['extent']
         gap_str = '\n  - '.join(gaps)
+        others = f'\n{len(short) - 1} other file(s) are also short.' if len(short) > 1 else ''
         raise ValueError(
-            f"{source_desc} data extent (lat {input_lat_min:.1f} to {input_lat_max:.1f}, "
+            f"{source_desc} data extent of {name} (lat {input_lat_min:.1f} to {input_lat_max:.1f}, "
             f"lon {input_lon_min:.1f} to {input_lon_max:.1f}) does not cover the WRF domain "
             f"(lat {min_lat:.1f} to {max_lat:.1f}, lon {min_lon:.1f} to {max_lon:.1f}).\n"
-            f"Missing coverage:\n  - {gap_str}"
+            f"Missing coverage:\n  - {gap_str}{others}"
         )
 
 
@@ -250,253 +367,85 @@ def filter_variables(files, variables):
     return True
 
 
-def ul_output_files(files, run_path, name, out_path, config_path):
+def output_storage():
+    """
+    Storage for [remote.output], or None when no output remote/path is configured.
     """
+    if not params.is_remote_output:
+        return None
+
+    remote = params.file['remote']['output']
+    if 'path' not in remote:
+        return None
+
+    return storage.get_storage('output', remote)
 
+
+def ul_output_files(files, store):
+    """
+    Upload files to the output remote and remove the local copies of those
+    that arrived. Failed files are kept so the next call retries them.
     """
     files_str = '\n'.join([os.path.split(p)[-1] for p in files])
     print(f'-- Uploading files:\n{files_str}')
 
-    cmd_str = f'rclone copy {run_path} {name}:{out_path} --transfers=4 --config={config_path} --files-from-raw -'
-    cmd_list = shlex.split(cmd_str)
-
     start_ul = pendulum.now('UTC')
-    p = subprocess.run(cmd_list, input=files_str, capture_output=True, text=True, check=False)
+    failed = store.upload(files)
     end_ul = pendulum.now('UTC')
 
     diff = end_ul - start_ul
 
     mins = round(diff.total_minutes(), 1)
 
-    if p.stderr == '':
-        for file in files:
-            if os.path.exists(file):
-                os.remove(file)
+    for file in files:
+        if os.path.split(file)[-1] not in failed and os.path.exists(file):
+            os.remove(file)
+
+    if not failed:
         print(f'-- Upload successful in {mins} mins')
+    else:
+        failed_str = '\n'.join(f'{name}: {msg}' for name, msg in sorted(failed.items()))
+        print(f'-- Upload failed for {len(failed)} file(s), will retry:\n{failed_str}')
 
 
-def recalc_geogrid(geogrid, domains):
+def ul_rsl_logs(run_path, run_uuid):
     """
-
+    Upload the rsl.* logs in run_path to logs/{run_uuid}/ on the output remote.
     """
-    parent_ids = to_list(geogrid['parent_id'])
-    old_max_domains = len(parent_ids)
-
-    parent_grid_ratio = to_list(geogrid['parent_grid_ratio'])
-
-    dx = geogrid['dx']
-    dy = geogrid['dy']
-
-    i_parent_start = to_list(geogrid['i_parent_start'])
-    j_parent_start = to_list(geogrid['j_parent_start'])
-
-    e_we = to_list(geogrid['e_we'])
-    e_sn = to_list(geogrid['e_sn'])
-
-    # define original projection
-    map_proj = geogrid['map_proj'].lower()
-    lat_0 = geogrid['ref_lat']
-    lat_1 = geogrid['truelat1']
-    lat_2 = geogrid['truelat2']
-
-    if 'stand_lon' in geogrid:
-        lon_0 = geogrid['stand_lon']
-    else:
-        lon_0 = geogrid['ref_lon']
-
-    ref_lon = geogrid['ref_lon']
-
-    new_top_domain = domains[0]
-
-    # TODO: eventually I'd like to allow multiple sub domains below the ndown domain, but currently only one is allowed
-    if new_top_domain > old_max_domains:
-        raise ValueError('new_top_domain must be greater than max_domains')
+    store = output_storage()
+    if store is None:
+        return
 
-    if new_top_domain > 1:
+    failed = store.upload(sorted(pathlib.Path(run_path).glob('rsl.*')), f'logs/{run_uuid}')
+    if failed:
+        print(f'-- Failed to upload {len(failed)} log file(s): {", ".join(sorted(failed))}')
 
-        lon_angle = lon_0 - ref_lon
 
-        if map_proj == 'lambert':
-            pwrf = f"""+proj=lcc +lat_1={lat_1} +lat_2={lat_2} +lat_0={lat_0} +lon_0={lon_0} +x_0=0 +y_0=0 +a={params.wrf_sphere_radius} +b={params.wrf_sphere_radius}"""
-        elif map_proj == 'mercator':
-            pwrf = f"""+proj=merc +lat_ts={lat_1} +lon_0={lon_0} +x_0=0 +y_0=0 +a={params.wrf_sphere_radius} +b={params.wrf_sphere_radius}"""
-        elif map_proj == 'polar':
-            pwrf = f"""+proj=stere +lat_ts={lat_1} +lat_0=90.0 +lon_0={lon_0} +x_0=0 +y_0=0 +a={params.wrf_sphere_radius} +b={params.wrf_sphere_radius}"""
-        else:
-            raise NotImplementedError('WRF proj not implemented yet: '
-                                      f'{map_proj}')
-
-        proj_crs = pyproj.CRS.from_string(pwrf)
-
-        geo_crs = pyproj.CRS(
-                proj='latlong',
-                R=params.wrf_sphere_radius
-            )
-
-        geo_to_proj = pyproj.Transformer.from_crs(geo_crs, proj_crs, always_xy=True)
-        proj_to_geo = pyproj.Transformer.from_crs(proj_crs, geo_crs, always_xy=True)
-
-        index = new_top_domain - 1
-        domain_seq = [index]
-        while True:
-            parent_id = parent_ids[index]
-            if parent_id > 1:
-                index = parent_id - 1
-                domain_seq.insert(0, index)
-            else:
-                # domain_seq.insert(0, 0)
-                break
-
-        prev_x_center, prev_y_center = geo_to_proj.transform(ref_lon, lat_0)
-        prev_dx_center = ((e_we[0] - 1) * 0.5) * dx
-        prev_dy_center = ((e_sn[0] - 1) * 0.5) * dy
-        for i in domain_seq:
-            i_start = i_parent_start[i] - 1
-            j_start = j_parent_start[i] - 1
-
-            new_dx_start = i_start * dx
-            new_dy_start = j_start * dy
-
-            dx = dx / parent_grid_ratio[i]
-            dy = dy / parent_grid_ratio[i]
-
-            new_dx_end = new_dx_start + (dx * (e_we[i] - 1))
-            new_dy_end = new_dy_start + (dy * (e_sn[i] - 1))
-
-            new_dx_center = (new_dx_end + new_dx_start) * 0.5
-            new_dy_center = (new_dy_end + new_dy_start) * 0.5
-
-            ddx = new_dx_center - prev_dx_center
-            ddy = new_dy_center - prev_dy_center
-
-            new_x_center = prev_x_center + ddx
-            new_y_center = prev_y_center + ddy
-
-            ref_lon, lat_0 = proj_to_geo.transform(new_x_center, new_y_center)
-
-            prev_x_center, prev_y_center = geo_to_proj.transform(ref_lon, lat_0)
-            prev_dx_center = ((e_we[i] - 1) * 0.5) * dx
-            prev_dy_center = ((e_sn[i] - 1) * 0.5) * dy
-
-        lon_0 = ref_lon + lon_angle
-
-    ## Save projection back to namelist.wps
-    ref_lat = round(lat_0, 6)
-    ref_lon = round(ref_lon, 6)
-    stand_lon = round(lon_0, 6)
-
-    geogrid['dx'] = int(dx)
-    geogrid['dy'] = int(dy)
-    geogrid['ref_lat'] = ref_lat
-    geogrid['ref_lon'] = ref_lon
-    geogrid['truelat1'] = ref_lat
-    geogrid['truelat2'] = ref_lat
-    geogrid['stand_lon'] = stand_lon
-
-    ## Update other parameters in namelist.wps
-    domain_index = [domain - 1 for domain in domains]
-    new_top_parent_id = new_top_domain - 1
-    geogrid['parent_id'] = [parent_ids[pid] - new_top_parent_id if parent_ids[pid] - new_top_parent_id > 1 else 1 for pid in domain_index]
-
-    new_parent_grid_ratio = [parent_grid_ratio[index] for index in domain_index]
-    new_parent_grid_ratio[0] = 1
-    geogrid['parent_grid_ratio'] = new_parent_grid_ratio
-
-    new_i_parent_start = [i_parent_start[index] for index in domain_index]
-    new_i_parent_start[0] = 1
-    geogrid['i_parent_start'] = new_i_parent_start
-
-    new_j_parent_start = [j_parent_start[index] for index in domain_index]
-    new_j_parent_start[0] = 1
-    geogrid['j_parent_start'] = new_j_parent_start
-
-    for p, v in geogrid.items():
-        if isinstance(v, list):
-            if len(v) == old_max_domains:
-                geogrid[p] = [v[index] for index in domain_index]
-
-    return geogrid
-
-
-def update_geogrid(geogrid, domains):
+@functools.lru_cache(maxsize=32)
+def wrf_transformers(map_proj, lat_1, lat_2, lat_0, lon_0):
     """
-
+    (geo_to_proj, proj_to_geo) pyproj transformers between lon/lat and the
+    x/y metres of a WRF map projection on the WRF sphere, built once per
+    projection.
     """
-    parent_ids = to_list(geogrid['parent_id'])
-    old_max_domains = len(parent_ids)
-
-    parent_grid_ratio = to_list(geogrid['parent_grid_ratio'])
-
-    dx = geogrid['dx']
-    dy = geogrid['dy']
-
-    i_parent_start = to_list(geogrid['i_parent_start'])
-    j_parent_start = to_list(geogrid['j_parent_start'])
-
-    new_top_domain = domains[0]
-
-    if new_top_domain > old_max_domains:
-        raise ValueError('new_top_domain must be greater than max_domains')
-
-    if new_top_domain > 1:
-
-        index = new_top_domain - 1
-        domain_seq = [index]
-        while True:
-            parent_id = parent_ids[index]
-            if parent_id > 1:
-                index = parent_id - 1
-                domain_seq.insert(0, index)
-            else:
-                # domain_seq.insert(0, 0)
-                break
-
-        for i in domain_seq:
-            dx = dx / parent_grid_ratio[i]
-            dy = dy / parent_grid_ratio[i]
-
-    geogrid['dx'] = int(dx)
-    geogrid['dy'] = int(dy)
-
-    ## Update other parameters in namelist.wps
-    domain_index = [domain - 1 for domain in domains]
-    new_top_parent_id = new_top_domain - 1
-    geogrid['parent_id'] = [parent_ids[pid] - new_top_parent_id if parent_ids[pid] - new_top_parent_id > 1 else 1 for pid in domain_index]
-
-    new_parent_grid_ratio = [parent_grid_ratio[index] for index in domain_index]
-    new_parent_grid_ratio[0] = 1
-    geogrid['parent_grid_ratio'] = new_parent_grid_ratio
-
-    new_i_parent_start = [i_parent_start[index] for index in domain_index]
-    new_i_parent_start[0] = 1
-    geogrid['i_parent_start'] = new_i_parent_start
-
-    new_j_parent_start = [j_parent_start[index] for index in domain_index]
-    new_j_parent_start[0] = 1
-    geogrid['j_parent_start'] = new_j_parent_start
-
-    for p, v in geogrid.items():
-        if isinstance(v, list):
-            if len(v) == old_max_domains:
-                geogrid[p] = [v[index] for index in domain_index]
-
-    return geogrid
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    if map_proj == 'lambert':
+        pwrf = f"""+proj=lcc +lat_1={lat_1} +lat_2={lat_2} +lat_0={lat_0} +lon_0={lon_0} +x_0=0 +y_0=0 +a={params.wrf_sphere_radius} +b={params.wrf_sphere_radius}"""
+    elif map_proj == 'mercator':
+        pwrf = f"""+proj=merc +lat_ts={lat_1} +lon_0={lon_0} +x_0=0 +y_0=0 +a={params.wrf_sphere_radius} +b={params.wrf_sphere_radius}"""
+    elif map_proj == 'polar':
+        pwrf = f"""+proj=stere +lat_ts={lat_1} +lat_0=90.0 +lon_0={lon_0} +x_0=0 +y_0=0 +a={params.wrf_sphere_radius} +b={params.wrf_sphere_radius}"""
+    else:
+        raise NotImplementedError('WRF proj not implemented yet: '
+                                  f'{map_proj}')
 
+    proj_crs = pyproj.CRS.from_string(pwrf)
 
+    geo_crs = pyproj.CRS(
+            proj='latlong',
+            R=params.wrf_sphere_radius
+        )
 
+    geo_to_proj = pyproj.Transformer.from_crs(geo_crs, proj_crs, always_xy=True)
+    proj_to_geo = pyproj.Transformer.from_crs(proj_crs, geo_crs, always_xy=True)
 
+    return geo_to_proj, proj_to_geo
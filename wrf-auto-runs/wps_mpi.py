@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Launch geogrid.exe and metgrid.exe under mpirun when WPS is a dmpar build.
+
+[wps] dmpar = 'auto' (the default) detects the build from WPS's
+configure.wps (-D_MPI in the compile flags), falling back to whether the
+executable links an MPI library; true/false override the detection. The
+rank count is the free cores of the task ([wps] max_ranks caps it), reduced
+so every rank keeps a patch of at least MIN_PATCH_POINTS grid points on the
+smallest domain. A dmpar build writes one log per rank
+(geogrid.log.0000, ...), which rank_logs collects.
+"""
+import functools
+import os
+import subprocess
+
+import params
+import utils
+
+############################################
+### Parameters
+
+MIN_PATCH_POINTS = 50 * 50
+
+###########################################
+### Functions
+
+
+@functools.lru_cache
+def _detect_dmpar(exe):
+    configure = params.wps_path.joinpath('configure.wps')
+    if configure.is_file():
+        return any('-D_MPI' in line for line in configure.read_text(errors='replace').splitlines()
+                   if not line.lstrip().startswith('#'))
+
+    p = subprocess.run(['ldd', str(exe)], capture_output=True, text=True, check=False)
+    return 'libmpi' in p.stdout
+
+
+def is_dmpar(exe):
+    """Whether exe should be launched under mpirun, per [wps] dmpar."""
+    dmpar = params.file.get('wps', {}).get('dmpar', 'auto')
+    if dmpar == 'auto':
+        return _detect_dmpar(str(exe))
+    return bool(dmpar)
+
+
+def free_cores():
+    """Cores this task may use (its CPU affinity, which Slurm restricts)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def n_ranks(geogrid, max_dom):
+    """
+    Rank count for a WPS run over the first max_dom domains: the free cores
+    (capped by [wps] max_ranks), but no more than the smallest domain can
+    split into MIN_PATCH_POINTS patches.
+    """
+    e_we = utils.to_list(geogrid['e_we'])[:max_dom]
+    e_sn = utils.to_list(geogrid['e_sn'])[:max_dom]
+    grid_limit = min(we * sn for we, sn in zip(e_we, e_sn)) // MIN_PATCH_POINTS
+
+    cores = free_cores()
+    max_ranks = params.file.get('wps', {}).get('max_ranks')
+    if max_ranks:
+        cores = min(cores, int(max_ranks))
+
+    return max(1, min(cores, grid_limit))
+
+
+def wps_command(exe, wps_nml, max_dom=None):
+    """(command list, rank count) to run a WPS executable for wps_nml."""
+    if not is_dmpar(exe):
+        return [str(exe)], 1
+
+    ranks = n_ranks(wps_nml['geogrid'], max_dom or wps_nml['share']['max_dom'])
+    return ['mpirun', '-np', str(ranks), str(exe)], ranks
+
+
+def rank_logs(name, cwd):
+    """The logs of a WPS run in cwd: name.log.NNNN per rank of a dmpar run, else name.log."""
+    logs = sorted(cwd.glob(f'{name}.log.[0-9][0-9][0-9][0-9]'))
+    if logs:
+        return logs
+    return [path for path in [cwd.joinpath(f'{name}.log')] if path.exists()]
+
+
+def log_errors(logs, max_lines=20):
+    """Lines mentioning ERROR in any of logs, prefixed with the log's name."""
+    errors = []
+    for path in logs:
+        for line in path.read_text(errors='replace').splitlines():
+            if 'ERROR' in line:
+                errors.append(f'{path.name}: {line.strip()}')
+
+    return '\n'.join(errors[:max_lines])
+
+
+def clear_logs(name, cwd):
+    """Remove the logs of a previous run so rank_logs only sees this one."""
+    for path in cwd.glob(f'{name}.log*'):
+        path.unlink()